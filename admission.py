@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from monitoring import REGISTRY
+
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "app_admission_wait_seconds", "Time spent queued for an upstream fetch slot"
+)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot get an upstream fetch slot"""
+
+    def __init__(self, message: str, status: int = 503, retry_after: int = 5):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Caps concurrent upstream fetches globally and per client, with fair queuing.
+
+    Requests over the caps wait in a queue per client, and freed slots go
+    to the waiting clients in turn, so a client with many queued requests
+    cannot starve the others. A client with too many requests waiting is
+    rejected with 429 straight away, a full queue with 503, and a request
+    that waits longer than its timeout with 503.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 16,
+        per_client: int = 4,
+        max_queue: int = 64,
+        per_client_queue: Optional[int] = None,
+        retry_after: int = 5,
+    ):
+        self.max_concurrent = max_concurrent
+        self.per_client = per_client
+        self.max_queue = max_queue
+        self.per_client_queue = (
+            per_client if per_client_queue is None else per_client_queue
+        )
+        self.retry_after = retry_after
+        self.admitted = 0
+        self.rejected: Counter = Counter()
+        self._active = 0
+        self._active_by_client: Counter = Counter()
+        self._waiting: "OrderedDict[str, deque]" = OrderedDict()
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, client_id: str, timeout: Optional[float] = None) -> Iterator[None]:
+        """Hold an upstream fetch slot for the duration of the block"""
+        self.acquire(client_id, timeout)
+        try:
+            yield
+        finally:
+            self.release(client_id)
+
+    def acquire(self, client_id: str, timeout: Optional[float] = None):
+        """Wait for a slot; timeout None waits as long as it takes"""
+        started = time.perf_counter()
+        with self._lock:
+            waiter = threading.Event()
+            self._waiting.setdefault(client_id, deque()).append(waiter)
+            self._queued += 1
+            self._dispatch()
+            if not waiter.is_set():
+                # Only requests that would have to wait count against the queue limits
+                if self._queued > self.max_queue:
+                    self._withdraw(client_id, waiter, "queue_full")
+                    raise AdmissionRejected(
+                        "Server is busy, please retry later", 503, self.retry_after
+                    )
+                if len(self._waiting[client_id]) > self.per_client_queue:
+                    self._withdraw(client_id, waiter, "client_limit")
+                    raise AdmissionRejected(
+                        "Too many concurrent requests from this client",
+                        429,
+                        self.retry_after,
+                    )
+
+        if not waiter.wait(timeout):
+            with self._lock:
+                if not waiter.is_set():
+                    self._withdraw(client_id, waiter, "timeout")
+                    raise AdmissionRejected(
+                        "Server is busy, please retry later", 503, self.retry_after
+                    )
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+    def release(self, client_id: str):
+        """Return a slot and hand it to the next waiting client"""
+        with self._lock:
+            self._active -= 1
+            self._active_by_client[client_id] -= 1
+            if self._active_by_client[client_id] <= 0:
+                del self._active_by_client[client_id]
+            self._dispatch()
+
+    def _withdraw(self, client_id: str, waiter: threading.Event, reason: str):
+        """Take a rejected waiter out of the queue; called with the lock held"""
+        queue = self._waiting[client_id]
+        queue.remove(waiter)
+        if not queue:
+            del self._waiting[client_id]
+        self._queued -= 1
+        self.rejected[reason] += 1
+
+    def _dispatch(self):
+        """Grant free slots to waiting clients round-robin; called with the lock held"""
+        while self._active < self.max_concurrent:
+            client_id = next(
+                (
+                    client_id
+                    for client_id in self._waiting
+                    if self._active_by_client[client_id] < self.per_client
+                ),
+                None,
+            )
+            if client_id is None:
+                return
+            queue = self._waiting[client_id]
+            waiter = queue.popleft()
+            if queue:
+                # The client goes to the back of the line for its next slot
+                self._waiting.move_to_end(client_id)
+            else:
+                del self._waiting[client_id]
+            self._queued -= 1
+            self._active += 1
+            self._active_by_client[client_id] += 1
+            self.admitted += 1
+            waiter.set()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Admission counters for the /metrics endpoint"""
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": self._queued,
+                "clients": len(self._active_by_client),
+                "admitted_total": self.admitted,
+                "rejected_total": sum(self.rejected.values()),
+                "rejected_queue_full_total": self.rejected["queue_full"],
+                "rejected_client_limit_total": self.rejected["client_limit"],
+                "rejected_timeout_total": self.rejected["timeout"],
+            }
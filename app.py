@@ -1,426 +1,1733 @@
-from flask import Flask, request, jsonify, render_template, send_file
-import yt_dlp
+import hashlib
+import json
+import logging
+import mimetypes
 import os
+import re
+import shutil
 import tempfile
+import time
 import uuid
-from datetime import datetime
-import shutil
-import json
+from compression import compress_response
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+from flask import (
+    Flask,
+    Response,
+    has_request_context,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+)
+from flask_limiter import Limiter
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+
+from admission import AdmissionController, AdmissionRejected
+from cache import TTLCache
+from canonical import Canonicalizer, video_key
+from config import get_config
+from deadlines import Deadline, DeadlineExceeded, call_with_deadline, configure_executor
+from formats import (
+    FORMAT_FIELDS,
+    FormatTarget,
+    format_columns,
+    format_rows,
+    parse_fields,
+    select_audio_format,
+    select_format,
+    select_thumbnail,
+)
+from janitor import Janitor
+from jobs import JobQueue, OwnerLimitError, QueueFullError
+from metadata_store import MetadataStore
+from monitoring import (
+    FILE_SERVE_SECONDS,
+    REGISTRY,
+    YTDLP_DOWNLOAD_SECONDS,
+    YTDLP_EXTRACTION_SECONDS,
+    PerformanceMonitor,
+    create_metrics_endpoint,
+    register_metrics_provider,
+)
+from postprocess import FASTSTART_EXTS, PRESETS, PostProcessor, output_ext
+from progress import FINAL_STATES, ProgressBroker
+from singleflight import SingleFlight
+from storage import create_storage
+from store import VideoStore, file_etag
+from upstream import UpstreamGuard, UpstreamUnavailable
+from video_index import VideoIndex
+from ydl_pool import YoutubeDLPool
+from zipstream import stream_zip
 
 app = Flask(__name__)
 
 # Configuration
-app.config['UPLOAD_FOLDER'] = 'downloads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config.from_object(get_config())
+
+# Take the client address from X-Forwarded-For as set by the trusted proxies
+if app.config["TRUSTED_PROXIES"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
 
 # Create downloads directory if it doesn't exist
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+if not os.path.exists(app.config["UPLOAD_FOLDER"]):
+    os.makedirs(app.config["UPLOAD_FOLDER"])
+
+# Try best quality, fallback to mp4, then any available format
+DEFAULT_FORMAT = "best/mp4/any"
+
+# Progress events of running jobs, streamed to /progress subscribers
+progress_broker = ProgressBroker(
+    min_interval=app.config["PROGRESS_MIN_INTERVAL"],
+    retention=app.config["JOB_RETENTION"],
+    max_streams=app.config["PROGRESS_MAX_STREAMS"],
+)
+
+# Background pool that runs yt-dlp downloads outside the request thread
+job_queue = JobQueue(
+    max_workers=app.config["DOWNLOAD_WORKERS"],
+    max_pending=app.config["DOWNLOAD_QUEUE_SIZE"],
+    retention=app.config["JOB_RETENTION"],
+    listener=progress_broker.publish,
+    max_per_owner=app.config["CLIENT_MAX_JOBS"],
+    state_dir=app.config["JOB_STATE_DIR"],
+    state_interval=app.config["JOB_STATE_INTERVAL"],
+)
+
+
+def client_id():
+    """Admission and rate limit key: the API key when one is sent, otherwise the client IP"""
+    if not has_request_context():
+        return "internal"
+    api_key = request.headers.get("X-API-Key")
+    if api_key:
+        # Hashed so keys never show up in limiter storage or logs
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return "ip:" + (request.remote_addr or "unknown")
+
+
+# Bounds concurrent yt-dlp extractions and downloads, shared fairly between clients
+admission = AdmissionController(
+    max_concurrent=app.config["UPSTREAM_MAX_CONCURRENCY"],
+    per_client=app.config["CLIENT_MAX_CONCURRENCY"],
+    max_queue=app.config["ADMISSION_QUEUE_SIZE"],
+    retry_after=app.config["RETRY_AFTER"],
+)
+register_metrics_provider("admission", admission.metrics)
+
+# Fails upstream calls fast while TikTok throttles us, and bounds retries across all requests
+upstream_guard = UpstreamGuard(
+    threshold=app.config["UPSTREAM_BREAKER_THRESHOLD"],
+    window=app.config["UPSTREAM_BREAKER_WINDOW"],
+    cooldown=app.config["UPSTREAM_BREAKER_COOLDOWN"],
+    max_retries=app.config["UPSTREAM_MAX_RETRIES"],
+    retry_ratio=app.config["UPSTREAM_RETRY_RATIO"],
+    max_delay=app.config["UPSTREAM_RETRY_MAX_DELAY"],
+)
+register_metrics_provider("upstream", upstream_guard.metrics)
+
+# Routes that reach TikTok; each gets RATELIMIT_DEFAULT per client
+RATE_LIMITED_ENDPOINTS = (
+    "download_video",
+    "download_batch",
+    "get_metadata",
+    "get_video_formats",
+    "stream_video",
+    "get_audio",
+    "get_thumbnail",
+)
+
+
+def rate_limit_exempt():
+    """Polling, health checks and file serving are never rate limited"""
+    return (
+        not app.config["RATELIMIT_ENABLED"]
+        or request.endpoint not in RATE_LIMITED_ENDPOINTS
+    )
+
+
+limiter = Limiter(
+    client_id,
+    app=app,
+    default_limits=[app.config["RATELIMIT_DEFAULT"]],
+    default_limits_exempt_when=rate_limit_exempt,
+    storage_uri=app.config["RATELIMIT_STORAGE_URL"],
+)
+
+
+def admission_error(error):
+    """Response for a request turned away by admission control"""
+    return (
+        jsonify({"error": str(error)}),
+        error.status,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+def request_deadline(default):
+    """Deadline of this request: the server's, or a shorter one the client sent as timeout"""
+    timeout = request.args.get("timeout")
+    if timeout is None:
+        data = request.get_json(silent=True)
+        timeout = data.get("timeout") if isinstance(data, dict) else None
+    if timeout is None:
+        return Deadline(default)
+    try:
+        seconds = float(timeout)
+    except (TypeError, ValueError):
+        seconds = 0
+    if isinstance(timeout, bool) or not seconds > 0:
+        raise ValueError("Invalid timeout provided")
+    return Deadline(min(seconds, default))
+
+
+def timeout_error(error):
+    """Response for a request that ran past its deadline"""
+    return jsonify({"error": str(error)}), 504
+
+
+# Extracted info dicts keyed by TikTok video ID, shared by /metadata and /formats
+metadata_cache = TTLCache(
+    maxsize=app.config["METADATA_CACHE_SIZE"], ttl=app.config["METADATA_CACHE_TTL"]
+)
+register_metrics_provider("metadata_cache", metadata_cache.metrics)
+register_metrics_provider("progress", progress_broker.metrics)
+
+
+def get_metadata_store():
+    """Persistent metadata store, in the upload folder unless METADATA_DB_PATH is set"""
+    path = app.config["METADATA_DB_PATH"] or os.path.join(
+        app.config["UPLOAD_FOLDER"], ".store", "metadata.db"
+    )
+    return MetadataStore.for_path(
+        path,
+        app.config["METADATA_STORE_FRESHNESS"],
+        app.config["METADATA_STORE_MAX_AGE"],
+    )
+
+
+register_metrics_provider(
+    "metadata_store", lambda: get_metadata_store().metrics(), shared=("rows",)
+)
+
+# Evicts old and least-recently-served downloads to keep the disk bounded
+janitor = Janitor(
+    get_folder=lambda: app.config["UPLOAD_FOLDER"],
+    max_bytes=app.config["MAX_DOWNLOADS_BYTES"],
+    max_age=app.config["MAX_DOWNLOAD_AGE"],
+    max_files=app.config["MAX_DOWNLOAD_FILES"],
+    interval=app.config["JANITOR_INTERVAL"],
+    is_busy=job_queue.is_active,
+)
+register_metrics_provider("janitor", janitor.metrics, shared=("disk_bytes",))
+
+# Where /file finds finished downloads: this instance's disk, or a bucket every instance shares
+storage = create_storage(app.config)
+register_metrics_provider("storage", storage.metrics)
+
+
+@app.after_request
+def compress_response_body(response):
+    """gzip (or brotli) JSON and text bodies for clients that accept it"""
+    if not app.config["RESPONSE_COMPRESSION"]:
+        return response
+    return compress_response(
+        response,
+        request.accept_encodings,
+        app.config["COMPRESS_MIN_SIZE"],
+        app.config["COMPRESS_LEVEL"],
+    )
 
-@app.route('/', methods=['GET'])
+
+@app.before_request
+def start_background_tasks():
+    # Started lazily so each gunicorn worker runs its own thread after fork
+    janitor.start()
+    REGISTRY.start_flusher()
+    if app.config["YT_DLP_WARMUP"]:
+        # yt_dlp is not imported at startup; load it now, off the request path
+        ydl_pool.start_warm_up(("metadata", "download"))
+
+
+# Pre-configured yt-dlp instances reused across requests, per option profile
+ydl_pool = YoutubeDLPool(
+    build_options=lambda profile: get_config().get_yt_dlp_options(
+        app.config["UPLOAD_FOLDER"], profile, retry_sleep=upstream_guard.retry_sleep
+    ),
+    size=app.config["YT_DLP_POOL_SIZE"],
+)
+register_metrics_provider("ydl_pool", ydl_pool.metrics)
+# Extractions run on a bounded pool so ones that overrun their deadline cannot pile up threads
+configure_executor(app.config["YT_DLP_EXTRACT_THREADS"])
+
+# ffmpeg faststart remux and transcode presets, run after a download is stored
+postprocessor = PostProcessor(
+    max_workers=app.config["POSTPROCESS_WORKERS"],
+    timeout=app.config["POSTPROCESS_TIMEOUT"],
+)
+register_metrics_provider("postprocess", postprocessor.metrics)
+if not postprocessor.available:
+    logging.info("ffmpeg not found, downloads are served without post-processing")
+
+# Shared HTTP session so streamed fetches reuse connections to the CDN
+upstream_session = requests.Session()
+
+# Coalesces concurrent extractions and downloads of the same video
+single_flight = SingleFlight()
+register_metrics_provider("single_flight", single_flight.metrics)
+register_metrics_provider(
+    "video_store",
+    lambda: VideoStore.for_folder(app.config["UPLOAD_FOLDER"]).metrics(),
+    shared=("blobs", "bytes"),
+)
+
+
+def get_video_index():
+    """Persistent video ID index for the current upload folder"""
+    return VideoIndex.for_folder(
+        app.config["UPLOAD_FOLDER"], app.config["VIDEO_INDEX_SIZE"]
+    )
+
+
+register_metrics_provider(
+    "video_index", lambda: get_video_index().metrics(), shared=("videos", "aliases")
+)
+
+# Maps URL variants and short links to one video ID before any cache lookup
+canonicalizer = Canonicalizer(
+    session=upstream_session,
+    get_index=get_video_index,
+    maxsize=app.config["SHORT_LINK_CACHE_SIZE"],
+    ttl=app.config["SHORT_LINK_CACHE_TTL"],
+    timeout=app.config["SHORT_LINK_TIMEOUT"],
+)
+register_metrics_provider("canonical", canonicalizer.metrics)
+# Workers share request and timing metrics through METRICS_DIR when it is set
+REGISTRY.configure(app.config["METRICS_DIR"], app.config["METRICS_FLUSH_INTERVAL"])
+create_metrics_endpoint(app)
+
+# Endpoint summary shared by / (JSON) and /api
+API_ENDPOINTS = {
+    "POST /download": "Queue a TikTok video download (optional max_height, max_bytes, codec, no_watermark, presets, timeout)",
+    "GET /jobs/<download_id>": "Get download status, progress and download_url",
+    "GET /progress/<download_id>": "Stream download progress as Server-Sent Events",
+    "POST /download/batch": "Download several videos in parallel (optionally as a ZIP)",
+    "POST /metadata": "Get video metadata",
+    "POST /metadata/bulk": "Get stored metadata for many video IDs in one request",
+    "GET /formats": "Get all available video formats and metadata (use ?url=<tiktok_url>)",
+    "GET /stream": "Stream a video straight from upstream (use ?url=<tiktok_url>&format_id=<id>)",
+    "GET /audio": "Get the audio track of a video (use ?url=<tiktok_url>)",
+    "GET /thumbnail": "Get the cover image of a video (use ?url=<tiktok_url>)",
+    "GET /videos/<video_id>": "Get known downloads and metadata for a video ID",
+    "GET /health": "Health check",
+}
+
+
+@app.route("/", methods=["GET"])
 def home():
     """Home page with web interface"""
     # Check if request wants JSON (API call)
-    if request.headers.get('Content-Type') == 'application/json' or request.args.get('format') == 'json':
-        return jsonify({
-            'message': 'TikTok Video Downloader API',
-            'version': '1.0',
-            'endpoints': {
-                'POST /download': 'Download TikTok video',
-                'POST /metadata': 'Get video metadata',
-                'GET /formats': 'Get all available video formats and metadata (use ?url=<tiktok_url>)',
-                'GET /health': 'Health check'
+    if (
+        request.headers.get("Content-Type") == "application/json"
+        or request.args.get("format") == "json"
+    ):
+        return jsonify(
+            {
+                "message": "TikTok Video Downloader API",
+                "version": "1.0",
+                "endpoints": API_ENDPOINTS,
             }
-        })
+        )
     # Otherwise serve the web interface
-    return render_template('index.html')
+    return render_template("index.html")
+
 
-@app.route('/api', methods=['GET'])
+@app.route("/api", methods=["GET"])
 def api_info():
     """API information endpoint"""
-    return jsonify({
-        'message': 'TikTok Video Downloader API',
-        'version': '1.0',
-        'endpoints': {
-            'POST /download': 'Download TikTok video',
-            'POST /metadata': 'Get video metadata',
-            'GET /formats': 'Get all available video formats and metadata (use ?url=<tiktok_url>)',
-            'GET /health': 'Health check'
+    return jsonify(
+        {
+            "message": "TikTok Video Downloader API",
+            "version": "1.0",
+            "endpoints": API_ENDPOINTS,
         }
-    })
+    )
 
-@app.route('/health', methods=['GET'])
+
+@app.route("/health", methods=["GET"])
 def health_check():
-    """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat()
-    })
+    """Health check endpoint, answered without loading yt-dlp"""
+    health_status = {"status": "healthy", "timestamp": datetime.now().isoformat()}
+
+    if request.args.get("detailed") == "true":
+        pool = ydl_pool.metrics()
+        health_status.update(
+            {
+                "system_metrics": PerformanceMonitor.get_system_metrics(),
+                "startup": STARTUP_METRICS,
+                "yt_dlp": {
+                    "loaded": bool(pool["yt_dlp_loaded"]),
+                    "import_seconds": pool["yt_dlp_import_seconds"],
+                    "import_rss_bytes": pool["yt_dlp_import_rss_bytes"],
+                    "warmup_seconds": pool["warmup_seconds"],
+                },
+                "jobs": job_queue.stats(),
+            }
+        )
+
+    return jsonify(health_status)
 
-@app.route('/download', methods=['POST'])
+
+def clean_video_filename(download_id, video_title, video_ext):
+    """Build the served filename for a download from the video title"""
+    # Remove special characters and limit length
+    clean_title = re.sub(r"[^\w\s-]", "", video_title or "")[:50]
+    clean_title = re.sub(r"\s+", "_", clean_title.strip())
+    if not clean_title:
+        clean_title = "tiktok_video"
+    return f"tiktok_{download_id}_{clean_title}.{video_ext}"
+
+
+def find_stored_video(store, cache_key, format_key):
+    """Look up a stored download without touching the network"""
+    entry = store.lookup(cache_key, format_key)
+    if entry is None:
+        # Short links only know their video ID once metadata has been extracted
+        info = cached_info(cache_key)
+        if info is not None and info.get("id") and str(info["id"]) != cache_key:
+            entry = store.lookup(str(info["id"]), format_key)
+    return entry
+
+
+def download_to_store(
+    store, video_url, download_dir, progress_hook, info=None, fmt=None
+):
+    """Download a video with yt-dlp and move it into the store.
+
+    Given the extracted info and one of its formats, that format is downloaded
+    straight from the info without extracting the video again.
+    """
+    format_key = fmt["format_id"] if fmt is not None else DEFAULT_FORMAT
+    # Download the video on a pooled yt-dlp instance pointed at this download's directory
+    params = {
+        "outtmpl": os.path.join(download_dir, "%(title)s.%(ext)s"),
+        "format": format_key,
+    }
+    with YTDLP_DOWNLOAD_SECONDS.time(), ydl_pool.checkout(
+        "download", params=params, progress_hooks=[progress_hook]
+    ) as ydl:
+        if info is None:
+            info = ydl.extract_info(video_url, download=True)
+        else:
+            try:
+                info = ydl.process_ie_result(
+                    ydl.sanitize_info(info, True), download=True
+                )
+            except (DeadlineExceeded, UpstreamUnavailable):
+                raise
+            except Exception as e:
+                # Format URLs expire; a fresh extraction gets new ones
+                logging.warning(
+                    f"Download from extracted info failed, extracting again: {e}"
+                )
+                info = ydl.extract_info(video_url, download=True)
+    video_title = info.get("title", "video")
+    video_ext = info.get("ext", "mp4")
+    video_path = os.path.join(download_dir, f"{video_title}.{video_ext}")
+
+    if not video_path or not os.path.exists(video_path):
+        raise RuntimeError("Failed to download video")
+
+    video_id = str(info.get("id") or video_key(video_url))
+    return store.add(
+        video_id,
+        info.get("format_id") or format_key,
+        video_path,
+        video_title,
+        aliases=[format_key],
+    )
+
+
+def postprocess_presets(entry, presets):
+    """Presets to run on a stored download: the server's and the client's, where they apply"""
+    if not app.config["POSTPROCESS_ENABLED"] or not postprocessor.available:
+        return []
+    return [
+        preset
+        for preset in dict.fromkeys([*app.config["POSTPROCESS_PRESETS"], *presets])
+        if preset != "faststart" or entry["ext"] in FASTSTART_EXTS
+    ]
+
+
+def postprocess_download(store, entry, download_id, download_dir, presets):
+    """Run post-processing presets on a stored download and link their outputs next to it.
+
+    Runs on the post-processor's threads once the download is done. Each
+    output is added to the job's 'variants' as it is ready, and taken off
+    'pending_variants' either way; a failed preset is only logged. Outputs
+    are stored under '<format>@<preset>', so every later download of the
+    same video and format reuses them.
+    """
+    variants = {}
+    for index, preset in enumerate(presets):
+        variant_key = f"{entry['format_id']}@{preset}"
+
+        def run(preset=preset, variant_key=variant_key):
+            stored = store.lookup(entry["video_id"], variant_key)
+            if stored is not None:
+                return stored
+            partial_dir = os.path.join(app.config["UPLOAD_FOLDER"], ".partial")
+            os.makedirs(partial_dir, exist_ok=True)
+            dest_path = os.path.join(
+                partial_dir, f"{uuid.uuid4().hex}.{output_ext(preset, entry['ext'])}"
+            )
+            if not postprocessor.process(store.blob_path(entry), dest_path, preset):
+                # Already in the preset's shape: the original serves as the output
+                store.alias(entry, entry["video_id"], variant_key)
+                return entry
+            return store.add(entry["video_id"], variant_key, dest_path, entry["title"])
+
+        try:
+            variant = store.lookup(entry["video_id"], variant_key) or single_flight.do(
+                f"postprocess:{entry['video_id']}:{variant_key}",
+                run,
+                shared_dir=os.path.join(app.config["UPLOAD_FOLDER"], ".locks"),
+            )
+            filename = clean_video_filename(
+                download_id, entry["title"], f"{preset}.{variant['ext']}"
+            )
+            store.link(variant, os.path.join(download_dir, filename))
+            if storage.remote:
+                storage.upload(
+                    f"{download_id}/{filename}", os.path.join(download_dir, filename)
+                )
+            variants[preset] = {
+                "filename": filename,
+                "file_size": variant["size"],
+                "download_url": f"/file/{download_id}/{filename}",
+            }
+        except Exception as e:
+            logging.warning(
+                f"Post-processing {preset} of download {download_id} failed: {e}"
+            )
+        job_queue.update_result(
+            download_id, variants=dict(variants), pending_variants=presets[index + 1 :]
+        )
+    return variants
+
+
+def run_download(
+    progress_hook,
+    download_id,
+    video_url,
+    upload_folder,
+    client="internal",
+    target=None,
+    presets=(),
+    deadline=None,
+):
+    """Download a video with yt-dlp and return the job result.
+
+    Past the deadline the transfer is cancelled from the progress hook. A
+    failed download leaves nothing behind in its directory.
+    """
+    deadline = deadline or Deadline(app.config["YT_DLP_TIMEOUT"])
+
+    def checked_hook(status):
+        # An exception raised in a yt-dlp progress hook aborts the transfer
+        deadline.check("Download")
+        progress_hook(status)
+
+    try:
+        return fetch_download(
+            progress_hook,
+            checked_hook,
+            download_id,
+            video_url,
+            upload_folder,
+            client,
+            target,
+            presets,
+            deadline,
+        )
+    except Exception:
+        # Drops .part files of a cancelled or failed transfer along with the directory
+        shutil.rmtree(os.path.join(upload_folder, download_id), ignore_errors=True)
+        raise
+
+
+def fetch_download(
+    progress_hook,
+    checked_hook,
+    download_id,
+    video_url,
+    upload_folder,
+    client,
+    target,
+    presets,
+    deadline,
+):
+    """The download itself: reuse a stored copy, join an in-flight download or run one"""
+    download_dir = os.path.join(upload_folder, download_id)
+    os.makedirs(download_dir, exist_ok=True)
+    store = VideoStore.for_folder(upload_folder)
+    cache_key, canonical_url = canonicalizer.resolve(video_url)
+    downloaded = []
+    info = fmt = None
+    format_key = DEFAULT_FORMAT
+    if target is not None:
+        # Pick the format from the (usually cached) format list
+        info = extract_video_info(
+            video_url,
+            freshness=app.config["METADATA_CACHE_TTL"],
+            client=client,
+            deadline=deadline,
+        )
+        fmt = select_format(info.get("formats") or [], target, info.get("duration"))
+        if fmt is None:
+            raise RuntimeError("No format matches the requested target")
+        format_key = fmt["format_id"]
+        cache_key = str(info.get("id") or cache_key)
+
+    def fetch():
+        # A concurrent request may have stored the video while we waited
+        stored = find_stored_video(store, cache_key, format_key)
+        if stored is not None:
+            return stored
+        downloaded.append(True)
+
+        def attempt():
+            # Queued jobs wait their turn for an upstream slot, for as long as their deadline allows
+            with admission.slot(client, deadline.remaining()):
+                deadline.check("Download")
+                return download_to_store(
+                    store, canonical_url, download_dir, checked_hook, info, fmt
+                )
+
+        return upstream_guard.call("download", attempt, deadline)
+
+    # Reuse a file already on disk for the same video and format, otherwise
+    # join any in-flight download of it, or run the download ourselves
+    entry = find_stored_video(store, cache_key, format_key)
+    if entry is None:
+        flight_key = f"download:{cache_key}:{format_key}"
+        entry = single_flight.do(
+            flight_key,
+            fetch,
+            shared_dir=os.path.join(upload_folder, ".locks"),
+            timeout=deadline.remaining(),
+        )
+    if entry["video_id"] != cache_key:
+        canonicalizer.remember(video_url, entry["video_id"])
+    VideoIndex.for_folder(
+        upload_folder, app.config["VIDEO_INDEX_SIZE"]
+    ).record_download(entry["video_id"], download_id)
+
+    # Link the stored file into this download's directory under a clean filename
+    new_video_name = clean_video_filename(download_id, entry["title"], entry["ext"])
+    store.link(entry, os.path.join(download_dir, new_video_name))
+    if storage.remote:
+        # Copy the file to shared storage so a /file request on any instance can serve it
+        try:
+            storage.upload(
+                f"{download_id}/{new_video_name}",
+                os.path.join(download_dir, new_video_name),
+            )
+        except Exception as e:
+            logging.warning(
+                f"Upload of {download_id}/{new_video_name} to storage failed: {e}"
+            )
+    presets = postprocess_presets(entry, presets)
+    if presets:
+        # ffmpeg runs after the job has finished, so it never holds a download worker
+        postprocessor.submit(
+            postprocess_download, store, entry, download_id, download_dir, presets
+        )
+    progress_hook(
+        {
+            "status": "finished",
+            "downloaded_bytes": entry["size"],
+            "total_bytes": entry["size"],
+        }
+    )
+
+    return {
+        "filename": new_video_name,
+        "file_size": entry["size"],
+        "format_id": entry["format_id"],
+        "download_url": f"/file/{download_id}/{new_video_name}",
+        "variants": {},
+        "pending_variants": presets,
+        "cached": not downloaded,
+    }
+
+
+@app.route("/download", methods=["POST"])
 def download_video():
-    """Download TikTok video endpoint"""
+    """Queue a TikTok video download and return its job ID"""
     try:
         # Get JSON data from request
-        data = request.get_json()
-        
-        if not data or 'url' not in data:
-            return jsonify({
-                'error': 'Missing required parameter: url'
-            }), 400
-        
-        video_url = data['url']
-        
+        data = request.get_json(silent=True)
+
+        if not data or "url" not in data:
+            return jsonify({"error": "Missing required parameter: url"}), 400
+
+        video_url = data["url"]
+
         # Validate URL
         if not video_url or not isinstance(video_url, str):
-            return jsonify({
-                'error': 'Invalid URL provided'
-            }), 400
-        
-        # Create unique directory for this download
+            return jsonify({"error": "Invalid URL provided"}), 400
+
+        # Optional max_height, max_bytes, codec and no_watermark pick a specific format
+        try:
+            target = FormatTarget.from_request(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Optional shorter deadline for the whole download, in seconds
+        try:
+            deadline = request_deadline(app.config["YT_DLP_TIMEOUT"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Optional transcode presets on top of the configured ones
+        presets = data.get("presets") or []
+        if not isinstance(presets, list) or any(
+            not isinstance(preset, str) or preset not in PRESETS for preset in presets
+        ):
+            return (
+                jsonify(
+                    {
+                        "error": f"Invalid presets provided, expected a list of: {', '.join(PRESETS)}"
+                    }
+                ),
+                400,
+            )
+
+        # Each download gets its own directory, created by the worker
         download_id = str(uuid.uuid4())
-        download_dir = os.path.join(app.config['UPLOAD_FOLDER'], download_id)
-        os.makedirs(download_dir, exist_ok=True)
-        
-        # Configure yt-dlp options with headers and user agent to avoid 403 errors
-        ydl_opts = {
-            'outtmpl': os.path.join(download_dir, '%(title)s.%(ext)s'),
-            'format': 'best/mp4/any',  # Try best quality, fallback to mp4, then any available format
-            'noplaylist': True,
-            'extract_flat': False,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Referer': 'https://www.tiktok.com/',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            },
-            'extractor_retries': 3,
-            'fragment_retries': 3,
-            'retry_sleep_functions': {'http': lambda n: min(4 ** n, 60)},
-        }
-        
-        # Download the video using yt-dlp
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            video_title = info.get('title', 'video')
-            video_ext = info.get('ext', 'mp4')
-            video_path = os.path.join(download_dir, f"{video_title}.{video_ext}")
-        
-        if not video_path or not os.path.exists(video_path):
-            return jsonify({
-                'error': 'Failed to download video'
-            }), 500
-        
-        # Create a clean filename
-        import re
-        # Remove special characters and limit length
-        clean_title = re.sub(r'[^\w\s-]', '', video_title)[:50]
-        clean_title = re.sub(r'\s+', '_', clean_title.strip())
-        if not clean_title:
-            clean_title = 'tiktok_video'
-        
-        # Rename the downloaded video with clean filename
-        new_video_name = f"tiktok_{download_id}_{clean_title}.{video_ext}"
-        new_video_path = os.path.join(download_dir, new_video_name)
-        os.rename(video_path, new_video_path)
-        
-        # Get file size
-        file_size = os.path.getsize(new_video_path)
-        
-        return jsonify({
-            'success': True,
-            'message': 'Video downloaded successfully',
-            'download_id': download_id,
-            'filename': new_video_name,
-            'file_size': file_size,
-            'download_url': f'/file/{download_id}/{new_video_name}'
-        })
-        
+
+        try:
+            client = client_id()
+            job_queue.submit(
+                download_id,
+                run_download,
+                download_id,
+                video_url,
+                app.config["UPLOAD_FOLDER"],
+                client,
+                target,
+                presets,
+                deadline,
+                owner=client,
+            )
+        except OwnerLimitError as e:
+            return (
+                jsonify({"error": str(e)}),
+                429,
+                {"Retry-After": str(app.config["RETRY_AFTER"])},
+            )
+        except QueueFullError as e:
+            return (
+                jsonify({"error": str(e)}),
+                503,
+                {"Retry-After": str(app.config["RETRY_AFTER"])},
+            )
+
+        return (
+            jsonify(
+                {
+                    "success": True,
+                    "message": "Video download queued",
+                    "download_id": download_id,
+                    "status": "queued",
+                    "status_url": f"/jobs/{download_id}",
+                    "progress_url": f"/progress/{download_id}",
+                }
+            ),
+            202,
+        )
+
     except Exception as e:
-        return jsonify({
-            'error': f'Download failed: {str(e)}'
-        }), 500
+        return jsonify({"error": f"Download failed: {str(e)}"}), 500
+
+
+@app.route("/jobs/<download_id>", methods=["GET"])
+def get_job_status(download_id):
+    """Get status, progress and result of a queued download"""
+    job = job_queue.get(download_id)
+
+    if job is None:
+        return jsonify({"error": "Download ID not found"}), 404
+
+    return jsonify(job_response(job))
+
+
+def job_response(job):
+    """Public view of a job, shared by /jobs and /progress"""
+    response = {
+        "download_id": job["download_id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+    if job["status"] == "finished":
+        response.update(job["result"])
+    elif job["status"] == "failed":
+        response["error"] = job["error"]
+
+    return response
+
+
+def progress_event(version, job):
+    """Format a job snapshot as one Server-Sent Event"""
+    return f"id: {version}\nevent: {job['status']}\ndata: {json.dumps(job_response(job))}\n\n"
+
+
+def refresh_shared_job(download_id):
+    """Publish a job run by another worker if its shared state changed; True when it did"""
+    latest = progress_broker.latest(download_id)
+    job = job_queue.get(download_id)
+    if job is None or (latest is not None and latest[1] == job):
+        return False
+    progress_broker.publish(download_id, job)
+    return True
+
+
+@app.route("/progress/<download_id>", methods=["GET"])
+def stream_progress(download_id):
+    """Stream a download's progress and state changes as Server-Sent Events"""
+    job = job_queue.get(download_id)
+
+    if job is None:
+        return jsonify({"error": "Download ID not found"}), 404
+
+    # Each open stream holds a server thread; clients turned away poll status_url instead
+    if not progress_broker.open_stream():
+        return (
+            jsonify(
+                {
+                    "error": "Too many open progress streams, poll status_url instead",
+                    "status_url": f"/jobs/{download_id}",
+                }
+            ),
+            503,
+            {"Retry-After": "5"},
+        )
+
+    if progress_broker.latest(download_id) is None:
+        progress_broker.publish(download_id, job)
+    keepalive = app.config["PROGRESS_KEEPALIVE"]
+    # Jobs of other workers only change in the shared state, so poll it
+    shared = not job_queue.is_local(download_id)
+    timeout = min(keepalive, app.config["JOB_STATE_INTERVAL"]) if shared else keepalive
+    expires = time.monotonic() + app.config["PROGRESS_MAX_DURATION"]
+
+    def events():
+        version = 0
+        idle = 0
+        while True:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                # Hand the thread back; the client follows the rest of the job by polling
+                yield f"event: poll\ndata: {json.dumps({'status_url': f'/jobs/{download_id}'})}\n\n"
+                return
+            update = progress_broker.wait(
+                download_id, version, timeout=min(timeout, remaining)
+            )
+            if update is None and shared and refresh_shared_job(download_id):
+                continue
+            if update is None:
+                if progress_broker.latest(download_id) is None:
+                    return
+                idle += min(timeout, remaining)
+                if idle < keepalive:
+                    continue
+                idle = 0
+                # Comment lines keep proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            version, snapshot = update
+            yield progress_event(version, snapshot)
+            if snapshot["status"] in FINAL_STATES:
+                return
+
+    response = Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(progress_broker.close_stream)
+    return response
+
+
+def cached_info(cache_key, freshness=None):
+    """Info from the in-memory cache, if it was extracted within freshness seconds"""
+    entry = metadata_cache.get(cache_key)
+    if entry is None or (
+        freshness is not None and entry["extracted_at"] < time.time() - freshness
+    ):
+        return None
+    return entry["info"]
+
+
+def cache_info(cache_key, info, extracted_at):
+    """Keep info in memory until METADATA_CACHE_TTL after it was extracted"""
+    ttl = app.config["METADATA_CACHE_TTL"] - (time.time() - extracted_at)
+    if ttl > 0:
+        metadata_cache.set(cache_key, {"info": info, "extracted_at": extracted_at}, ttl)
+
+
+def extract_video_info(video_url, freshness=None, client=None, deadline=None):
+    """Extract video info with yt-dlp, reusing cached results for the same video.
+
+    freshness bounds the age of a cached result, for callers that need its
+    signed CDN URLs to still work.
+    """
+    cache_key, canonical_url = canonicalizer.resolve(video_url)
+    info = cached_info(cache_key, freshness)
+    if info is not None:
+        return info
+
+    # Info extracted by an earlier worker or before a restart, cached only for what is left of its TTL
+    entry = get_metadata_store().get_entry(cache_key, freshness)
+    if entry is not None:
+        cache_info(cache_key, entry["info"], entry["extracted_at"])
+        return entry["info"]
+
+    client = client or client_id()
+    upload_folder = app.config["UPLOAD_FOLDER"]
+    deadline = deadline or Deadline(app.config["YT_DLP_EXTRACT_TIMEOUT"])
+
+    def extract():
+        info = run_extraction(canonical_url, client, deadline)
+        extracted_at = time.time()
+        cache_info(cache_key, info, extracted_at)
+        if info.get("id"):
+            video_id = str(info["id"])
+            # Unresolved links map to the real ID from now on, so later variants hit too
+            if video_id != cache_key:
+                cache_info(video_id, info, extracted_at)
+                canonicalizer.remember(video_url, video_id)
+            get_video_index().record_metadata(video_id, info)
+            get_metadata_store().put(video_id, info)
+        return info
+
+    # Concurrent lookups of the same video share a single extraction. They join it on
+    # their own thread, so only the leader's run takes a pool thread, and each stops
+    # waiting at its own deadline. yt-dlp cannot be interrupted mid-extraction; one
+    # that overruns finishes in the background, bounded by its socket timeout, and
+    # still fills the caches
+    return single_flight.do(
+        f"info:{cache_key}",
+        lambda: call_with_deadline(extract, deadline, "Extraction"),
+        shared_dir=os.path.join(upload_folder, ".locks"),
+        timeout=deadline.remaining(),
+    )
+
+
+def admission_timeout(deadline=None):
+    """Seconds to queue for an upstream slot: the configured limit, or less when the deadline is nearer"""
+    timeout = app.config["ADMISSION_QUEUE_TIMEOUT"]
+    return timeout if deadline is None else min(timeout, deadline.remaining())
+
+
+def run_extraction(video_url, client="internal", deadline=None):
+    """Run yt-dlp metadata extraction without downloading"""
+
+    def attempt():
+        with admission.slot(
+            client, admission_timeout(deadline)
+        ), YTDLP_EXTRACTION_SECONDS.time(), ydl_pool.checkout("metadata") as ydl:
+            return ydl.extract_info(video_url, download=False)
 
-@app.route('/metadata', methods=['POST'])
+    # Backoff between attempts is spent outside the admission slot
+    return upstream_guard.call("extraction", attempt, deadline)
+
+
+def run_batch_item(video_url, upload_folder, client, deadline):
+    """Download one URL of a batch, returning its result instead of raising"""
+    download_id = str(uuid.uuid4())
+    try:
+        result = run_download(
+            lambda status: None,
+            download_id,
+            video_url,
+            upload_folder,
+            client,
+            deadline=deadline,
+        )
+        return {"success": True, "download_id": download_id, **result}
+    except Exception as e:
+        return {"success": False, "error": f"Download failed: {str(e)}"}
+
+
+@app.route("/download/batch", methods=["POST"])
+def download_batch():
+    """Download several TikTok videos in parallel"""
+    try:
+        data = request.get_json(silent=True)
+        urls = data.get("urls") if isinstance(data, dict) else None
+
+        if not urls or not isinstance(urls, list):
+            return jsonify({"error": "Missing required parameter: urls"}), 400
+
+        if len(urls) > app.config["BATCH_MAX_URLS"]:
+            return (
+                jsonify(
+                    {
+                        "error": f"Too many URLs, at most {app.config['BATCH_MAX_URLS']} per batch"
+                    }
+                ),
+                400,
+            )
+
+        parallelism = data.get("parallelism", app.config["BATCH_PARALLELISM"])
+        if not isinstance(parallelism, int) or parallelism < 1:
+            return jsonify({"error": "Invalid parallelism provided"}), 400
+        # One deadline covers the whole batch
+        try:
+            deadline = request_deadline(app.config["YT_DLP_TIMEOUT"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        # More threads than the client's upstream slots would only queue
+        parallelism = min(
+            parallelism,
+            app.config["BATCH_MAX_PARALLELISM"],
+            app.config["CLIENT_MAX_CONCURRENCY"],
+        )
+
+        # Each video is downloaded once no matter how many URL variants point at it
+        unique_urls = {}
+        for video_url in urls:
+            if video_url and isinstance(video_url, str):
+                unique_urls.setdefault(video_key(video_url), video_url)
+
+        outcomes = {}
+        if unique_urls:
+            upload_folder = app.config["UPLOAD_FOLDER"]
+            client = client_id()
+            with ThreadPoolExecutor(
+                max_workers=min(parallelism, len(unique_urls))
+            ) as pool:
+                futures = {
+                    key: pool.submit(
+                        run_batch_item, video_url, upload_folder, client, deadline
+                    )
+                    for key, video_url in unique_urls.items()
+                }
+                outcomes = {key: future.result() for key, future in futures.items()}
+
+        results = []
+        for video_url in urls:
+            if not video_url or not isinstance(video_url, str):
+                results.append(
+                    {
+                        "url": video_url,
+                        "success": False,
+                        "error": "Invalid URL provided",
+                    }
+                )
+            else:
+                results.append({"url": video_url, **outcomes[video_key(video_url)]})
+
+        if data.get("zip") or request.args.get("zip") == "true":
+            return batch_zip_response(results)
+
+        return jsonify(
+            {
+                "success": True,
+                "total": len(results),
+                "succeeded": sum(1 for result in results if result["success"]),
+                "results": results,
+            }
+        )
+
+    except Exception as e:
+        return jsonify({"error": f"Batch download failed: {str(e)}"}), 500
+
+
+def batch_zip_response(results):
+    """Stream the successful downloads of a batch as one ZIP archive"""
+    members = {}
+    for result in results:
+        if result["success"] and result["download_id"] not in members:
+            path = os.path.join(
+                app.config["UPLOAD_FOLDER"], result["download_id"], result["filename"]
+            )
+            members[result["download_id"]] = (path, result["filename"])
+
+    # Hold the files until the archive has been sent
+    for download_id in members:
+        janitor.acquire(download_id)
+
+    def release_all():
+        for download_id in members:
+            janitor.release(download_id)
+
+    body = stream_zip(
+        members.values(),
+        extra=[("results.json", json.dumps(results, indent=2))],
+        chunk_size=app.config["STREAM_CHUNK_SIZE"],
+    )
+    response = Response(
+        body,
+        content_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="tiktok_batch_{uuid.uuid4().hex[:8]}.zip"'
+        },
+    )
+    response.call_on_close(release_all)
+    return response
+
+
+@app.route("/metadata", methods=["POST"])
 def get_metadata():
     """Get TikTok video metadata endpoint"""
     try:
         # Get JSON data from request
         data = request.get_json()
-        
-        if not data or 'url' not in data:
-            return jsonify({
-                'error': 'Missing required parameter: url'
-            }), 400
-        
-        video_url = data['url']
-        
+
+        if not data or "url" not in data:
+            return jsonify({"error": "Missing required parameter: url"}), 400
+
+        video_url = data["url"]
+
         # Validate URL
         if not video_url or not isinstance(video_url, str):
-            return jsonify({
-                'error': 'Invalid URL provided'
-            }), 400
-        
-        # Get video metadata using yt-dlp with headers to avoid 403 errors
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Referer': 'https://www.tiktok.com/',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            },
-            'extractor_retries': 3,
-            'fragment_retries': 3,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            metadata = {
-                'title': info.get('title', 'N/A'),
-                'uploader': info.get('uploader', 'N/A'),
-                'duration': info.get('duration', 'N/A'),
-                'view_count': info.get('view_count', 'N/A'),
-                'like_count': info.get('like_count', 'N/A'),
-                'description': info.get('description', 'N/A'),
-                'upload_date': info.get('upload_date', 'N/A'),
-                'webpage_url': info.get('webpage_url', video_url)
+            return jsonify({"error": "Invalid URL provided"}), 400
+
+        try:
+            deadline = request_deadline(app.config["YT_DLP_EXTRACT_TIMEOUT"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Get video metadata, served from the cache for repeat lookups
+        info = extract_video_info(video_url, deadline=deadline)
+
+        return jsonify(
+            {"success": True, "metadata": summarize_metadata(info, video_url)}
+        )
+
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except DeadlineExceeded as e:
+        return timeout_error(e)
+    except Exception as e:
+        return jsonify({"error": f"Failed to get metadata: {str(e)}"}), 500
+
+
+def summarize_metadata(info, video_url):
+    """Metadata fields returned by /metadata"""
+    return {
+        "title": info.get("title", "N/A"),
+        "uploader": info.get("uploader", "N/A"),
+        "duration": info.get("duration", "N/A"),
+        "view_count": info.get("view_count", "N/A"),
+        "like_count": info.get("like_count", "N/A"),
+        "description": info.get("description", "N/A"),
+        "upload_date": info.get("upload_date", "N/A"),
+        "webpage_url": info.get("webpage_url", video_url),
+    }
+
+
+@app.route("/metadata/bulk", methods=["POST"])
+def get_metadata_bulk():
+    """Get stored metadata for many videos without contacting TikTok"""
+    try:
+        data = request.get_json(silent=True)
+        ids = data.get("ids") if isinstance(data, dict) else None
+
+        if not ids or not isinstance(ids, list):
+            return jsonify({"error": "Missing required parameter: ids"}), 400
+
+        if len(ids) > app.config["METADATA_BULK_MAX_IDS"]:
+            return (
+                jsonify(
+                    {
+                        "error": f"Too many IDs, at most {app.config['METADATA_BULK_MAX_IDS']} per request"
+                    }
+                ),
+                400,
+            )
+
+        max_age = data.get("max_age")
+        if max_age is not None and (
+            isinstance(max_age, bool)
+            or not isinstance(max_age, (int, float))
+            or max_age < 0
+        ):
+            return jsonify({"error": "Invalid max_age provided"}), 400
+
+        # Video URLs are accepted too and mapped to their IDs without any network call
+        keys = {}
+        for item in ids:
+            if item and isinstance(item, (str, int)):
+                keys[str(item)] = video_key(str(item))
+
+        stored = get_metadata_store().get_many(set(keys.values()), max_age)
+        results = {}
+        for item, key in keys.items():
+            if key in stored and stored[key]["info"] is not None:
+                info = stored[key]["info"]
+                results[item] = {
+                    "video_id": key,
+                    "extracted_at": datetime.fromtimestamp(
+                        stored[key]["extracted_at"], timezone.utc
+                    ).isoformat(),
+                    "metadata": summarize_metadata(info, info.get("webpage_url")),
+                }
+
+        return jsonify(
+            {
+                "success": True,
+                "found": len(results),
+                "missing": [item for item in keys if item not in results],
+                "results": results,
             }
-        
-        return jsonify({
-            'success': True,
-            'metadata': metadata
-        })
-        
+        )
+
     except Exception as e:
-        return jsonify({
-            'error': f'Failed to get metadata: {str(e)}'
-        }), 500
+        return jsonify({"error": f"Failed to get metadata: {str(e)}"}), 500
 
-@app.route('/formats', methods=['GET'])
+
+@app.route("/formats", methods=["GET"])
 def get_video_formats():
     """Get all available video formats and metadata for a TikTok video"""
     try:
         # Get URL from query parameter
-        video_url = request.args.get('url')
-        
+        video_url = request.args.get("url")
+
         if not video_url:
-            return jsonify({
-                'error': 'Missing required parameter: url'
-            }), 400
-        
+            return jsonify({"error": "Missing required parameter: url"}), 400
+
         # Validate URL
         if not isinstance(video_url, str):
-            return jsonify({
-                'error': 'Invalid URL provided'
-            }), 400
-        
-        # Get video information and formats using yt-dlp with headers to avoid 403 errors
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'listformats': True,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Referer': 'https://www.tiktok.com/',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            },
-            'extractor_retries': 3,
-            'fragment_retries': 3,
+            return jsonify({"error": "Invalid URL provided"}), 400
+
+        # Opt-in smaller responses: compact=true drops null fields (and the long
+        # signed url unless it is asked for), fields= picks the format fields and
+        # layout=columns sends one array per field instead of one object per format
+        compact = request.args.get("compact") == "true"
+        layout = request.args.get("layout", "rows")
+        if layout not in ("rows", "columns"):
+            return (
+                jsonify({"error": "Invalid layout provided, expected rows or columns"}),
+                400,
+            )
+        default_fields = FORMAT_FIELDS
+        if compact or layout == "columns":
+            default_fields = [field for field in FORMAT_FIELDS if field != "url"]
+        try:
+            fields = parse_fields(request.args.get("fields"), default_fields)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        try:
+            deadline = request_deadline(app.config["YT_DLP_EXTRACT_TIMEOUT"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Format URLs expire, so only trust stored info as recent as the in-memory cache
+        info = extract_video_info(
+            video_url, freshness=app.config["METADATA_CACHE_TTL"], deadline=deadline
+        )
+
+        # Extract comprehensive metadata
+        metadata = {
+            "title": info.get("title", "N/A"),
+            "uploader": info.get("uploader", "N/A"),
+            "uploader_id": info.get("uploader_id", "N/A"),
+            "duration": info.get("duration", "N/A"),
+            "view_count": info.get("view_count", "N/A"),
+            "like_count": info.get("like_count", "N/A"),
+            "comment_count": info.get("comment_count", "N/A"),
+            "description": info.get("description", "N/A"),
+            "upload_date": info.get("upload_date", "N/A"),
+            "webpage_url": info.get("webpage_url", video_url),
+            "thumbnail": info.get("thumbnail", "N/A"),
+            "width": info.get("width", "N/A"),
+            "height": info.get("height", "N/A"),
+            "fps": info.get("fps", "N/A"),
+            "filesize": info.get("filesize", "N/A"),
+            "ext": info.get("ext", "N/A"),
         }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            
-            # Extract comprehensive metadata
+
+        # Extract available formats
+        raw_formats = info.get("formats") or []
+        if layout == "columns":
+            formats = format_columns(raw_formats, fields)
+        else:
+            formats = format_rows(raw_formats, fields, compact)
+
+        # Get the best format info
+        best_format = None
+        if "format" in info:
+            best_format = {
+                "format_id": info.get("format_id", "N/A"),
+                "ext": info.get("ext", "N/A"),
+                "width": info.get("width", "N/A"),
+                "height": info.get("height", "N/A"),
+                "fps": info.get("fps", "N/A"),
+                "filesize": info.get("filesize", "N/A"),
+            }
+
+        if compact:
             metadata = {
-                'title': info.get('title', 'N/A'),
-                'uploader': info.get('uploader', 'N/A'),
-                'uploader_id': info.get('uploader_id', 'N/A'),
-                'duration': info.get('duration', 'N/A'),
-                'view_count': info.get('view_count', 'N/A'),
-                'like_count': info.get('like_count', 'N/A'),
-                'comment_count': info.get('comment_count', 'N/A'),
-                'description': info.get('description', 'N/A'),
-                'upload_date': info.get('upload_date', 'N/A'),
-                'webpage_url': info.get('webpage_url', video_url),
-                'thumbnail': info.get('thumbnail', 'N/A'),
-                'width': info.get('width', 'N/A'),
-                'height': info.get('height', 'N/A'),
-                'fps': info.get('fps', 'N/A'),
-                'filesize': info.get('filesize', 'N/A'),
-                'ext': info.get('ext', 'N/A')
+                key: value
+                for key, value in metadata.items()
+                if value not in ("N/A", None)
             }
-            
-            # Extract available formats
-            formats = []
-            if 'formats' in info and info['formats']:
-                for fmt in info['formats']:
-                    format_info = {
-                        'format_id': fmt.get('format_id', 'N/A'),
-                        'ext': fmt.get('ext', 'N/A'),
-                        'width': fmt.get('width', 'N/A'),
-                        'height': fmt.get('height', 'N/A'),
-                        'fps': fmt.get('fps', 'N/A'),
-                        'filesize': fmt.get('filesize', 'N/A'),
-                        'tbr': fmt.get('tbr', 'N/A'),  # Total bitrate
-                        'vbr': fmt.get('vbr', 'N/A'),  # Video bitrate
-                        'abr': fmt.get('abr', 'N/A'),  # Audio bitrate
-                        'acodec': fmt.get('acodec', 'N/A'),
-                        'vcodec': fmt.get('vcodec', 'N/A'),
-                        'format_note': fmt.get('format_note', 'N/A'),
-                        'quality': fmt.get('quality', 'N/A'),
-                        'url': fmt.get('url', 'N/A')
-                    }
-                    formats.append(format_info)
-            
-            # Get the best format info
-            best_format = None
-            if 'format' in info:
+            if best_format is not None:
                 best_format = {
-                    'format_id': info.get('format_id', 'N/A'),
-                    'ext': info.get('ext', 'N/A'),
-                    'width': info.get('width', 'N/A'),
-                    'height': info.get('height', 'N/A'),
-                    'fps': info.get('fps', 'N/A'),
-                    'filesize': info.get('filesize', 'N/A')
+                    key: value
+                    for key, value in best_format.items()
+                    if value not in ("N/A", None)
                 }
-        
-        return jsonify({
-            'success': True,
-            'metadata': metadata,
-            'formats': formats,
-            'best_format': best_format,
-            'total_formats': len(formats)
-        })
-        
+
+        return jsonify(
+            {
+                "success": True,
+                "metadata": metadata,
+                "formats": formats,
+                "best_format": best_format,
+                "total_formats": len(raw_formats),
+            }
+        )
+
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except DeadlineExceeded as e:
+        return timeout_error(e)
     except Exception as e:
-        return jsonify({
-            'error': f'Failed to get video formats: {str(e)}'
-        }), 500
+        return jsonify({"error": f"Failed to get video formats: {str(e)}"}), 500
 
-@app.route('/file/<download_id>/<filename>', methods=['GET'])
+
+def select_stream_format(info, format_id=None):
+    """Pick the format to stream, defaulting to the one yt-dlp selected as best"""
+    formats = info.get("formats") or []
+    if format_id:
+        for fmt in formats:
+            if fmt.get("format_id") == format_id:
+                return fmt
+        return None
+    if info.get("url"):
+        return info
+    # yt-dlp orders formats from worst to best
+    for fmt in reversed(formats):
+        if fmt.get("url") and fmt.get("vcodec") != "none":
+            return fmt
+    return None
+
+
+def upstream_headers(info, fmt):
+    """Headers and cookies yt-dlp negotiated for fetching a format from the CDN"""
+    headers = dict(fmt.get("http_headers") or info.get("http_headers") or {})
+    if fmt.get("cookies"):
+        headers["Cookie"] = fmt["cookies"]
+    return headers
+
+
+@app.route("/stream", methods=["GET"])
+def stream_video():
+    """Stream a video format from upstream to the client without saving it"""
+    try:
+        video_url = request.args.get("url")
+
+        if not video_url:
+            return jsonify({"error": "Missing required parameter: url"}), 400
+
+        try:
+            deadline = request_deadline(app.config["YT_DLP_EXTRACT_TIMEOUT"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Format URLs expire, so only trust stored info as recent as the in-memory cache
+        info = extract_video_info(
+            video_url, freshness=app.config["METADATA_CACHE_TTL"], deadline=deadline
+        )
+        fmt = select_stream_format(info, request.args.get("format_id"))
+
+        if fmt is None or not fmt.get("url"):
+            return jsonify({"error": "Requested format not available"}), 404
+
+        headers = upstream_headers(info, fmt)
+        if request.headers.get("Range"):
+            headers["Range"] = request.headers["Range"]
+        # Ask for the raw bytes so upstream Content-Length stays accurate
+        headers["Accept-Encoding"] = "identity"
+
+        # CDN fetches bypass upstream_guard: a 403 here is an expired signed URL, not TikTok throttling
+        cdn_response = upstream_session.get(
+            fmt["url"],
+            headers=headers,
+            stream=True,
+            timeout=app.config["STREAM_CONNECT_TIMEOUT"],
+        )
+
+        if cdn_response.status_code >= 400:
+            cdn_response.close()
+            return jsonify(
+                {"error": f"Upstream returned HTTP {cdn_response.status_code}"}
+            ), (416 if cdn_response.status_code == 416 else 502)
+
+        # Pass through the headers that describe the byte range being sent
+        filename = clean_video_filename(
+            info.get("id", "stream"), info.get("title"), fmt.get("ext", "mp4")
+        )
+        response_headers = {
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Accept-Ranges": cdn_response.headers.get("Accept-Ranges", "bytes"),
+        }
+        for header in ("Content-Length", "Content-Range", "Last-Modified", "ETag"):
+            if cdn_response.headers.get(header):
+                response_headers[header] = cdn_response.headers[header]
+
+        # Only one chunk is held in memory at a time
+        body = cdn_response.iter_content(chunk_size=app.config["STREAM_CHUNK_SIZE"])
+        response = Response(
+            body,
+            status=cdn_response.status_code,
+            headers=response_headers,
+            content_type=cdn_response.headers.get("Content-Type", "video/mp4"),
+            direct_passthrough=True,
+        )
+        response.call_on_close(cdn_response.close)
+        return response
+
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except DeadlineExceeded as e:
+        return timeout_error(e)
+    except Exception as e:
+        return jsonify({"error": f"Streaming failed: {str(e)}"}), 500
+
+
+def fetch_asset_to_store(store, video_id, kind, info, source, client, deadline):
+    """Fetch an audio track or thumbnail with one HTTP request and move it into the store"""
+    partial_dir = os.path.join(app.config["UPLOAD_FOLDER"], ".partial")
+    os.makedirs(partial_dir, exist_ok=True)
+    headers = upstream_headers(info, source)
+    headers["Accept-Encoding"] = "identity"
+    path = None
+    try:
+        with admission.slot(client, admission_timeout(deadline)):
+            cdn_response = upstream_session.get(
+                source["url"],
+                headers=headers,
+                stream=True,
+                timeout=app.config["STREAM_CONNECT_TIMEOUT"],
+            )
+            try:
+                cdn_response.raise_for_status()
+                content_type = cdn_response.headers.get("Content-Type", "").split(";")[
+                    0
+                ]
+                ext = source.get("ext") or (
+                    mimetypes.guess_extension(content_type) or ".jpg"
+                ).lstrip(".")
+                path = os.path.join(partial_dir, f"{uuid.uuid4().hex}.{ext}")
+                with open(path, "wb") as f:
+                    for chunk in cdn_response.iter_content(
+                        chunk_size=app.config["STREAM_CHUNK_SIZE"]
+                    ):
+                        deadline.check(kind.capitalize())
+                        f.write(chunk)
+            finally:
+                cdn_response.close()
+        return store.add(
+            video_id,
+            source.get("format_id") or kind,
+            path,
+            info.get("title") or kind,
+            aliases=[kind],
+        )
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def serve_asset(kind):
+    """Shared /audio and /thumbnail handler: serve from the store, fetching on a miss"""
+    try:
+        video_url = request.args.get("url")
+
+        if not video_url:
+            return jsonify({"error": "Missing required parameter: url"}), 400
+
+        try:
+            deadline = request_deadline(app.config["YT_DLP_EXTRACT_TIMEOUT"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        store = VideoStore.for_folder(app.config["UPLOAD_FOLDER"])
+        cache_key, _ = canonicalizer.resolve(video_url)
+        entry = find_stored_video(store, cache_key, kind)
+        cached = entry is not None
+
+        if entry is None:
+            # CDN URLs expire, so only trust stored info as recent as the in-memory cache
+            info = extract_video_info(
+                video_url, freshness=app.config["METADATA_CACHE_TTL"], deadline=deadline
+            )
+            if kind == "audio":
+                source = select_audio_format(
+                    info.get("formats") or [], info.get("duration")
+                )
+            else:
+                source = select_thumbnail(info)
+            if source is None:
+                return jsonify({"error": f"No {kind} available for this video"}), 404
+
+            video_id = str(info.get("id") or cache_key)
+            client = client_id()
+            # Concurrent requests for the same asset share one fetch
+            entry = single_flight.do(
+                f"{kind}:{video_id}",
+                lambda: store.lookup(video_id, kind)
+                or fetch_asset_to_store(
+                    store, video_id, kind, info, source, client, deadline
+                ),
+                shared_dir=os.path.join(app.config["UPLOAD_FOLDER"], ".locks"),
+                timeout=deadline.remaining(),
+            )
+
+        path = store.blob_path(entry)
+        response = send_file(
+            path,
+            as_attachment=kind == "audio",
+            download_name=clean_video_filename(
+                entry["video_id"], entry["title"], entry["ext"]
+            ),
+            etag=entry.get("sha256") or file_etag(path),
+            conditional=True,
+            max_age=app.config["FILE_CACHE_MAX_AGE"],
+        )
+        response.headers["X-Cache"] = "HIT" if cached else "MISS"
+        return response
+
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except DeadlineExceeded as e:
+        return timeout_error(e)
+    except requests.HTTPError as e:
+        return (
+            jsonify({"error": f"Upstream returned HTTP {e.response.status_code}"}),
+            502,
+        )
+    except Exception as e:
+        return jsonify({"error": f"Failed to get {kind}: {str(e)}"}), 500
+
+
+@app.route("/audio", methods=["GET"])
+def get_audio():
+    """Get a video's smallest audio-bearing format without downloading the full video"""
+    return serve_asset("audio")
+
+
+@app.route("/thumbnail", methods=["GET"])
+def get_thumbnail():
+    """Get a video's cover image"""
+    return serve_asset("thumbnail")
+
+
+@app.route("/videos/<video_id>", methods=["GET"])
+def get_video(video_id):
+    """Get the downloads and metadata known for a TikTok video ID"""
+    record = get_video_index().get(video_id)
+
+    if record is None:
+        return jsonify({"error": "Video not found"}), 404
+
+    downloads = []
+    for download_id in record["download_ids"]:
+        job = job_queue.get(download_id)
+        download = {"download_id": download_id, "status_url": f"/jobs/{download_id}"}
+        if job is not None and job["status"] == "finished":
+            download["download_url"] = job["result"]["download_url"]
+        downloads.append(download)
+
+    return jsonify(
+        {
+            "video_id": record["video_id"],
+            "metadata": record.get("metadata", {}),
+            "downloads": downloads,
+        }
+    )
+
+
+@app.route("/file/<download_id>/<filename>", methods=["GET"])
 def download_file(download_id, filename):
-    """Serve downloaded files"""
+    """Serve downloaded files with Range and conditional GET support"""
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], download_id, filename)
-        
-        if not os.path.exists(file_path):
-            return jsonify({
-                'error': 'File not found'
-            }), 404
-        
-        return send_file(file_path, as_attachment=True, download_name=filename)
-        
+        file_path = safe_join(app.config["UPLOAD_FOLDER"], download_id, filename)
+
+        if (
+            file_path
+            and not os.path.isfile(file_path)
+            and storage.remote
+            and storage.exists(f"{download_id}/{filename}")
+        ):
+            # Downloaded on another instance: send the client to the shared copy
+            return redirect(storage.url(f"{download_id}/{filename}", filename), 302)
+
+        if not file_path or not os.path.isfile(file_path):
+            return jsonify({"error": "File not found"}), 404
+
+        # Keep the janitor away from this download while it is being sent
+        janitor.touch(os.path.dirname(file_path))
+        janitor.acquire(download_id)
+        started = time.perf_counter()
+        try:
+            # send_file answers Range with 206 and If-None-Match/If-Modified-Since
+            # with 304, and hands the file to wsgi.file_wrapper so gunicorn can
+            # use sendfile() for full responses
+            response = send_file(
+                file_path,
+                as_attachment=True,
+                download_name=filename,
+                etag=file_etag(file_path),
+                conditional=True,
+                max_age=app.config["FILE_CACHE_MAX_AGE"],
+            )
+        except Exception:
+            janitor.release(download_id)
+            raise
+
+        def finish():
+            # Measured until the body has been sent, not just until send_file returns
+            FILE_SERVE_SECONDS.observe(time.perf_counter() - started)
+            janitor.release(download_id)
+
+        response.call_on_close(finish)
+        return response
+
     except Exception as e:
-        return jsonify({
-            'error': f'Failed to serve file: {str(e)}'
-        }), 500
+        return jsonify({"error": f"Failed to serve file: {str(e)}"}), 500
+
 
-@app.route('/cleanup', methods=['POST'])
+@app.route("/cleanup", methods=["POST"])
 def cleanup_files():
     """Clean up old downloaded files"""
     try:
         data = request.get_json()
-        download_id = data.get('download_id') if data else None
-        
+        download_id = data.get("download_id") if data else None
+
         if download_id:
-            # Clean up specific download
-            download_dir = os.path.join(app.config['UPLOAD_FOLDER'], download_id)
-            if os.path.exists(download_dir):
-                shutil.rmtree(download_dir)
-                return jsonify({
-                    'success': True,
-                    'message': f'Cleaned up download {download_id}'
-                })
+            # Clean up specific download, and its shared copy wherever it ran
+            download_dir = os.path.join(app.config["UPLOAD_FOLDER"], download_id)
+            removed = storage.delete_prefix(f"{download_id}/") if storage.remote else 0
+            if os.path.exists(download_dir) or removed:
+                shutil.rmtree(download_dir, ignore_errors=True)
+                return jsonify(
+                    {"success": True, "message": f"Cleaned up download {download_id}"}
+                )
             else:
-                return jsonify({
-                    'error': 'Download ID not found'
-                }), 404
+                return jsonify({"error": "Download ID not found"}), 404
         else:
             # Clean up all downloads (use with caution)
-            if os.path.exists(app.config['UPLOAD_FOLDER']):
-                shutil.rmtree(app.config['UPLOAD_FOLDER'])
-                os.makedirs(app.config['UPLOAD_FOLDER'])
-                return jsonify({
-                    'success': True,
-                    'message': 'Cleaned up all downloads'
-                })
-        
+            if storage.remote:
+                storage.delete_prefix("")
+            if os.path.exists(app.config["UPLOAD_FOLDER"]):
+                shutil.rmtree(app.config["UPLOAD_FOLDER"])
+                os.makedirs(app.config["UPLOAD_FOLDER"])
+                return jsonify({"success": True, "message": "Cleaned up all downloads"})
+
     except Exception as e:
-        return jsonify({
-            'error': f'Cleanup failed: {str(e)}'
-        }), 500
+        return jsonify({"error": f"Cleanup failed: {str(e)}"}), 500
+
 
-@app.route('/clear-cache', methods=['POST'])
+@app.route("/clear-cache", methods=["POST"])
 def clear_cache():
     """Clear yt-dlp cache to fix download issues"""
     try:
         import subprocess
         from pathlib import Path
-        
+
         # Try to clear cache using yt-dlp command
         try:
-            result = subprocess.run(['yt-dlp', '--rm-cache-dir'], 
-                                  capture_output=True, text=True, timeout=30)
+            result = subprocess.run(
+                ["yt-dlp", "--rm-cache-dir"], capture_output=True, text=True, timeout=30
+            )
             if result.returncode == 0:
-                return jsonify({
-                    'success': True,
-                    'message': 'yt-dlp cache cleared successfully',
-                    'output': result.stdout
-                })
+                return jsonify(
+                    {
+                        "success": True,
+                        "message": "yt-dlp cache cleared successfully",
+                        "output": result.stdout,
+                    }
+                )
             else:
-                return jsonify({
-                    'success': False,
-                    'message': 'Failed to clear cache via yt-dlp command',
-                    'error': result.stderr
-                })
+                return jsonify(
+                    {
+                        "success": False,
+                        "message": "Failed to clear cache via yt-dlp command",
+                        "error": result.stderr,
+                    }
+                )
         except subprocess.TimeoutExpired:
-            return jsonify({
-                'success': False,
-                'message': 'Cache clearing timed out'
-            }), 500
+            return (
+                jsonify({"success": False, "message": "Cache clearing timed out"}),
+                500,
+            )
         except FileNotFoundError:
-            return jsonify({
-                'success': False,
-                'message': 'yt-dlp command not found. Please ensure yt-dlp is installed and in PATH.'
-            }), 500
-            
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "message": "yt-dlp command not found. Please ensure yt-dlp is installed and in PATH.",
+                    }
+                ),
+                500,
+            )
+
     except Exception as e:
-        return jsonify({
-            'error': f'Cache clearing failed: {str(e)}'
-        }), 500
+        return jsonify({"error": f"Cache clearing failed: {str(e)}"}), 500
+
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({
-        'error': 'Endpoint not found'
-    }), 404
+    return jsonify({"error": "Endpoint not found"}), 404
+
+
+@app.errorhandler(429)
+def rate_limited(error):
+    limit = limiter.current_limit
+    retry_after = (
+        int(limit.reset_at - time.time()) if limit else app.config["RETRY_AFTER"]
+    )
+    return (
+        jsonify({"error": f"Rate limit exceeded: {error.description}"}),
+        429,
+        {"Retry-After": str(max(retry_after, 1))},
+    )
+
 
 @app.errorhandler(405)
 def method_not_allowed(error):
-    return jsonify({
-        'error': 'Method not allowed'
-    }), 405
+    return jsonify({"error": "Method not allowed"}), 405
+
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({
-        'error': 'Internal server error'
-    }), 500
+    return jsonify({"error": "Internal server error"}), 500
+
+
+# Request counters, latency histograms and the in-flight gauge for every route
+PerformanceMonitor.instrument_app(app)
+
+# Cold start cost of this process, taken once every route is registered
+STARTUP_METRICS = PerformanceMonitor.get_startup_metrics()
+register_metrics_provider("startup", lambda: STARTUP_METRICS)
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     # Get port from environment variable for Cloud Run compatibility
-    port = int(os.environ.get('PORT', 8080))
-    app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
+    port = int(os.environ.get("PORT", 8080))
+    app.run(debug=False, host="0.0.0.0", port=port)
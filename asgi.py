@@ -0,0 +1,367 @@
+"""ASGI entry point serving the same routes as app:app.
+
+Run with an ASGI server, e.g.:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Flask views run on a bounded thread pool, so blocking yt-dlp extraction
+and downloads never stall the event loop and never use more than
+ASGI_EXECUTOR_WORKERS threads. Response bodies (files from /file and
+upstream bytes from /stream) are pulled one chunk at a time on a second,
+smaller pool and sent from the event loop, so a slow client waiting on
+its socket holds no thread at all. Hundreds of slow downloads can then
+share a handful of threads. /progress event streams are served natively
+on the event loop, so idle subscribers cost a future each.
+"""
+
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+from werkzeug.wsgi import FileWrapper
+
+from app import FINAL_STATES
+from app import app as flask_app
+from app import job_queue, progress_broker, progress_event, refresh_shared_job
+from monitoring import REQUEST_COUNT
+
+# Marks the end of a response body iterator
+_DONE = object()
+
+
+class _ChunkedFileWrapper(FileWrapper):
+    """wsgi.file_wrapper reading files in large chunks for async sending"""
+
+    def __init__(self, file, buffer_size: int = 8192):
+        super().__init__(file, max(buffer_size, flask_app.config["STREAM_CHUNK_SIZE"]))
+
+
+class AsgiBridge:
+    """Serve a WSGI application over ASGI without a thread per connection"""
+
+    def __init__(
+        self,
+        wsgi_app,
+        max_workers: int = 32,
+        io_workers: int = 8,
+        max_body_size: Optional[int] = None,
+        async_routes: Optional[Dict[str, Callable]] = None,
+    ):
+        self.wsgi_app = wsgi_app
+        self.max_body_size = max_body_size
+        # GET routes handled natively as async (scope, receive, send, **args)
+        self.async_routes = async_routes or {}
+        self.url_map = Map(
+            [Rule(rule, endpoint=rule, methods=["GET"]) for rule in self.async_routes]
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="asgi-handler"
+        )
+        # Body reads are short; keeping them apart means slow extractions
+        # filling the handler pool cannot stall files already being sent
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix="asgi-io"
+        )
+
+    async def __call__(self, scope: Dict[str, Any], receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            handler = self._match_async(scope)
+            if handler is not None:
+                await handler[0](scope, receive, send, **handler[1])
+            else:
+                await self._http(scope, receive, send)
+
+    def _match_async(self, scope: Dict[str, Any]):
+        if not self.async_routes or scope["method"] != "GET":
+            return None
+        try:
+            rule, args = self.url_map.bind("", path_info=scope["path"]).match(
+                method="GET"
+            )
+        except HTTPException:
+            return None
+        return self.async_routes[rule], args
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                self.io_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope: Dict[str, Any], receive, send):
+        loop = asyncio.get_running_loop()
+        body = await self._read_body(receive)
+        if body is None:
+            await self._send_error(send, 413, b"Request Entity Too Large")
+            return
+
+        # Stop sending as soon as the client goes away
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    return
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        response: Dict[str, Any] = {}
+        iterable = None
+        try:
+            environ = self._environ(scope, body)
+            try:
+                iterable, first = await loop.run_in_executor(
+                    self.executor, self._start, environ, response
+                )
+            except Exception as e:
+                logging.error(f"ASGI request failed: {e}")
+                await self._send_error(send, 500, b"Internal Server Error")
+                return
+
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": int(response["status"].split(" ", 1)[0]),
+                    "headers": [
+                        (name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in response["headers"]
+                    ],
+                }
+            )
+            chunk = first
+            while chunk is not _DONE and not disconnected.is_set():
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+                chunk = await loop.run_in_executor(
+                    self.io_executor, next, iterable, _DONE
+                )
+            if not disconnected.is_set():
+                await send(
+                    {"type": "http.response.body", "body": b"", "more_body": False}
+                )
+        finally:
+            watcher.cancel()
+            if iterable is not None and hasattr(iterable, "close"):
+                # Runs call_on_close callbacks (janitor release, upstream close)
+                await loop.run_in_executor(self.io_executor, iterable.close)
+
+    async def _read_body(self, receive) -> Optional[bytes]:
+        """Read the whole request body, or None when it exceeds the size limit"""
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if self.max_body_size and size > self.max_body_size:
+                return None
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    def _start(self, environ: Dict[str, Any], response: Dict[str, Any]):
+        """Call the WSGI app and fetch the first chunk if headers are still pending"""
+        written: List[bytes] = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"] = status
+            response["headers"] = headers
+            return written.append
+
+        result = self.wsgi_app(environ, start_response)
+        iterable = iter(result)
+        first = b""
+        if "status" not in response or written:
+            # start_response may be deferred until the first chunk
+            first = next(iterable, _DONE)
+            if first is _DONE:
+                first = b""
+        if written:
+            first = b"".join(written) + first
+        if iterable is not result and hasattr(result, "close"):
+            # Keep the WSGI close() contract when iter() returned a new object
+            return _ClosingIterator(iterable, result.close), first
+        return iterable, first
+
+    @staticmethod
+    def _environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1]) if server[1] is not None else "80",
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": _ChunkedFileWrapper,
+        }
+        for raw_name, raw_value in scope.get("headers", []):
+            name = raw_name.decode("latin-1").upper().replace("-", "_")
+            value = raw_value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+                continue
+            if name == "CONTENT_LENGTH":
+                continue
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    @staticmethod
+    async def _send_error(send, status: int, body: bytes):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+class _ClosingIterator:
+    """Iterator that forwards close() to the original WSGI result"""
+
+    def __init__(self, iterator, close):
+        self._iterator = iterator
+        self.close = close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+
+async def stream_progress(scope: Dict[str, Any], receive, send, download_id: str):
+    """Async /progress/<download_id>: Server-Sent Events without a thread per subscriber"""
+    job = job_queue.get(download_id)
+    if job is None:
+        REQUEST_COUNT.inc(method="GET", endpoint="/progress/<download_id>", status=404)
+        body = b'{"error": "Download ID not found"}'
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 404,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+        return
+    REQUEST_COUNT.inc(method="GET", endpoint="/progress/<download_id>", status=200)
+
+    if progress_broker.latest(download_id) is None:
+        progress_broker.publish(download_id, job)
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        }
+    )
+
+    async def wait_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    disconnect = asyncio.ensure_future(wait_disconnect())
+    keepalive = flask_app.config["PROGRESS_KEEPALIVE"]
+    # Jobs of other workers only change in the shared state, so poll it
+    shared = not job_queue.is_local(download_id)
+    timeout = (
+        min(keepalive, flask_app.config["JOB_STATE_INTERVAL"]) if shared else keepalive
+    )
+    version = 0
+    idle = 0
+    try:
+        while not disconnect.done():
+            waiter = asyncio.ensure_future(
+                progress_broker.wait_async(download_id, version, timeout)
+            )
+            await asyncio.wait(
+                [waiter, disconnect], return_when=asyncio.FIRST_COMPLETED
+            )
+            if not waiter.done():
+                waiter.cancel()
+                break
+            update = waiter.result()
+            if update is None and shared and refresh_shared_job(download_id):
+                continue
+            if update is None:
+                if progress_broker.latest(download_id) is None:
+                    break
+                idle += timeout
+                if idle < keepalive:
+                    continue
+                idle = 0
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": b": keepalive\n\n",
+                        "more_body": True,
+                    }
+                )
+                continue
+            version, snapshot = update
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": progress_event(version, snapshot).encode("utf-8"),
+                    "more_body": True,
+                }
+            )
+            if snapshot["status"] in FINAL_STATES:
+                break
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        disconnect.cancel()
+
+
+app = AsgiBridge(
+    flask_app,
+    max_workers=flask_app.config["ASGI_EXECUTOR_WORKERS"],
+    io_workers=flask_app.config["ASGI_IO_WORKERS"],
+    max_body_size=flask_app.config["MAX_CONTENT_LENGTH"],
+    async_routes={"/progress/<download_id>": stream_progress},
+)
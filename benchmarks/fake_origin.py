@@ -0,0 +1,169 @@
+"""Local stand-in for TikTok used by the benchmarks.
+
+Serves a video page per ID and an MP4 payload behind it, with a
+configurable delay before each response and a configurable payload
+size. yt-dlp's generic extractor reads the og:video tags of the page,
+so the app runs its real extraction and download code paths, with its
+default extractor allow-list, without network access:
+
+    python -m benchmarks.fake_origin --port 9000 --latency 0.2 --size 2097152
+    curl http://127.0.0.1:9000/@bench/video/1
+"""
+
+import argparse
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<title>Benchmark video {video_id}</title>
+<meta property="og:title" content="Benchmark video {video_id}">
+<meta property="og:video" content="/media/{video_id}.mp4">
+<meta property="og:video:type" content="video/mp4">
+<meta property="og:video:width" content="720">
+<meta property="og:video:height" content="1280">
+</head>
+<body>
+<video src="/media/{video_id}.mp4" width="720" height="1280"></video>
+</body>
+</html>
+"""
+
+
+class FakeOriginHandler(BaseHTTPRequestHandler):
+    """Serves /@<user>/video/<id> pages and /media/<id>.mp4 payloads"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._respond(head=True)
+
+    def do_GET(self):
+        self._respond(head=False)
+
+    def _respond(self, head: bool):
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        page = re.fullmatch(r"/@[\w.-]+/video/(\d+)/?", self.path.split("?")[0])
+        media = re.fullmatch(r"/media/(\d+)\.mp4", self.path.split("?")[0])
+        if page:
+            body = PAGE_TEMPLATE.format(video_id=page.group(1)).encode("utf-8")
+            self._send_body(200, "text/html; charset=utf-8", body, head)
+        elif media:
+            self._send_media(head)
+        else:
+            self._send_body(404, "text/plain", b"Not found", head)
+
+    def _send_body(self, status: int, content_type: str, body: bytes, head: bool):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _send_media(self, head: bool):
+        size = self.server.size
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+        # The payload is the chunk repeated, so any range maps back into it
+        chunk = self.server.chunk
+        position = start
+        while position <= end:
+            offset = position % len(chunk)
+            data = chunk[offset : offset + end - position + 1]
+            self.wfile.write(data)
+            position += len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOrigin:
+    """Fake origin running on a background thread"""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.05,
+        size: int = 1024 * 1024,
+    ):
+        self.server = ThreadingHTTPServer((host, port), FakeOriginHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.size = size
+        self.server.requests = 0
+        # Byte pattern repeated to make up every payload
+        self.server.chunk = bytes(range(256)) * 256
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def video_url(self, video_id) -> str:
+        """Page URL of a fake video"""
+        return f"{self.base_url}/@bench/video/{video_id}"
+
+    @property
+    def requests(self) -> int:
+        return self.server.requests
+
+    def start(self) -> "FakeOrigin":
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="fake-origin", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve fake TikTok pages and MP4 payloads"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds before each response"
+    )
+    parser.add_argument(
+        "--size", type=int, default=1024 * 1024, help="MP4 payload size in bytes"
+    )
+    args = parser.parse_args()
+
+    origin = FakeOrigin(args.host, args.port, args.latency, args.size)
+    print(f"Fake origin on {origin.base_url} (try {origin.video_url(1)})")
+    try:
+        origin.server.serve_forever()
+    except KeyboardInterrupt:
+        origin.stop()
+
+
+if __name__ == "__main__":
+    main()
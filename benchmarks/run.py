@@ -0,0 +1,441 @@
+"""Offline load test for the downloader API.
+
+Starts the fake origin and the app under a real server (gunicorn or
+uvicorn), then drives each scenario at increasing concurrency and
+reports latency percentiles, throughput, peak RSS of the server
+processes and disk use of the downloads folder:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --scenarios metadata,file --concurrency 1,8,32 --duration 5
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json --tolerance 0.2
+
+With --baseline the run exits non-zero when any p95 latency or
+throughput regresses by more than the tolerance.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import psutil
+import requests
+
+from benchmarks.fake_origin import FakeOrigin
+from janitor import disk_usage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("metadata", "formats", "download", "file")
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class AppServer:
+    """The app running in a child server process on a local port"""
+
+    def __init__(self, server: str, workers: int, threads: int, upload_folder: str):
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        # Hourly rate limits would cut every run short; admission control stays on.
+        # The fake origin's og:video pages pass the default extractor allow-list.
+        env = dict(
+            os.environ,
+            UPLOAD_FOLDER=upload_folder,
+            FLASK_ENV="production",
+            RATELIMIT_ENABLED="false",
+            METRICS_DIR=os.path.join(upload_folder, ".metrics"),
+            JOB_STATE_DIR=os.path.join(upload_folder, ".jobs"),
+            PYTHONUNBUFFERED="1",
+        )
+        if server == "uvicorn":
+            command = [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "asgi:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(self.port),
+                "--workers",
+                str(workers),
+                "--log-level",
+                "warning",
+            ]
+        else:
+            command = [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "-c",
+                "gunicorn.conf.py",
+                "--bind",
+                f"127.0.0.1:{self.port}",
+                "--workers",
+                str(workers),
+                "--threads",
+                str(threads),
+                "--max-requests",
+                "0",
+                "--log-level",
+                "warning",
+                "app:app",
+            ]
+        self.process = subprocess.Popen(
+            command,
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def wait_ready(self, timeout: float = 60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    f"App server exited with code {self.process.returncode}"
+                )
+            try:
+                if (
+                    requests.get(f"{self.base_url}/health", timeout=1).status_code
+                    == 200
+                ):
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("App server did not become ready")
+
+    def rss(self) -> int:
+        """Resident memory of the server and all its workers"""
+        try:
+            parent = psutil.Process(self.process.pid)
+            processes = [parent] + parent.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return 0
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                continue
+        return total
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class RssSampler:
+    """Tracks the peak RSS of the app server in the background"""
+
+    def __init__(self, server: AppServer, interval: float = 0.1):
+        self.server = server
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.server.rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Scenario:
+    """One benchmarked operation; run() performs a single request and raises on failure"""
+
+    def __init__(self, name: str, base_url: str, origin: FakeOrigin, videos: int):
+        self.name = name
+        self.base_url = base_url
+        self.origin = origin
+        # Zero videos means every request asks for a new, uncached video
+        self._ids = (
+            itertools.cycle(range(1, videos + 1)) if videos > 0 else itertools.count(1)
+        )
+        self._lock = threading.Lock()
+        self.file_url = None
+
+    def next_video_url(self) -> str:
+        with self._lock:
+            return self.origin.video_url(next(self._ids))
+
+    def setup(self, session: requests.Session):
+        if self.name == "file":
+            job = self._download(session, self.origin.video_url(0))
+            self.file_url = f"{self.base_url}{job['download_url']}"
+
+    def run(self, session: requests.Session):
+        if self.name == "metadata":
+            response = session.post(
+                f"{self.base_url}/metadata",
+                json={"url": self.next_video_url()},
+                timeout=120,
+            )
+            response.raise_for_status()
+        elif self.name == "formats":
+            response = session.get(
+                f"{self.base_url}/formats",
+                params={"url": self.next_video_url()},
+                timeout=120,
+            )
+            response.raise_for_status()
+        elif self.name == "download":
+            self._download(session, self.next_video_url())
+        elif self.name == "file":
+            with session.get(self.file_url, stream=True, timeout=120) as response:
+                response.raise_for_status()
+                for _ in response.iter_content(chunk_size=256 * 1024):
+                    pass
+
+    def _download(self, session: requests.Session, video_url: str) -> Dict[str, Any]:
+        """Queue a download and poll until it finishes; the latency covers the whole job"""
+        response = session.post(
+            f"{self.base_url}/download", json={"url": video_url}, timeout=30
+        )
+        response.raise_for_status()
+        status_url = f"{self.base_url}{response.json()['status_url']}"
+        while True:
+            job = session.get(status_url, timeout=30).json()
+            if job["status"] == "finished":
+                return job
+            if job["status"] == "failed":
+                raise RuntimeError(job["error"])
+            time.sleep(0.05)
+
+
+def run_level(scenario: Scenario, concurrency: int, duration: float) -> Dict[str, Any]:
+    """Run a scenario with a fixed number of clients for a fixed time"""
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(number: int):
+        session = requests.Session()
+        # Each simulated client gets its own per-client admission slots
+        session.headers["X-API-Key"] = f"bench-client-{number}"
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                scenario.run(session)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=client, args=(number,)) for number in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def run_benchmarks(args) -> Dict[str, Any]:
+    upload_folder = tempfile.mkdtemp(prefix="bench-downloads-")
+    origin = FakeOrigin(latency=args.origin_latency, size=args.size).start()
+    server = AppServer(args.server, args.workers, args.threads, upload_folder)
+    results: Dict[str, Any] = {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "server": args.server,
+            "workers": args.workers,
+            "threads": args.threads,
+            "origin_latency": args.origin_latency,
+            "size": args.size,
+            "videos": args.videos,
+            "duration": args.duration,
+        },
+        "scenarios": {},
+    }
+    try:
+        server.wait_ready()
+        for name in args.scenarios:
+            scenario = Scenario(name, server.base_url, origin, args.videos)
+            scenario.setup(requests.Session())
+            levels = []
+            for concurrency in args.concurrency:
+                with RssSampler(server) as sampler:
+                    level = run_level(scenario, concurrency, args.duration)
+                level["peak_rss_mb"] = round(sampler.peak / (1024 * 1024), 1)
+                level["disk_mb"] = round(disk_usage(upload_folder) / (1024 * 1024), 1)
+                levels.append(level)
+                print_level(name, level)
+            results["scenarios"][name] = levels
+        results["meta"]["origin_requests"] = origin.requests
+    finally:
+        server.stop()
+        origin.stop()
+        shutil.rmtree(upload_folder, ignore_errors=True)
+    return results
+
+
+def print_level(name: str, level: Dict[str, Any]):
+    print(
+        f"{name:<10} c={level['concurrency']:<4} n={level['requests']:<6} err={level['errors']:<4} "
+        f"rps={level['rps']:<9} p50={level['p50_ms']:<8} p95={level['p95_ms']:<8} p99={level['p99_ms']:<8} "
+        f"rss={level['peak_rss_mb']}MB disk={level['disk_mb']}MB",
+        flush=True,
+    )
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Describe every p95 latency or throughput regression beyond the tolerance"""
+    regressions = []
+    for name, levels in results["scenarios"].items():
+        baseline_levels = {
+            level["concurrency"]: level
+            for level in baseline.get("scenarios", {}).get(name, [])
+        }
+        for level in levels:
+            before = baseline_levels.get(level["concurrency"])
+            if before is None:
+                continue
+            label = f"{name} c={level['concurrency']}"
+            if before["p95_ms"] and level["p95_ms"] > before["p95_ms"] * (
+                1 + tolerance
+            ):
+                regressions.append(
+                    f"{label}: p95 {before['p95_ms']}ms -> {level['p95_ms']}ms"
+                )
+            if before["rps"] and level["rps"] < before["rps"] * (1 - tolerance):
+                regressions.append(f"{label}: rps {before['rps']} -> {level['rps']}")
+            if level["errors"] > before.get("errors", 0):
+                regressions.append(
+                    f"{label}: errors {before.get('errors', 0)} -> {level['errors']}"
+                )
+    return regressions
+
+
+def parse_list(value: str, cast: Callable = str) -> List[Any]:
+    return [cast(item) for item in value.split(",") if item]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the downloader API against a local fake origin"
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=parse_list,
+        default=list(SCENARIOS),
+        help=f"Comma-separated scenarios ({','.join(SCENARIOS)})",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: parse_list(value, int),
+        default=[1, 4, 16],
+        help="Comma-separated client counts",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds per concurrency level"
+    )
+    parser.add_argument(
+        "--videos",
+        type=int,
+        default=20,
+        help="Distinct fake videos requested in rotation (0: always a new one)",
+    )
+    parser.add_argument(
+        "--origin-latency",
+        type=float,
+        default=0.05,
+        help="Fake origin delay per response",
+    )
+    parser.add_argument(
+        "--size", type=int, default=1024 * 1024, help="Fake MP4 size in bytes"
+    )
+    parser.add_argument("--server", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument(
+        "--save-baseline", help="Write results as the new baseline file"
+    )
+    parser.add_argument("--baseline", help="Compare against this baseline file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed relative regression"
+    )
+    args = parser.parse_args(argv)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = run_benchmarks(args)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
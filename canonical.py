@@ -0,0 +1,170 @@
+import logging
+import re
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from cache import TTLCache
+
+# TikTok video and photo URLs carry the numeric video ID in the path
+VIDEO_ID_PATTERN = re.compile(r"/(?:video|photo|v|embed(?:/v2)?)/(\d+)")
+
+# Hosts whose links only redirect to the real video URL
+SHORT_LINK_HOSTS = ("vm.tiktok.com", "vt.tiktok.com")
+
+
+def _is_tiktok_host(host: str) -> bool:
+    return host == "tiktok.com" or host.endswith(".tiktok.com")
+
+
+def normalize_url(url: str) -> str:
+    """Normalize a TikTok URL so variants of one link compare equal.
+
+    Mobile hosts and missing schemes are unified, and the query string and
+    fragment (share and tracking parameters) are dropped since they never
+    identify the video. Non-TikTok URLs are only stripped of whitespace.
+    """
+    url = url.strip()
+    if "://" not in url and re.match(
+        r"^(?:[\w-]+\.)*tiktok\.com(?:/|$)", url, re.IGNORECASE
+    ):
+        url = f"https://{url}"
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if not _is_tiktok_host(host):
+        return url
+
+    match = VIDEO_ID_PATTERN.search(parts.path)
+    if match:
+        user = re.search(r"/@([\w.-]+)", parts.path)
+        kind = "photo" if "/photo/" in parts.path else "video"
+        return f"https://www.tiktok.com/@{user.group(1) if user else ''}/{kind}/{match.group(1)}"
+    if host in ("tiktok.com", "m.tiktok.com"):
+        host = "www.tiktok.com"
+    return f"https://{host}{parts.path.rstrip('/') or '/'}"
+
+
+def video_id_from_url(url: str) -> Optional[str]:
+    """TikTok video ID contained in a URL, if any"""
+    match = VIDEO_ID_PATTERN.search(urlsplit(normalize_url(url)).path)
+    return match.group(1) if match else None
+
+
+def video_key(url: str) -> str:
+    """Cache key for a video URL without any network access: the video ID, or the normalized URL"""
+    return video_id_from_url(url) or normalize_url(url)
+
+
+def is_short_link(url: str) -> bool:
+    """Whether a URL is a TikTok short link that must be resolved by redirect"""
+    parts = urlsplit(normalize_url(url))
+    host = (parts.hostname or "").lower()
+    return host in SHORT_LINK_HOSTS or (
+        _is_tiktok_host(host) and parts.path.startswith("/t/")
+    )
+
+
+class Canonicalizer:
+    """Resolves user-supplied URLs to a stable video key and canonical URL.
+
+    Short links cost an HTTP redirect round trip, so their resolutions are
+    cached in memory with a TTL and persisted as aliases in the video
+    index, which other workers and restarts read before going to the
+    network. Resolution failures fall back to the normalized URL and let
+    yt-dlp follow the redirect itself.
+    """
+
+    def __init__(
+        self,
+        session,
+        get_index: Optional[Callable[[], Any]] = None,
+        maxsize: int = 4096,
+        ttl: float = 86400,
+        timeout: float = 10,
+    ):
+        self.session = session
+        self.get_index = get_index
+        self.timeout = timeout
+        self.resolutions = 0
+        self.failures = 0
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def resolve(self, url: str) -> Tuple[str, str]:
+        """Return (video key, canonical URL) for a user-supplied URL"""
+        normalized = normalize_url(url)
+        video_id = video_id_from_url(normalized)
+        if video_id is not None:
+            return video_id, normalized
+
+        cached = self._cache.get(normalized)
+        if cached is None and self.get_index is not None:
+            alias = self.get_index().alias(normalized)
+            if alias is not None:
+                cached = (
+                    alias,
+                    normalize_url(f"https://www.tiktok.com/@/video/{alias}"),
+                )
+                self._cache.set(normalized, cached)
+        if cached is not None:
+            return cached
+
+        if not is_short_link(normalized):
+            return normalized, normalized
+
+        resolved = self._follow(normalized)
+        video_id = video_id_from_url(resolved) if resolved else None
+        if resolved is None or video_id is None:
+            return normalized, normalized
+        result = (video_id, normalize_url(resolved))
+        self._cache.set(normalized, result)
+        if self.get_index is not None:
+            self.get_index().add_alias(normalized, video_id)
+        return result
+
+    def remember(self, url: str, video_id: str):
+        """Record the video ID a URL turned out to point at, e.g. after extraction"""
+        normalized = normalize_url(url)
+        if video_id_from_url(normalized) is not None:
+            return
+        self._cache.set(
+            normalized,
+            (
+                str(video_id),
+                normalize_url(f"https://www.tiktok.com/@/video/{video_id}"),
+            ),
+        )
+        if self.get_index is not None:
+            self.get_index().add_alias(normalized, str(video_id))
+
+    def _follow(self, url: str) -> Optional[str]:
+        """Follow a short link's redirects without downloading the page"""
+        with self._lock:
+            self.resolutions += 1
+        try:
+            response = self.session.head(
+                url, allow_redirects=True, timeout=self.timeout
+            )
+            response.close()
+            return response.url
+        except Exception as e:
+            logging.warning(f"Could not resolve short link {url}: {e}")
+            with self._lock:
+                self.failures += 1
+            return None
+
+    def clear(self):
+        """Forget in-memory resolutions"""
+        self._cache.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Resolution counters for the /metrics endpoint"""
+        cache_metrics = self._cache.metrics()
+        with self._lock:
+            return {
+                "resolutions_total": self.resolutions,
+                "resolve_failures_total": self.failures,
+                "cache_hits_total": cache_metrics["hits_total"],
+                "cache_misses_total": cache_metrics["misses_total"],
+                "cache_size": cache_metrics["size"],
+            }
@@ -0,0 +1,53 @@
+import gzip
+from typing import Optional
+
+from werkzeug.datastructures import Accept
+
+try:
+    import brotli
+except ImportError:  # Optional: pip install brotli
+    brotli = None
+
+# Media types worth compressing; video bodies are already compressed
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html")
+
+
+def choose_encoding(accept_encodings: Accept) -> Optional[str]:
+    """Preferred encoding the client accepts: br when brotli is installed, then gzip"""
+    candidates = [
+        encoding
+        for encoding in ("br", "gzip")
+        if encoding != "br" or brotli is not None
+    ]
+    best = max(candidates, key=lambda encoding: accept_encodings.quality(encoding))
+    return best if accept_encodings.quality(best) > 0 else None
+
+
+def compress_body(body: bytes, encoding: str, level: int = 6) -> bytes:
+    if encoding == "br":
+        # Brotli quality runs 0-11; keep the same relative effort as the gzip level
+        return brotli.compress(body, quality=min(11, level + 2))
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def compress_response(
+    response, accept_encodings: Accept, min_size: int = 1024, level: int = 6
+):
+    """Compress a buffered text response in place when the client accepts it"""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(accept_encodings)
+    body = response.get_data()
+    if encoding is None or len(body) < min_size:
+        return response
+    response.set_data(compress_body(body, encoding, level))
+    response.headers["Content-Encoding"] = encoding
+    return response
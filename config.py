@@ -1,100 +1,315 @@
 import os
-from typing import Dict, Any
+from typing import Any, Callable, Dict, Optional
+
 
 class Config:
     """Base configuration class"""
-    
+
     # Flask settings
-    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+    SECRET_KEY = os.environ.get("SECRET_KEY", "dev-secret-key-change-in-production")
     DEBUG = False
     TESTING = False
-    
+
     # Application settings
-    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'downloads')
-    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))  # 16MB
-    
+    UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "downloads")
+    MAX_CONTENT_LENGTH = int(
+        os.environ.get("MAX_CONTENT_LENGTH", 16 * 1024 * 1024)
+    )  # 16MB
+
     # Server settings
-    HOST = os.environ.get('HOST', '0.0.0.0')
-    PORT = int(os.environ.get('PORT', 8080))
-    
+    HOST = os.environ.get("HOST", "0.0.0.0")
+    PORT = int(os.environ.get("PORT", 8080))
+
     # yt-dlp settings
-    YT_DLP_TIMEOUT = int(os.environ.get('YT_DLP_TIMEOUT', 300))  # 5 minutes
-    YT_DLP_RETRIES = int(os.environ.get('YT_DLP_RETRIES', 3))
-    
-    # Rate limiting
-    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', 'memory://')
-    RATELIMIT_DEFAULT = os.environ.get('RATELIMIT_DEFAULT', '100 per hour')
-    
+    YT_DLP_TIMEOUT = int(
+        os.environ.get("YT_DLP_TIMEOUT", 300)
+    )  # Deadline of a whole download, 5 minutes
+    YT_DLP_EXTRACT_TIMEOUT = int(
+        os.environ.get("YT_DLP_EXTRACT_TIMEOUT", 60)
+    )  # Deadline of a metadata extraction
+    # Threads running extractions, including ones abandoned at their deadline until yt-dlp returns
+    YT_DLP_EXTRACT_THREADS = int(os.environ.get("YT_DLP_EXTRACT_THREADS", 16))
+    YT_DLP_SOCKET_TIMEOUT = int(
+        os.environ.get("YT_DLP_SOCKET_TIMEOUT", 20)
+    )  # Per connection and read
+    YT_DLP_RETRIES = int(os.environ.get("YT_DLP_RETRIES", 3))
+    YT_DLP_POOL_SIZE = int(
+        os.environ.get("YT_DLP_POOL_SIZE", 8)
+    )  # Instances per profile
+    # Extractor name patterns yt-dlp registers ('default' for all of them); fewer makes instances cheaper
+    YT_DLP_EXTRACTORS = os.environ.get(
+        "YT_DLP_EXTRACTORS", "tiktok.*,vm.tiktok,generic"
+    ).split(",")
+    # Import yt-dlp and build pooled instances in the background after the first request
+    YT_DLP_WARMUP = os.environ.get("YT_DLP_WARMUP", "true").lower() == "true"
+
+    # Background download jobs
+    DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+    DOWNLOAD_QUEUE_SIZE = int(os.environ.get("DOWNLOAD_QUEUE_SIZE", 32))
+    JOB_RETENTION = int(os.environ.get("JOB_RETENTION", 3600))  # 1 hour
+    # Job records shared between gunicorn workers so any worker answers /jobs (unset keeps them per process)
+    JOB_STATE_DIR = os.environ.get("JOB_STATE_DIR")
+    JOB_STATE_INTERVAL = float(
+        os.environ.get("JOB_STATE_INTERVAL", 1.0)
+    )  # Seconds between progress writes
+
+    # /progress Server-Sent Events
+    PROGRESS_MIN_INTERVAL = float(
+        os.environ.get("PROGRESS_MIN_INTERVAL", 0.25)
+    )  # Seconds between progress events
+    PROGRESS_KEEPALIVE = int(os.environ.get("PROGRESS_KEEPALIVE", 15))
+    # Streams served by WSGI threads each hold one; past these limits clients poll /jobs instead.
+    # ASGI mode (asgi:app) streams without holding a thread and applies neither limit
+    PROGRESS_MAX_STREAMS = int(
+        os.environ.get(
+            "PROGRESS_MAX_STREAMS",
+            max(int(os.environ.get("GUNICORN_THREADS", 8)) // 2, 1),
+        )
+    )  # Open streams per worker, half its threads by default, 0 for no limit
+    PROGRESS_MAX_DURATION = int(
+        os.environ.get("PROGRESS_MAX_DURATION", 120)
+    )  # Seconds before a stream is closed
+
+    # Batch downloads
+    BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", 50))
+    BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", 4))
+    BATCH_MAX_PARALLELISM = int(os.environ.get("BATCH_MAX_PARALLELISM", 8))
+
+    # Metadata cache
+    METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", 1024))
+    METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", 300))  # 5 minutes
+
+    # Persistent metadata store behind the in-memory cache (defaults to the store folder)
+    METADATA_DB_PATH = os.environ.get("METADATA_DB_PATH")
+    METADATA_STORE_FRESHNESS = int(
+        os.environ.get("METADATA_STORE_FRESHNESS", 21600)
+    )  # 6 hours
+    METADATA_STORE_MAX_AGE = int(
+        os.environ.get("METADATA_STORE_MAX_AGE", 7 * 86400)
+    )  # 7 days
+    METADATA_BULK_MAX_IDS = int(os.environ.get("METADATA_BULK_MAX_IDS", 1000))
+
+    # Streaming pass-through
+    STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 64 * 1024))  # 64KB
+    STREAM_CONNECT_TIMEOUT = int(os.environ.get("STREAM_CONNECT_TIMEOUT", 30))
+
+    # ffmpeg post-processing of downloads (skipped when ffmpeg is not installed)
+    POSTPROCESS_ENABLED = (
+        os.environ.get("POSTPROCESS_ENABLED", "true").lower() == "true"
+    )
+    POSTPROCESS_WORKERS = int(
+        os.environ.get("POSTPROCESS_WORKERS", 2)
+    )  # Concurrent ffmpeg processes
+    # Presets run on every download; clients opt into others with "presets"
+    POSTPROCESS_PRESETS = [
+        p for p in os.environ.get("POSTPROCESS_PRESETS", "faststart").split(",") if p
+    ]
+    POSTPROCESS_TIMEOUT = int(os.environ.get("POSTPROCESS_TIMEOUT", 600))  # 10 minutes
+
+    # Compression of JSON and text responses (brotli when installed, else gzip)
+    RESPONSE_COMPRESSION = (
+        os.environ.get("RESPONSE_COMPRESSION", "true").lower() == "true"
+    )
+    COMPRESS_MIN_SIZE = int(
+        os.environ.get("COMPRESS_MIN_SIZE", 1024)
+    )  # Smaller bodies are sent as is
+    COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+    # Downloaded files never change once written
+    FILE_CACHE_MAX_AGE = int(os.environ.get("FILE_CACHE_MAX_AGE", 3600))  # 1 hour
+
+    # Where finished downloads are kept for /file: 'local' disk, or 's3' for any S3-compatible bucket
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+    STORAGE_BUCKET = os.environ.get("STORAGE_BUCKET")
+    STORAGE_PREFIX = os.environ.get("STORAGE_PREFIX", "downloads")
+    STORAGE_ENDPOINT_URL = os.environ.get(
+        "STORAGE_ENDPOINT_URL"
+    )  # MinIO, or https://storage.googleapis.com for GCS
+    STORAGE_REGION = os.environ.get("STORAGE_REGION")
+    STORAGE_URL_TTL = int(
+        os.environ.get("STORAGE_URL_TTL", 3600)
+    )  # Presigned URL lifetime
+    STORAGE_PART_SIZE = int(
+        os.environ.get("STORAGE_PART_SIZE", 8 * 1024 * 1024)
+    )  # Multipart chunk size
+
+    # Downloads janitor (0 disables a limit)
+    MAX_DOWNLOADS_BYTES = int(
+        os.environ.get("MAX_DOWNLOADS_BYTES", 1024 * 1024 * 1024)
+    )  # 1GB
+    MAX_DOWNLOAD_AGE = int(os.environ.get("MAX_DOWNLOAD_AGE", 3600))  # 1 hour
+    MAX_DOWNLOAD_FILES = int(os.environ.get("MAX_DOWNLOAD_FILES", 500))
+    JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", 60))
+
+    # URL canonicalization and the persistent video index
+    SHORT_LINK_CACHE_SIZE = int(os.environ.get("SHORT_LINK_CACHE_SIZE", 4096))
+    SHORT_LINK_CACHE_TTL = int(os.environ.get("SHORT_LINK_CACHE_TTL", 86400))  # 1 day
+    SHORT_LINK_TIMEOUT = int(os.environ.get("SHORT_LINK_TIMEOUT", 10))
+    VIDEO_INDEX_SIZE = int(os.environ.get("VIDEO_INDEX_SIZE", 5000))
+
+    # ASGI mode (asgi:app): threads running Flask views, and threads reading response bodies
+    ASGI_EXECUTOR_WORKERS = int(os.environ.get("ASGI_EXECUTOR_WORKERS", 32))
+    ASGI_IO_WORKERS = int(os.environ.get("ASGI_IO_WORKERS", 8))
+
+    # Metrics shared between gunicorn workers (unset keeps them per process)
+    METRICS_DIR = os.environ.get("METRICS_DIR")
+    METRICS_FLUSH_INTERVAL = int(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+
+    # Rate limiting (per client, on the routes that reach TikTok)
+    RATELIMIT_ENABLED = os.environ.get("RATELIMIT_ENABLED", "true").lower() == "true"
+    RATELIMIT_STORAGE_URL = os.environ.get("RATELIMIT_STORAGE_URL", "memory://")
+    RATELIMIT_DEFAULT = os.environ.get("RATELIMIT_DEFAULT", "100 per hour")
+
+    # Admission control for upstream fetches (extractions and downloads)
+    UPSTREAM_MAX_CONCURRENCY = int(
+        os.environ.get("UPSTREAM_MAX_CONCURRENCY", 16)
+    )  # Per worker process
+    CLIENT_MAX_CONCURRENCY = int(
+        os.environ.get("CLIENT_MAX_CONCURRENCY", 4)
+    )  # Per IP or API key
+    ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 64))
+    ADMISSION_QUEUE_TIMEOUT = int(
+        os.environ.get("ADMISSION_QUEUE_TIMEOUT", 10)
+    )  # Seconds a request waits for a slot
+    CLIENT_MAX_JOBS = int(
+        os.environ.get("CLIENT_MAX_JOBS", 8)
+    )  # Queued or running downloads per client
+    RETRY_AFTER = int(os.environ.get("RETRY_AFTER", 5))
+    # Proxies in front of the app that append X-Forwarded-For (1 for Cloud Run, 0 when exposed directly)
+    TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 1))
+
+    # Circuit breaker and retry budget for TikTok throttling (per worker process)
+    UPSTREAM_BREAKER_THRESHOLD = int(
+        os.environ.get("UPSTREAM_BREAKER_THRESHOLD", 5)
+    )  # 403/429s that open it, 0 disables
+    UPSTREAM_BREAKER_WINDOW = int(
+        os.environ.get("UPSTREAM_BREAKER_WINDOW", 30)
+    )  # Seconds those are counted over
+    UPSTREAM_BREAKER_COOLDOWN = int(
+        os.environ.get("UPSTREAM_BREAKER_COOLDOWN", 30)
+    )  # Seconds open before a probe
+    UPSTREAM_MAX_RETRIES = int(
+        os.environ.get("UPSTREAM_MAX_RETRIES", 2)
+    )  # Retries of a throttled extraction or download
+    UPSTREAM_RETRY_RATIO = float(
+        os.environ.get("UPSTREAM_RETRY_RATIO", 0.2)
+    )  # Retries allowed per upstream call
+    UPSTREAM_RETRY_MAX_DELAY = float(
+        os.environ.get("UPSTREAM_RETRY_MAX_DELAY", 5)
+    )  # Longest backoff in seconds
+
     # Logging
-    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
-    LOG_FORMAT = os.environ.get('LOG_FORMAT', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.environ.get(
+        "LOG_FORMAT", "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+
     # Security headers
     SECURITY_HEADERS = {
-        'X-Content-Type-Options': 'nosniff',
-        'X-Frame-Options': 'DENY',
-        'X-XSS-Protection': '1; mode=block',
-        'Strict-Transport-Security': 'max-age=31536000; includeSubDomains',
-        'Content-Security-Policy': "default-src 'self'; script-src 'self' 'unsafe-inline'; style-src 'self' 'unsafe-inline';"
+        "X-Content-Type-Options": "nosniff",
+        "X-Frame-Options": "DENY",
+        "X-XSS-Protection": "1; mode=block",
+        "Strict-Transport-Security": "max-age=31536000; includeSubDomains",
+        "Content-Security-Policy": "default-src 'self'; script-src 'self' 'unsafe-inline'; style-src 'self' 'unsafe-inline';",
     }
-    
+
+    # Browser-like headers sent with every yt-dlp request to avoid 403 errors
+    YT_DLP_HTTP_HEADERS = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Referer": "https://www.tiktok.com/",
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+        "Accept-Language": "en-US,en;q=0.5",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+        "Upgrade-Insecure-Requests": "1",
+    }
+
     @staticmethod
-    def get_yt_dlp_options(download_dir: str) -> Dict[str, Any]:
-        """Get yt-dlp configuration options"""
-        return {
-            'outtmpl': os.path.join(download_dir, '%(title)s.%(ext)s'),
-            'format': 'best/mp4/any',
-            'noplaylist': True,
-            'extract_flat': False,
-            'socket_timeout': Config.YT_DLP_TIMEOUT,
-            'retries': Config.YT_DLP_RETRIES,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Referer': 'https://www.tiktok.com/',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            },
-            'extractor_retries': 3,
-            'fragment_retries': 3,
+    def get_yt_dlp_options(
+        download_dir: str,
+        profile: str = "download",
+        retry_sleep: Optional[Callable[[int], float]] = None,
+    ) -> Dict[str, Any]:
+        """Get yt-dlp configuration options for a profile ('download' or 'metadata')"""
+        options = {
+            "noplaylist": True,
+            "socket_timeout": Config.YT_DLP_SOCKET_TIMEOUT,
+            "retries": Config.YT_DLP_RETRIES,
+            "http_headers": dict(Config.YT_DLP_HTTP_HEADERS),
+            # Throttled extractions are retried by the app, within its retry budget
+            "extractor_retries": 0,
+            "fragment_retries": 3,
+            "allowed_extractors": list(Config.YT_DLP_EXTRACTORS),
         }
+        if profile == "metadata":
+            options.update(
+                {
+                    "quiet": True,
+                    "no_warnings": True,
+                }
+            )
+        else:
+            options.update(
+                {
+                    "outtmpl": os.path.join(download_dir, "%(title)s.%(ext)s"),
+                    "format": "best/mp4/any",
+                    "extract_flat": False,
+                }
+            )
+        if retry_sleep is not None:
+            options["retry_sleep_functions"] = {
+                "http": retry_sleep,
+                "fragment": retry_sleep,
+            }
+        return options
+
 
 class DevelopmentConfig(Config):
     """Development configuration"""
+
     DEBUG = True
-    LOG_LEVEL = 'DEBUG'
+    LOG_LEVEL = "DEBUG"
+
 
 class ProductionConfig(Config):
     """Production configuration"""
+
     DEBUG = False
-    LOG_LEVEL = 'WARNING'
-    
+    LOG_LEVEL = "WARNING"
+
     # Enhanced security for production
     SECURITY_HEADERS = {
         **Config.SECURITY_HEADERS,
-        'Strict-Transport-Security': 'max-age=63072000; includeSubDomains; preload',
+        "Strict-Transport-Security": "max-age=63072000; includeSubDomains; preload",
     }
 
+
 class TestingConfig(Config):
     """Testing configuration"""
+
     TESTING = True
     DEBUG = True
-    LOG_LEVEL = 'DEBUG'
-    UPLOAD_FOLDER = 'test_downloads'
+    LOG_LEVEL = "DEBUG"
+    UPLOAD_FOLDER = "test_downloads"
+    JANITOR_INTERVAL = 0  # Tests run the janitor explicitly
+    RATELIMIT_ENABLED = False
+    YT_DLP_WARMUP = (
+        False  # Tests mock yt_dlp.YoutubeDL, so nothing may build real instances
+    )
+
 
 # Configuration mapping
 config = {
-    'development': DevelopmentConfig,
-    'production': ProductionConfig,
-    'testing': TestingConfig,
-    'default': ProductionConfig
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+    "testing": TestingConfig,
+    "default": ProductionConfig,
 }
 
+
 def get_config(config_name: str = None) -> Config:
     """Get configuration based on environment"""
     if config_name is None:
-        config_name = os.environ.get('FLASK_ENV', 'production')
-    
-    return config.get(config_name, config['default'])
\ No newline at end of file
+        config_name = os.environ.get("FLASK_ENV", "production")
+
+    return config.get(config_name, config["default"])
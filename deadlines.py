@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Optional
+
+from monitoring import REGISTRY
+
+UPSTREAM_TIMEOUTS = REGISTRY.counter(
+    "app_upstream_timeouts_total",
+    "yt-dlp operations abandoned at their deadline",
+    ("operation",),
+)
+
+
+# Calls made through call_with_deadline, including ones still running past their deadline
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_max_workers = 16
+
+
+def configure_executor(max_workers: int):
+    """Size the pool call_with_deadline runs calls on; takes effect before its first call"""
+    global _max_workers
+    _max_workers = max_workers
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Created on first use so gunicorn workers do not inherit it across fork
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_max_workers, thread_name_prefix="deadline"
+            )
+        return _executor
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an operation runs past its deadline"""
+
+
+class Deadline:
+    """Point in time by which an operation has to be finished"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, operation: str):
+        """Raise DeadlineExceeded once the deadline has passed"""
+        if self.expired:
+            UPSTREAM_TIMEOUTS.inc(operation=operation.lower())
+            raise DeadlineExceeded(
+                f"{operation} timed out after {self.seconds:g} seconds"
+            )
+
+
+def call_with_deadline(
+    func: Callable[[], Any], deadline: Deadline, operation: str
+) -> Any:
+    """Run func on a bounded thread pool and stop waiting for it at the deadline.
+
+    For blocking calls that cannot be interrupted, such as a yt-dlp
+    extraction: the caller gets DeadlineExceeded on time, while func runs
+    to completion in the background (bounded by its socket timeouts) and
+    its result is dropped. A call still queued for a pool thread at the
+    deadline is cancelled instead.
+    """
+    future = _get_executor().submit(func)
+    try:
+        return future.result(timeout=deadline.remaining())
+    except TimeoutError:
+        future.cancel()
+        UPSTREAM_TIMEOUTS.inc(operation=operation.lower())
+        raise DeadlineExceeded(
+            f"{operation} timed out after {deadline.seconds:g} seconds"
+        )
@@ -0,0 +1,239 @@
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# vcodec values yt-dlp reports for each codec family
+CODEC_FAMILIES = {
+    "h264": ("h264", "avc1", "avc"),
+    "h265": ("h265", "hevc", "hev1", "hvc1", "bytevc1"),
+}
+
+# Quality label in TikTok format IDs such as h264_540p_1234-0
+QUALITY_LABEL = re.compile(r"(?<![0-9])(\d{3,4})p(?![a-z])")
+
+# Request fields that make /download pick a format instead of yt-dlp's best
+TARGET_FIELDS = ("max_height", "max_bytes", "codec", "no_watermark")
+
+
+class FormatTarget:
+    """What a client wants from a download: size and quality limits plus preferences"""
+
+    def __init__(
+        self,
+        max_height: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        codec: Optional[str] = None,
+        no_watermark: bool = False,
+    ):
+        self.max_height = max_height
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.no_watermark = no_watermark
+
+    @classmethod
+    def from_request(cls, data: Dict[str, Any]) -> Optional["FormatTarget"]:
+        """Parse the target fields of a request body; None when it sets none of them"""
+        if all(
+            data.get(field) is None or data.get(field) is False
+            for field in TARGET_FIELDS
+        ):
+            return None
+        for field in ("max_height", "max_bytes"):
+            value = data.get(field)
+            if value is not None and (
+                not isinstance(value, int) or isinstance(value, bool) or value <= 0
+            ):
+                raise ValueError(f"Invalid {field} provided")
+        codec = data.get("codec")
+        if codec is not None and codec not in CODEC_FAMILIES:
+            raise ValueError(
+                f"Invalid codec provided, expected one of: {', '.join(CODEC_FAMILIES)}"
+            )
+        if not isinstance(data.get("no_watermark", False), bool):
+            raise ValueError("Invalid no_watermark provided")
+        return cls(
+            data.get("max_height"),
+            data.get("max_bytes"),
+            codec,
+            data.get("no_watermark", False),
+        )
+
+
+def codec_family(fmt: Dict[str, Any]) -> Optional[str]:
+    """'h264' or 'h265' for a format's video codec, None for anything else"""
+    vcodec = (fmt.get("vcodec") or "").lower()
+    for family, prefixes in CODEC_FAMILIES.items():
+        if vcodec.startswith(prefixes):
+            return family
+    return None
+
+
+def quality_height(fmt: Dict[str, Any]) -> int:
+    """The "p" in 540p: TikTok's own label when the format has one, else the short side"""
+    # TikTok labels 576x1024 variants 540p, so the dimensions alone do not say it
+    label = QUALITY_LABEL.search(
+        f"{fmt.get('format_id') or ''} {fmt.get('format_note') or ''}"
+    )
+    if label:
+        return int(label.group(1))
+    width, height = fmt.get("width") or 0, fmt.get("height") or 0
+    return min(width, height) if width and height else height
+
+
+def is_watermarked(fmt: Dict[str, Any]) -> bool:
+    """TikTok marks its watermarked download variant in the format note"""
+    note = (fmt.get("format_note") or "").lower()
+    return "watermarked" in note
+
+
+def estimated_size(
+    fmt: Dict[str, Any], duration: Optional[float] = None
+) -> Optional[int]:
+    """Bytes a format will take, from its reported size or its bitrate and the duration"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    if fmt.get("tbr") and duration:
+        # tbr is in KBit/s
+        return int(fmt["tbr"] * 1000 / 8 * duration)
+    return None
+
+
+def select_format(
+    formats: Iterable[Dict[str, Any]],
+    target: FormatTarget,
+    duration: Optional[float] = None,
+) -> Optional[Dict[str, Any]]:
+    """Pick the format that best fits a target from an extracted format list.
+
+    Height, size and watermark limits rule formats out. Of the rest, the
+    largest picture wins, then the preferred codec, then an unwatermarked
+    copy, then the smallest file, so a 540p request gets the cheapest 540p
+    variant rather than the largest one. Returns None when nothing fits.
+    """
+    candidates: List[Tuple[Any, ...]] = []
+    for fmt in formats:
+        # Only complete videos: no audio-only, video-only or URL-less entries
+        if (
+            not fmt.get("url")
+            or fmt.get("vcodec") == "none"
+            or fmt.get("acodec") == "none"
+        ):
+            continue
+        height = quality_height(fmt)
+        size = estimated_size(fmt, duration)
+        if target.max_height and (not height or height > target.max_height):
+            continue
+        if target.max_bytes and (size is None or size > target.max_bytes):
+            continue
+        if target.no_watermark and is_watermarked(fmt):
+            continue
+        # Rank by picture size, so a labelled and an unlabelled copy of one rendition tie
+        pixels = (fmt.get("width") or 0) * (fmt.get("height") or 0) or height * height
+        candidates.append(
+            (
+                -pixels,
+                0 if target.codec is None or codec_family(fmt) == target.codec else 1,
+                1 if is_watermarked(fmt) else 0,
+                size if size is not None else float("inf"),
+                len(candidates),
+                fmt,
+            )
+        )
+    if not candidates:
+        return None
+    return min(candidates)[-1]
+
+
+def select_audio_format(
+    formats: Iterable[Dict[str, Any]], duration: Optional[float] = None
+) -> Optional[Dict[str, Any]]:
+    """Smallest format that carries audio and can be fetched with one HTTP request.
+
+    Audio-only formats win over videos with sound, and formats that declare
+    an audio codec win over ones that leave it unknown.
+    """
+    candidates: List[Tuple[Any, ...]] = []
+    for fmt in formats:
+        if not fmt.get("url") or fmt.get("acodec") == "none":
+            continue
+        if fmt.get("protocol") not in (None, "http", "https"):
+            # Segmented (HLS/DASH) formats need yt-dlp to assemble them
+            continue
+        size = estimated_size(fmt, duration)
+        candidates.append(
+            (
+                0 if fmt.get("vcodec") == "none" else 1,
+                0 if fmt.get("acodec") else 1,
+                size if size is not None else float("inf"),
+                len(candidates),
+                fmt,
+            )
+        )
+    if not candidates:
+        return None
+    return min(candidates)[-1]
+
+
+def select_thumbnail(info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The cover image yt-dlp picked, falling back to the last (best) listed thumbnail"""
+    if info.get("thumbnail"):
+        return {"url": info["thumbnail"]}
+    for thumbnail in reversed(info.get("thumbnails") or []):
+        if thumbnail.get("url"):
+            return thumbnail
+    return None
+
+
+# Per-format fields returned by /formats, in response order
+FORMAT_FIELDS = (
+    "format_id",
+    "ext",
+    "width",
+    "height",
+    "fps",
+    "filesize",
+    "tbr",
+    "vbr",
+    "abr",
+    "acodec",
+    "vcodec",
+    "format_note",
+    "quality",
+    "url",
+)
+
+
+def parse_fields(value: Optional[str], default: Iterable[str] = FORMAT_FIELDS) -> tuple:
+    """Fields named in a ?fields= list, in the order given"""
+    if not value:
+        return tuple(default)
+    fields = tuple(
+        dict.fromkeys(field.strip() for field in value.split(",") if field.strip())
+    )
+    unknown = [field for field in fields if field not in FORMAT_FIELDS]
+    if unknown or not fields:
+        raise ValueError(
+            f"Unknown fields: {', '.join(unknown) or value}; "
+            f"choose from {', '.join(FORMAT_FIELDS)}"
+        )
+    return fields
+
+
+def format_rows(
+    formats: Iterable[Dict[str, Any]], fields: Iterable[str], compact: bool = False
+) -> list:
+    """One dict per format; compact rows leave out missing and null fields"""
+    if compact:
+        return [
+            {field: fmt[field] for field in fields if fmt.get(field) is not None}
+            for fmt in formats
+        ]
+    return [{field: fmt.get(field, "N/A") for field in fields} for fmt in formats]
+
+
+def format_columns(
+    formats: Iterable[Dict[str, Any]], fields: Iterable[str]
+) -> Dict[str, list]:
+    """Columnar layout: each field maps to its values across all formats, null where missing"""
+    formats = list(formats)
+    return {field: [fmt.get(field) for fmt in formats] for field in fields}
@@ -0,0 +1,63 @@
+"""gunicorn settings: gunicorn -c gunicorn.conf.py app:app
+
+Runs one worker per CPU by default. Workers share downloads, the video
+store and the metadata database through UPLOAD_FOLDER, and job records
+and metrics through directories set up here before they are forked, so
+any worker can answer for a job another one is running.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+worker_class = "gthread"
+# gthread workers heartbeat from their main loop, so this only restarts a wedged worker;
+# slow requests are bounded by the app's own deadlines (YT_DLP_TIMEOUT, YT_DLP_EXTRACT_TIMEOUT)
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+# Recycle workers now and then; their jobs stay visible through the shared state
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = 100
+# Background threads (janitor, metrics flusher, yt-dlp warm-up) start per worker after fork
+preload_app = True
+
+# Worker-shared state, in a directory private to this server unless configured
+_shared_dir = os.environ.get("SHARED_STATE_DIR") or os.path.join(
+    tempfile.gettempdir(), f"tiktok-downloader-{os.environ.get('PORT', 8080)}"
+)
+if workers > 1:
+    os.environ.setdefault("METRICS_DIR", os.path.join(_shared_dir, "metrics"))
+    os.environ.setdefault("JOB_STATE_DIR", os.path.join(_shared_dir, "jobs"))
+
+
+def on_starting(server):
+    # Metrics of a previous server run would otherwise be merged into this one
+    metrics_dir = os.environ.get("METRICS_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def worker_exit(server, worker):
+    # Write the final counters of a recycled worker so totals never go backwards
+    from monitoring import REGISTRY
+
+    try:
+        REGISTRY.flush()
+    except Exception as e:
+        server.log.warning(f"Final metrics flush failed: {e}")
+
+
+def child_exit(server, worker):
+    # Fold the reaped worker's counters into one file so recycled workers don't pile up
+    from monitoring import REGISTRY
+
+    try:
+        REGISTRY.retire(worker.pid)
+    except Exception as e:
+        server.log.warning(f"Retiring worker metrics failed: {e}")
@@ -0,0 +1,267 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+from store import VideoStore
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None  # type: ignore[assignment]
+
+# Blobs younger than this may not be linked into their download yet
+ORPHAN_GRACE_SECONDS = 60
+
+# SQLite indexes in the store; bounded by their own limits, so they never count towards the quota
+DATABASE_SUFFIXES = (".db", ".db-wal", ".db-shm")
+
+
+def disk_usage(folder: str) -> int:
+    """Bytes used under a folder by files the janitor can evict, counting hardlinked files once"""
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(DATABASE_SUFFIXES):
+                continue
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+class Janitor:
+    """Background eviction of old and least-recently-served downloads.
+
+    A download's directory mtime is its last-served time; /file refreshes
+    it with touch(). Downloads that are being served or are still being
+    written by a job are never evicted. Store blobs are only removed once
+    no download links to them any more. Workers sharing the folder take
+    turns: a pass is skipped while another worker's pass is running.
+    """
+
+    def __init__(
+        self,
+        get_folder: Callable[[], str],
+        max_bytes: int = 0,
+        max_age: int = 0,
+        max_files: int = 0,
+        interval: int = 60,
+        is_busy: Optional[Callable[[str], bool]] = None,
+    ):
+        self.get_folder = get_folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_files = max_files
+        self.interval = interval
+        self.is_busy = is_busy or (lambda download_id: False)
+        self.evictions: Counter = Counter()
+        self.evicted_bytes = 0
+        self.runs = 0
+        self.disk_bytes = 0
+        self._in_use: Counter = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def acquire(self, download_id: str):
+        """Mark a download as being served so it is not evicted"""
+        with self._lock:
+            self._in_use[download_id] += 1
+
+    def release(self, download_id: str):
+        """Mark a served download as finished"""
+        with self._lock:
+            self._in_use[download_id] -= 1
+            if self._in_use[download_id] <= 0:
+                del self._in_use[download_id]
+
+    @staticmethod
+    def touch(download_dir: str):
+        """Record that a download was just served"""
+        try:
+            os.utime(download_dir)
+        except OSError:
+            pass
+
+    def start(self):
+        """Start the background thread once per process"""
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        if not (self.max_bytes or self.max_age or self.max_files):
+            return
+        with self._lock:
+            # Threads do not survive a fork, so gunicorn workers start their own
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._loop, name="downloads-janitor", daemon=True
+            )
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"Downloads janitor failed: {e}")
+
+    def run_once(self) -> Dict[str, int]:
+        """Apply the age, count and size limits once and return evictions by reason"""
+        folder = self.get_folder()
+        if not os.path.isdir(folder):
+            return {}
+        if fcntl is None:
+            return self._run_locked(folder)
+        with open(
+            os.path.join(VideoStore.for_folder(folder).root, "janitor.lock"), "a"
+        ) as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return {}
+            try:
+                return self._run_locked(folder)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run_locked(self, folder: str) -> Dict[str, int]:
+        evicted: Counter = Counter()
+
+        now = time.time()
+        store = VideoStore.for_folder(folder)
+        downloads = self._scan(folder)
+        total_downloads = len(downloads)
+        candidates = [d for d in downloads if not self._busy(d["download_id"])]
+
+        # Expired downloads and unreferenced blobs
+        if self.max_age:
+            for download in [
+                d for d in candidates if now - d["last_used"] > self.max_age
+            ]:
+                self._evict_download(download, "age", evicted)
+                candidates.remove(download)
+                total_downloads -= 1
+            for entry in self._orphans(store):
+                if now - entry["created_at"] > self.max_age:
+                    self._evict_blob(store, entry, "age", evicted)
+
+        # Too many downloads: drop the least recently served
+        if self.max_files:
+            while total_downloads > self.max_files and candidates:
+                self._evict_download(candidates.pop(0), "count", evicted)
+                total_downloads -= 1
+
+        # Over the byte quota: unreferenced blobs go first, then downloads
+        # in least-recently-served order together with blobs they orphan
+        usage = disk_usage(folder)
+        if self.max_bytes:
+            while usage > self.max_bytes:
+                orphans = self._orphans(store)
+                if orphans:
+                    usage -= self._evict_blob(store, orphans[0], "bytes", evicted)
+                elif candidates:
+                    usage -= self._evict_download(candidates.pop(0), "bytes", evicted)
+                else:
+                    logging.warning(
+                        "Downloads folder is over quota but every download is in use"
+                    )
+                    break
+
+        with self._lock:
+            self.runs += 1
+            self.disk_bytes = max(usage, 0)
+        if evicted:
+            logging.info(f"Downloads janitor evicted {dict(evicted)}")
+        return dict(evicted)
+
+    def _busy(self, download_id: str) -> bool:
+        with self._lock:
+            if self._in_use.get(download_id):
+                return True
+        return self.is_busy(download_id)
+
+    @staticmethod
+    def _scan(folder: str) -> List[Dict[str, Any]]:
+        """Download directories ordered from least to most recently served"""
+        downloads = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            # Dot-directories hold the store and lock files
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            downloads.append(
+                {
+                    "download_id": name,
+                    "path": path,
+                    "last_used": os.stat(path).st_mtime,
+                }
+            )
+        return sorted(downloads, key=lambda d: d["last_used"])
+
+    @staticmethod
+    def _orphans(store: VideoStore) -> List[Dict[str, Any]]:
+        """Store blobs no download links to, oldest first"""
+        orphans = []
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        for entry in store.entries():
+            if entry["created_at"] > cutoff:
+                continue
+            try:
+                if os.stat(store.blob_path(entry)).st_nlink <= 1:
+                    orphans.append(entry)
+            except FileNotFoundError:
+                continue
+        return sorted(orphans, key=lambda entry: entry["created_at"])
+
+    def _evict_download(
+        self, download: Dict[str, Any], reason: str, evicted: Counter
+    ) -> int:
+        """Remove a download directory and return the bytes actually freed"""
+        freed = 0
+        for root, _, files in os.walk(download["path"]):
+            for name in files:
+                stat = os.lstat(os.path.join(root, name))
+                # Files still linked from the store keep their space
+                if stat.st_nlink <= 1:
+                    freed += stat.st_size
+        shutil.rmtree(download["path"], ignore_errors=True)
+        self._record(reason, freed, evicted)
+        return freed
+
+    def _evict_blob(
+        self, store: VideoStore, entry: Dict[str, Any], reason: str, evicted: Counter
+    ) -> int:
+        store.discard(entry)
+        self._record(reason, entry["size"], evicted)
+        return entry["size"]
+
+    def _record(self, reason: str, freed: int, evicted: Counter):
+        evicted[reason] += 1
+        with self._lock:
+            self.evictions[reason] += 1
+            self.evicted_bytes += freed
+
+    def metrics(self) -> Dict[str, Any]:
+        """Eviction counters for the /metrics endpoint"""
+        with self._lock:
+            metrics = {
+                "evictions_total": sum(self.evictions.values()),
+                "evicted_bytes_total": self.evicted_bytes,
+                "runs_total": self.runs,
+                "disk_bytes": self.disk_bytes,
+                "in_use": len(self._in_use),
+            }
+            for reason in ("age", "count", "bytes"):
+                metrics[f"evictions_{reason}_total"] = self.evictions[reason]
+            return metrics
@@ -0,0 +1,330 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue cannot accept more work"""
+
+
+class OwnerLimitError(QueueFullError):
+    """Raised when one owner already has as many active jobs as allowed"""
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+class JobQueue:
+    """Bounded background worker pool for long-running download jobs.
+
+    Jobs run in the process that accepted them. With a state directory
+    shared by all gunicorn workers, every job is also written there, so
+    /jobs and /progress answer from whichever worker gets the request.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_pending: int = 32,
+        retention: int = 3600,
+        listener: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        max_per_owner: int = 0,
+        state_dir: Optional[str] = None,
+        state_interval: float = 1.0,
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retention = retention
+        # Active jobs one owner (client) may hold at once, 0 for no limit
+        self.max_per_owner = max_per_owner
+        # Called with a snapshot whenever a job's state or progress changes
+        self.listener = listener
+        # Progress reaches the state directory at most once per state_interval
+        self.state_dir = state_dir
+        self.state_interval = state_interval
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        self._persisted: Dict[str, float] = {}
+        # Result fields added while a job was still running, merged in when it finishes
+        self._late_results: Dict[str, Dict[str, Any]] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="download-job"
+        )
+        # Slots cover both running and queued jobs so the backlog stays bounded
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        job_id: str,
+        func: Callable[..., Dict[str, Any]],
+        *args,
+        owner: Optional[str] = None,
+        **kwargs,
+    ) -> Optional[Dict[str, Any]]:
+        """Queue a job; func receives a progress hook as its first argument"""
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError("Download queue is full, please retry later")
+
+        self._prune()
+        job = {
+            "download_id": job_id,
+            "owner": owner,
+            "status": "queued",
+            "progress": {
+                "downloaded_bytes": 0,
+                "total_bytes": None,
+                "percent": 0.0,
+                "speed": None,
+                "eta": None,
+            },
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        with self._lock:
+            if (
+                owner is not None
+                and self.max_per_owner
+                and self._count_active(owner) >= self.max_per_owner
+            ):
+                self._slots.release()
+                raise OwnerLimitError(
+                    "Too many downloads in progress, please retry later"
+                )
+            self._jobs[job_id] = job
+        self._persist(job_id)
+        self._notify(job_id)
+
+        try:
+            self._executor.submit(self._run, job_id, func, args, kwargs)
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            self._remove_state(job_id)
+            raise
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return a snapshot of a job, or None if it is unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                snapshot = dict(job)
+                snapshot["progress"] = dict(job["progress"])
+                return snapshot
+        return self._load_state(job_id)
+
+    def update_result(self, job_id: str, **fields):
+        """Merge fields into a job's result, for work that carries on after the job itself"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if job["result"] is None:
+                self._late_results.setdefault(job_id, {}).update(fields)
+                return
+            job["result"] = {**job["result"], **fields}
+            job["updated"] = time.time()
+        self._persist(job_id)
+        self._notify(job_id)
+
+    def is_local(self, job_id: str) -> bool:
+        """Whether this process runs the job, so its updates arrive without polling"""
+        with self._lock:
+            return job_id in self._jobs
+
+    def is_active(self, job_id: str) -> bool:
+        """Whether a job is still queued or running"""
+        job = self.get(job_id)
+        return job is not None and job["status"] in ("queued", "running")
+
+    def _count_active(self, owner: str) -> int:
+        """Queued or running jobs of an owner; called with the lock held"""
+        return sum(
+            1
+            for job in self._jobs.values()
+            if job["owner"] == owner and job["status"] in ("queued", "running")
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """Count jobs by status"""
+        counts = {"queued": 0, "running": 0, "finished": 0, "failed": 0}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return counts
+
+    def progress_hook(self, job_id: str) -> Callable[[Dict[str, Any]], None]:
+        """Build a yt-dlp progress hook that updates the job record"""
+
+        def hook(status: Dict[str, Any]):
+            downloaded = status.get("downloaded_bytes") or 0
+            total = status.get("total_bytes") or status.get("total_bytes_estimate")
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return
+                job["progress"]["downloaded_bytes"] = downloaded
+                job["progress"]["total_bytes"] = total
+                job["progress"]["speed"] = status.get("speed")
+                job["progress"]["eta"] = status.get("eta")
+                if status.get("status") == "finished":
+                    job["progress"]["percent"] = 100.0
+                elif total:
+                    job["progress"]["percent"] = round(downloaded * 100.0 / total, 1)
+            if time.time() - self._persisted.get(job_id, 0) >= self.state_interval:
+                self._persist(job_id)
+            self._notify(job_id)
+
+        return hook
+
+    def _run(self, job_id: str, func: Callable[..., Dict[str, Any]], args, kwargs):
+        self._update(
+            job_id, status="running", started_at=datetime.now(timezone.utc).isoformat()
+        )
+        try:
+            result = func(self.progress_hook(job_id), *args, **kwargs)
+            with self._lock:
+                result = {**result, **self._late_results.pop(job_id, {})}
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job.update(
+                        status="finished",
+                        result=result,
+                        finished_at=datetime.now(timezone.utc).isoformat(),
+                        updated=time.time(),
+                    )
+            self._persist(job_id)
+            self._notify(job_id)
+        except Exception as e:
+            with self._lock:
+                self._late_results.pop(job_id, None)
+            logging.error(f"Download job {job_id} failed: {e}")
+            self._update(
+                job_id,
+                status="failed",
+                error=f"Download failed: {str(e)}",
+                finished_at=datetime.now(timezone.utc).isoformat(),
+            )
+        finally:
+            self._slots.release()
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+                job["updated"] = time.time()
+        self._persist(job_id)
+        self._notify(job_id)
+
+    def _state_path(self, job_id: str) -> Optional[str]:
+        # Job IDs are generated UUIDs, but /jobs passes them through from the URL
+        if (
+            not self.state_dir
+            or not job_id
+            or os.path.basename(job_id) != job_id
+            or job_id.startswith(".")
+        ):
+            return None
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def _persist(self, job_id: str):
+        """Write a job's snapshot to the state directory for other workers"""
+        path = self._state_path(job_id)
+        if path is None:
+            return
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            state = {**job, "progress": dict(job["progress"]), "pid": os.getpid()}
+            self._persisted[job_id] = time.time()
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write job state for {job_id}: {e}")
+
+    def _load_state(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """A job run by another worker, from the state directory"""
+        path = self._state_path(job_id)
+        if path is None:
+            return None
+        try:
+            with open(path, "r") as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job["status"] in ("queued", "running") and not _pid_alive(
+            job.pop("pid", 0) or 0
+        ):
+            # The worker running it exited (restart, crash or max_requests)
+            job.update(
+                status="failed",
+                error="Download failed: worker exited before the download finished",
+            )
+        job.pop("pid", None)
+        return job
+
+    def _remove_state(self, job_id: str):
+        path = self._state_path(job_id)
+        self._persisted.pop(job_id, None)
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _notify(self, job_id: str):
+        if self.listener is None:
+            return
+        snapshot = self.get(job_id)
+        if snapshot is not None:
+            try:
+                self.listener(job_id, snapshot)
+            except Exception as e:
+                logging.warning(f"Job listener failed for {job_id}: {e}")
+
+    def _prune(self):
+        """Forget finished jobs older than the retention window"""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job["status"] in ("finished", "failed")
+                and job.get("updated", cutoff) < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+        for job_id in expired:
+            self._remove_state(job_id)
+        if self.state_dir:
+            # Jobs of workers that have exited are only ever removed here
+            for name in os.listdir(self.state_dir):
+                path = os.path.join(self.state_dir, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    continue
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, Optional
+
+# SQLite's default limit on bound parameters per statement
+_MAX_VARIABLES = 900
+
+# Rows written between prunes of expired entries
+_PRUNE_EVERY = 1000
+
+
+class MetadataStore:
+    """Persistent store of extracted info dicts keyed by video ID.
+
+    Backs the in-memory metadata cache so restarted or recycled workers
+    start warm. The database runs in WAL mode, letting every worker read
+    while one writes; each thread keeps its own connection.
+    """
+
+    _instances: Dict[str, "MetadataStore"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str, freshness: float = 21600, max_age: float = 7 * 86400):
+        self.path = path
+        self.freshness = freshness
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connect()
+
+    @classmethod
+    def for_path(
+        cls, path: str, freshness: float = 21600, max_age: float = 7 * 86400
+    ) -> "MetadataStore":
+        """Get the shared store for a database file"""
+        path = os.path.abspath(path)
+        with cls._instances_lock:
+            store = cls._instances.get(path)
+            if store is None:
+                store = cls._instances[path] = cls(path, freshness, max_age)
+            return store
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not os.path.exists(self.path):
+            # The database was deleted underneath us (e.g. by /cleanup)
+            conn.close()
+            conn = None
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS videos ("
+                    "video_id TEXT PRIMARY KEY, info BLOB NOT NULL, extracted_at REAL NOT NULL)"
+                )
+            self._local.conn = conn
+        return conn
+
+    def get(
+        self, video_id: str, freshness: Optional[float] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Return a stored info dict extracted within the freshness window"""
+        entry = self.get_entry(video_id, freshness)
+        return entry["info"] if entry is not None else None
+
+    def get_entry(
+        self, video_id: str, freshness: Optional[float] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Like get, but returns {'info', 'extracted_at'}"""
+        freshness = self.freshness if freshness is None else freshness
+        row = (
+            self._connect()
+            .execute(
+                "SELECT info, extracted_at FROM videos WHERE video_id = ? AND extracted_at >= ?",
+                (str(video_id), time.time() - freshness),
+            )
+            .fetchone()
+        )
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        info = self._decode(row[0])
+        return {"info": info, "extracted_at": row[1]} if info is not None else None
+
+    def get_many(
+        self, video_ids: Iterable[str], freshness: Optional[float] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """Look up many videos at once, returning {video_id: {'info', 'extracted_at'}}"""
+        video_ids = list(dict.fromkeys(str(video_id) for video_id in video_ids))
+        cutoff = time.time() - freshness if freshness is not None else 0
+        conn = self._connect()
+        results = {}
+        for start in range(0, len(video_ids), _MAX_VARIABLES):
+            chunk = video_ids[start : start + _MAX_VARIABLES]
+            rows = conn.execute(
+                f"SELECT video_id, info, extracted_at FROM videos "
+                f"WHERE video_id IN ({','.join('?' * len(chunk))}) AND extracted_at >= ?",
+                (*chunk, cutoff),
+            )
+            for video_id, info, extracted_at in rows:
+                results[video_id] = {
+                    "info": self._decode(info),
+                    "extracted_at": extracted_at,
+                }
+        return results
+
+    def put(self, video_id: str, info: Dict[str, Any]):
+        """Store an info dict as extracted now"""
+        # yt-dlp info dicts are JSON apart from the odd non-serializable value
+        blob = zlib.compress(json.dumps(info, default=str).encode("utf-8"))
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO videos (video_id, info, extracted_at) VALUES (?, ?, ?)",
+                (str(video_id), blob, time.time()),
+            )
+        with self._lock:
+            self.writes += 1
+            prune = self.writes % _PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def prune(self) -> int:
+        """Delete entries older than max_age and return how many were removed"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM videos WHERE extracted_at < ?",
+                (time.time() - self.max_age,),
+            )
+        return cursor.rowcount
+
+    def clear(self):
+        """Delete every stored entry"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM videos")
+
+    @staticmethod
+    def _decode(blob: bytes) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(zlib.decompress(blob))
+        except (zlib.error, ValueError) as e:
+            logging.warning(f"Could not decode stored metadata: {e}")
+            return None
+
+    def metrics(self) -> Dict[str, Any]:
+        """Store counters for the /metrics endpoint"""
+        rows = self._connect().execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+        with self._lock:
+            return {
+                "hits_total": self.hits,
+                "misses_total": self.misses,
+                "writes_total": self.writes,
+                "rows": rows,
+            }
@@ -1,49 +1,496 @@
-import logging
-import time
 import functools
-from typing import Dict, Any, Optional
-from flask import request, g, jsonify
-import psutil
+import glob
+import json
+import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import psutil
+from flask import g, jsonify, make_response, request
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None  # type: ignore[assignment]
+
+# Histogram buckets in seconds, from fast cache hits up to long downloads
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+
+class _Metric:
+    """Base class for labelled metrics"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Serializable state used to aggregate across worker processes"""
+        with self._lock:
+            return {
+                "kind": self.kind,
+                "documentation": self.documentation,
+                "labelnames": list(self.labelnames),
+                "values": [[list(key), value] for key, value in self._values.items()],
+            }
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Cumulative histogram of observations"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Per-bucket counts followed by sum and count
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+
+class MetricsRegistry:
+    """Process-local metrics, optionally shared between gunicorn workers.
+
+    With a metrics directory configured each worker periodically writes
+    its snapshot to metrics_<pid>.json there, and a scrape of any worker
+    merges every snapshot. Counters and histograms of workers that have
+    exited are kept so totals never go backwards, folded into
+    retired.json once the worker is reaped; gauges only count live
+    workers. Values of registered providers are part of the snapshot:
+    keys ending in _total are counters, the rest gauges. Gauges that
+    describe state shared by every worker are merged with max.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.flush_interval = 5
+        self._metrics: Dict[str, _Metric] = {}
+        self._providers: List[
+            Tuple[str, Callable[[], Dict[str, Any]], Tuple[str, ...]]
+        ] = []
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def _register(self, metric_class, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            return metric
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Iterable[str] = ()
+    ) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Iterable[str] = ()
+    ) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def register_provider(
+        self,
+        prefix: str,
+        provider: Callable[[], Dict[str, Any]],
+        shared: Iterable[str] = (),
+    ):
+        """Export the numeric values a callable returns as app_<prefix>_<key>.
+
+        Keys in shared describe state every worker sees, such as the
+        files on disk, and are merged with max instead of summed.
+        """
+        with self._lock:
+            self._providers.append((prefix, provider, tuple(shared)))
+
+    def configure(self, directory: Optional[str] = None, flush_interval: int = 5):
+        """Share metrics through a directory visible to every worker"""
+        self.directory = directory
+        self.flush_interval = flush_interval
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            providers = list(self._providers)
+        snapshot = {metric.name: metric.snapshot() for metric in metrics}
+        for prefix, provider, shared in providers:
+            try:
+                values = provider()
+            except Exception as e:
+                logging.warning(f"Metrics provider {prefix} failed: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                snapshot[f"app_{prefix}_{key}"] = {
+                    "kind": "counter" if key.endswith("_total") else "gauge",
+                    "documentation": f"{key.replace('_', ' ').capitalize()} ({prefix})",
+                    "labelnames": [],
+                    "values": [[[], value]],
+                }
+                if key in shared:
+                    snapshot[f"app_{prefix}_{key}"]["merge"] = "max"
+        return snapshot
+
+    def flush(self):
+        """Write this worker's snapshot for other workers to merge"""
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"metrics_{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_flusher(self):
+        """Flush in the background once per worker process"""
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+
+        def loop():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.error(f"Metrics flush failed: {e}")
+
+        threading.Thread(target=loop, name="metrics-flusher", daemon=True).start()
+
+    @contextmanager
+    def _directory_lock(self, exclusive: bool) -> Iterator[None]:
+        """Keep scrapes from reading a worker's counters both before and after they are retired"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, "metrics.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def collect(self) -> Dict[str, Any]:
+        """Merged metrics across all workers sharing the directory"""
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        snapshots = []
+        with self._directory_lock(exclusive=False):
+            retired = self._load(os.path.join(self.directory, "retired.json"))
+            if retired is not None:
+                snapshots.append((False, retired))
+            for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+                try:
+                    pid = int(os.path.basename(path)[len("metrics_") : -len(".json")])
+                except ValueError:
+                    continue
+                snapshot = self._load(path)
+                if snapshot is not None:
+                    snapshots.append((_pid_alive(pid), snapshot))
+        return _merge_snapshots(snapshots)
+
+    def retire(self, pid: int):
+        """Fold the counters of an exited worker into retired.json and drop its file.
+
+        Called by the gunicorn master once it has reaped the worker, so a
+        recycled worker leaves no file behind and a new worker reusing
+        its PID starts from zero.
+        """
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"metrics_{pid}.json")
+        retired_path = os.path.join(self.directory, "retired.json")
+        with self._directory_lock(exclusive=True):
+            snapshot = self._load(path)
+            if snapshot is None:
+                return
+            snapshots = [(False, snapshot)]
+            retired = self._load(retired_path)
+            if retired is not None:
+                snapshots.append((False, retired))
+            tmp_path = f"{retired_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(_merge_snapshots(snapshots), f)
+            os.replace(tmp_path, retired_path)
+            os.remove(path)
+
+    def render(self) -> List[str]:
+        """Prometheus text exposition lines"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['documentation']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            labelnames = metric["labelnames"]
+            for labelvalues, value in metric["values"]:
+                labels = list(zip(labelnames, labelvalues))
+                if metric["kind"] != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"], value):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels + [('le', repr(float(bound)))])} {cumulative}"
+                    )
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels + [('le', '+Inf')])} {value[-1]}"
+                )
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+        return lines
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _merge_snapshots(snapshots: List[Tuple[bool, Dict[str, Any]]]) -> Dict[str, Any]:
+    merged: Dict[str, Any] = {}
+    for alive, snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if metric["kind"] == "gauge" and not alive:
+                continue
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for labelvalues, value in metric["values"]:
+                key = tuple(labelvalues)
+                if metric["kind"] == "histogram":
+                    current = target["values"].get(key)
+                    target["values"][key] = (
+                        value
+                        if current is None
+                        else [a + b for a, b in zip(current, value)]
+                    )
+                elif metric.get("merge") == "max":
+                    target["values"][key] = max(target["values"].get(key, value), value)
+                else:
+                    target["values"][key] = target["values"].get(key, 0) + value
+    for metric in merged.values():
+        metric["values"] = [
+            [list(key), value] for key, value in metric["values"].items()
+        ]
+    return merged
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, value in labels
+    )
+    return (
+        "{"
+        + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped))
+        + "}"
+    )
+
+
+# Shared registry and the standard application metrics
+REGISTRY = MetricsRegistry()
+REQUEST_COUNT = REGISTRY.counter(
+    "app_http_requests_total",
+    "HTTP requests by method, endpoint and status",
+    ("method", "endpoint", "status"),
+)
+REQUEST_LATENCY = REGISTRY.histogram(
+    "app_http_request_duration_seconds",
+    "Time spent in the request handler",
+    ("method", "endpoint"),
+)
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "app_http_requests_in_flight", "Requests currently being handled"
+)
+YTDLP_EXTRACTION_SECONDS = REGISTRY.histogram(
+    "app_ytdlp_extraction_duration_seconds", "yt-dlp metadata extraction time"
+)
+YTDLP_DOWNLOAD_SECONDS = REGISTRY.histogram(
+    "app_ytdlp_download_duration_seconds", "yt-dlp download time"
+)
+FILE_SERVE_SECONDS = REGISTRY.histogram(
+    "app_file_serve_duration_seconds", "Time to send a downloaded file to the client"
+)
+
+# Prime psutil so later cpu_percent(interval=None) calls return a real value
+psutil.cpu_percent(interval=None)
+
 
 class PerformanceMonitor:
     """Performance monitoring utilities"""
-    
+
     @staticmethod
     def get_system_metrics() -> Dict[str, Any]:
         """Get current system metrics"""
         try:
             return {
-                'cpu_percent': psutil.cpu_percent(interval=1),
-                'memory_percent': psutil.virtual_memory().percent,
-                'memory_available_mb': psutil.virtual_memory().available / (1024 * 1024),
-                'disk_usage_percent': psutil.disk_usage('/').percent,
-                'timestamp': datetime.utcnow().isoformat()
+                # Non-blocking: CPU usage since the previous call
+                "cpu_percent": psutil.cpu_percent(interval=None),
+                "memory_percent": psutil.virtual_memory().percent,
+                "memory_available_mb": psutil.virtual_memory().available
+                / (1024 * 1024),
+                "disk_usage_percent": psutil.disk_usage("/").percent,
+                "timestamp": datetime.utcnow().isoformat(),
             }
         except Exception as e:
             logging.error(f"Error getting system metrics: {e}")
-            return {'error': str(e)}
-    
+            return {"error": str(e)}
+
+    @staticmethod
+    def get_startup_metrics() -> Dict[str, Any]:
+        """Time since this process started and its memory use, taken once the app is ready"""
+        process = psutil.Process()
+        return {
+            "seconds": round(time.time() - process.create_time(), 3),
+            "rss_bytes": process.memory_info().rss,
+        }
+
     @staticmethod
     def log_request_metrics():
-        """Log request performance metrics"""
+        """Log request performance metrics and record them in the metrics registry"""
+
         def decorator(f):
             @functools.wraps(f)
             def wrapper(*args, **kwargs):
                 start_time = time.time()
                 g.start_time = start_time
-                
+                endpoint = request.url_rule.rule if request.url_rule else request.path
+                status_code = 500
+                REQUESTS_IN_FLIGHT.inc()
+
                 try:
-                    result = f(*args, **kwargs)
-                    status_code = getattr(result, 'status_code', 200)
+                    result = make_response(f(*args, **kwargs))
+                    status_code = result.status_code
                 except Exception as e:
                     status_code = 500
                     logging.error(f"Request failed: {e}")
                     raise
                 finally:
                     duration = time.time() - start_time
-                    
+                    REQUESTS_IN_FLIGHT.dec()
+                    REQUEST_COUNT.inc(
+                        method=request.method, endpoint=endpoint, status=status_code
+                    )
+                    REQUEST_LATENCY.observe(
+                        duration, method=request.method, endpoint=endpoint
+                    )
+
                     # Log request metrics
                     logging.info(
                         f"Request: {request.method} {request.path} - "
@@ -51,186 +498,231 @@ class PerformanceMonitor:
                         f"Duration: {duration:.3f}s - "
                         f"IP: {request.remote_addr}"
                     )
-                    
+
                     # Log slow requests
                     if duration > 5.0:  # 5 seconds threshold
                         logging.warning(
                             f"Slow request detected: {request.method} {request.path} - "
                             f"Duration: {duration:.3f}s"
                         )
-                
+
                 return result
+
             return wrapper
+
         return decorator
 
+    @staticmethod
+    def instrument_app(app, exclude: Iterable[str] = ("static",)):
+        """Wrap every registered view with log_request_metrics"""
+        for endpoint, view in list(app.view_functions.items()):
+            if endpoint not in exclude:
+                app.view_functions[endpoint] = PerformanceMonitor.log_request_metrics()(
+                    view
+                )
+
+
 class StructuredLogger:
     """Structured logging for better observability"""
-    
+
     def __init__(self, name: str):
         self.logger = logging.getLogger(name)
-    
+
     def log_download_start(self, url: str, download_id: str, user_ip: str):
         """Log download start event"""
         self.logger.info(
             "Download started",
             extra={
-                'event_type': 'download_start',
-                'download_id': download_id,
-                'url': url,
-                'user_ip': user_ip,
-                'timestamp': datetime.utcnow().isoformat()
-            }
+                "event_type": "download_start",
+                "download_id": download_id,
+                "url": url,
+                "user_ip": user_ip,
+                "timestamp": datetime.utcnow().isoformat(),
+            },
         )
-    
+
     def log_download_success(self, download_id: str, file_size: int, duration: float):
         """Log successful download"""
         self.logger.info(
             "Download completed successfully",
             extra={
-                'event_type': 'download_success',
-                'download_id': download_id,
-                'file_size_bytes': file_size,
-                'duration_seconds': duration,
-                'timestamp': datetime.utcnow().isoformat()
-            }
+                "event_type": "download_success",
+                "download_id": download_id,
+                "file_size_bytes": file_size,
+                "duration_seconds": duration,
+                "timestamp": datetime.utcnow().isoformat(),
+            },
         )
-    
+
     def log_download_error(self, download_id: str, error: str, duration: float):
         """Log download error"""
         self.logger.error(
             "Download failed",
             extra={
-                'event_type': 'download_error',
-                'download_id': download_id,
-                'error': error,
-                'duration_seconds': duration,
-                'timestamp': datetime.utcnow().isoformat()
-            }
+                "event_type": "download_error",
+                "download_id": download_id,
+                "error": error,
+                "duration_seconds": duration,
+                "timestamp": datetime.utcnow().isoformat(),
+            },
         )
-    
+
     def log_security_event(self, event_type: str, details: Dict[str, Any]):
         """Log security-related events"""
         self.logger.warning(
             f"Security event: {event_type}",
             extra={
-                'event_type': 'security_event',
-                'security_event_type': event_type,
-                'details': details,
-                'user_ip': request.remote_addr if request else 'unknown',
-                'timestamp': datetime.utcnow().isoformat()
-            }
+                "event_type": "security_event",
+                "security_event_type": event_type,
+                "details": details,
+                "user_ip": request.remote_addr if request else "unknown",
+                "timestamp": datetime.utcnow().isoformat(),
+            },
         )
 
-def setup_logging(log_level: str = 'INFO', log_format: str = None):
+
+def setup_logging(log_level: str = "INFO", log_format: str = None):
     """Setup application logging"""
     if log_format is None:
-        log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    
+        log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
     # Configure root logger
     logging.basicConfig(
         level=getattr(logging, log_level.upper()),
         format=log_format,
         handlers=[
             logging.StreamHandler(),  # Console output for Cloud Run
-        ]
+        ],
     )
-    
+
     # Set specific log levels for noisy libraries
-    logging.getLogger('urllib3').setLevel(logging.WARNING)
-    logging.getLogger('requests').setLevel(logging.WARNING)
-    logging.getLogger('yt_dlp').setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logging.getLogger("yt_dlp").setLevel(logging.WARNING)
+
+
+def register_metrics_provider(prefix: str, provider, shared: Iterable[str] = ()):
+    """Register a callable whose numeric values are exported on /metrics, summed across workers
+    except for the shared keys, which are merged with max"""
+    REGISTRY.register_provider(prefix, provider, shared)
+
+
+def create_metrics_endpoint(app):
+    """Create Prometheus-style metrics endpoint"""
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Prometheus-style metrics endpoint"""
+        try:
+            metrics_data = PerformanceMonitor.get_system_metrics()
+
+            # Convert to Prometheus format
+            prometheus_metrics = []
+            for key, value in metrics_data.items():
+                if isinstance(value, (int, float)):
+                    prometheus_metrics.append(f"app_{key} {value}")
+
+            prometheus_metrics.extend(REGISTRY.render())
+
+            return (
+                "\n".join(prometheus_metrics),
+                200,
+                {"Content-Type": "text/plain; charset=utf-8"},
+            )
+
+        except Exception as e:
+            logging.error(f"Metrics endpoint failed: {e}")
+            return f"# Error: {e}", 500, {"Content-Type": "text/plain"}
+
 
 def create_health_check_endpoint(app):
     """Create comprehensive health check endpoint"""
-    
-    @app.route('/health', methods=['GET'])
+
+    @app.route("/health", methods=["GET"])
     def health_check():
         """Comprehensive health check"""
         try:
             # Basic health check
             health_status = {
-                'status': 'healthy',
-                'timestamp': datetime.utcnow().isoformat(),
-                'version': '1.0.0'
+                "status": "healthy",
+                "timestamp": datetime.utcnow().isoformat(),
+                "version": "1.0.0",
             }
-            
+
             # Add system metrics if requested
-            if request.args.get('detailed') == 'true':
-                health_status['system_metrics'] = PerformanceMonitor.get_system_metrics()
-                
+            if request.args.get("detailed") == "true":
+                health_status["system_metrics"] = (
+                    PerformanceMonitor.get_system_metrics()
+                )
+
                 # Check disk space
-                downloads_dir = app.config.get('UPLOAD_FOLDER', 'downloads')
+                downloads_dir = app.config.get("UPLOAD_FOLDER", "downloads")
                 if os.path.exists(downloads_dir):
                     disk_usage = psutil.disk_usage(downloads_dir)
-                    health_status['disk_space'] = {
-                        'total_gb': disk_usage.total / (1024**3),
-                        'used_gb': disk_usage.used / (1024**3),
-                        'free_gb': disk_usage.free / (1024**3),
-                        'percent_used': (disk_usage.used / disk_usage.total) * 100
+                    health_status["disk_space"] = {
+                        "total_gb": disk_usage.total / (1024**3),
+                        "used_gb": disk_usage.used / (1024**3),
+                        "free_gb": disk_usage.free / (1024**3),
+                        "percent_used": (disk_usage.used / disk_usage.total) * 100,
                     }
-            
+
             return jsonify(health_status), 200
-            
+
         except Exception as e:
             logging.error(f"Health check failed: {e}")
-            return jsonify({
-                'status': 'unhealthy',
-                'error': str(e),
-                'timestamp': datetime.utcnow().isoformat()
-            }), 503
-    
-    @app.route('/metrics', methods=['GET'])
-    def metrics():
-        """Prometheus-style metrics endpoint"""
-        try:
-            metrics_data = PerformanceMonitor.get_system_metrics()
-            
-            # Convert to Prometheus format
-            prometheus_metrics = []
-            for key, value in metrics_data.items():
-                if isinstance(value, (int, float)):
-                    prometheus_metrics.append(f"app_{key} {value}")
-            
-            return '\n'.join(prometheus_metrics), 200, {'Content-Type': 'text/plain'}
-            
-        except Exception as e:
-            logging.error(f"Metrics endpoint failed: {e}")
-            return f"# Error: {e}", 500, {'Content-Type': 'text/plain'}
+            return (
+                jsonify(
+                    {
+                        "status": "unhealthy",
+                        "error": str(e),
+                        "timestamp": datetime.utcnow().isoformat(),
+                    }
+                ),
+                503,
+            )
+
+    create_metrics_endpoint(app)
+
 
 def add_security_headers(app):
     """Add security headers to all responses"""
-    
+
     @app.after_request
     def set_security_headers(response):
-        security_headers = app.config.get('SECURITY_HEADERS', {})
+        security_headers = app.config.get("SECURITY_HEADERS", {})
         for header, value in security_headers.items():
             response.headers[header] = value
         return response
 
+
 def setup_error_handlers(app):
     """Setup comprehensive error handling"""
-    
+
     @app.errorhandler(404)
     def not_found(error):
         logging.warning(f"404 error: {request.url} - IP: {request.remote_addr}")
-        return jsonify({'error': 'Endpoint not found'}), 404
-    
+        return jsonify({"error": "Endpoint not found"}), 404
+
     @app.errorhandler(405)
     def method_not_allowed(error):
-        logging.warning(f"405 error: {request.method} {request.url} - IP: {request.remote_addr}")
-        return jsonify({'error': 'Method not allowed'}), 405
-    
+        logging.warning(
+            f"405 error: {request.method} {request.url} - IP: {request.remote_addr}"
+        )
+        return jsonify({"error": "Method not allowed"}), 405
+
     @app.errorhandler(413)
     def request_entity_too_large(error):
         logging.warning(f"413 error: Request too large - IP: {request.remote_addr}")
-        return jsonify({'error': 'Request entity too large'}), 413
-    
+        return jsonify({"error": "Request entity too large"}), 413
+
     @app.errorhandler(429)
     def ratelimit_handler(error):
         logging.warning(f"Rate limit exceeded - IP: {request.remote_addr}")
-        return jsonify({'error': 'Rate limit exceeded'}), 429
-    
+        return jsonify({"error": "Rate limit exceeded"}), 429
+
     @app.errorhandler(500)
     def internal_error(error):
-        logging.error(f"500 error: {error} - URL: {request.url} - IP: {request.remote_addr}")
-        return jsonify({'error': 'Internal server error'}), 500
\ No newline at end of file
+        logging.error(
+            f"500 error: {error} - URL: {request.url} - IP: {request.remote_addr}"
+        )
+        return jsonify({"error": "Internal server error"}), 500
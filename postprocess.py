@@ -0,0 +1,163 @@
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from monitoring import REGISTRY
+
+POSTPROCESS_SECONDS = REGISTRY.histogram(
+    "app_postprocess_seconds", "Time spent running ffmpeg on a download", ("preset",)
+)
+
+# ffmpeg output options per preset; every output puts the moov box first
+PRESETS = {
+    # Lossless: copy the streams and move the index to the front of the file
+    "faststart": ["-map", "0", "-c", "copy", "-movflags", "+faststart"],
+    # Short side scaled down to 480 (TikTok videos are portrait), never up
+    "480p": [
+        "-vf",
+        "scale='if(gt(iw,ih),-2,min(480,iw))':'if(gt(iw,ih),min(480,ih),-2)'",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "veryfast",
+        "-crf",
+        "28",
+        "-maxrate",
+        "800k",
+        "-bufsize",
+        "1600k",
+        "-pix_fmt",
+        "yuv420p",
+        "-c:a",
+        "aac",
+        "-b:a",
+        "96k",
+        "-movflags",
+        "+faststart",
+    ],
+}
+
+# Containers faststart applies to
+FASTSTART_EXTS = ("mp4", "m4a", "m4v", "mov")
+
+
+def needs_faststart(path: str) -> bool:
+    """Whether an MP4's media data comes before its moov box, so players must read to the end first"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box = struct.unpack(">I4s", header)
+            if box == b"moov":
+                return False
+            if box == b"mdat":
+                return True
+            if size == 1:
+                # 64-bit size follows the box type
+                size = struct.unpack(">Q", f.read(8))[0] - 8
+            elif size < 8:
+                # Box runs to the end of the file, or the file is not an MP4
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+
+
+def output_ext(preset: str, ext: str) -> str:
+    """Extension of a preset's output for a source file extension"""
+    return ext if preset == "faststart" else "mp4"
+
+
+class PostProcessor:
+    """Runs ffmpeg presets on downloaded files in the background, a few at a time.
+
+    Post-processing tasks go to a small thread pool, off the download
+    workers. Each run is an ffmpeg child process, so the encoding work
+    never holds the GIL of the worker; the pool only bounds how many run
+    at once. Without an ffmpeg binary the processor is unavailable and
+    callers skip the stage.
+    """
+
+    def __init__(
+        self, max_workers: int = 2, timeout: int = 600, ffmpeg: Optional[str] = None
+    ):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.runs: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.skipped = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self.ffmpeg is not None and self.max_workers > 0
+
+    def submit(self, func: Callable[..., Any], *args) -> Future:
+        """Run a post-processing task on the pool; it calls process() for each preset"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="postprocess"
+                )
+            executor = self._executor
+        return executor.submit(func, *args)
+
+    def process(self, src_path: str, dest_path: str, preset: str) -> bool:
+        """Write a preset's output to dest_path; False when the source already fits the preset"""
+        if preset == "faststart" and not needs_faststart(src_path):
+            with self._lock:
+                self.skipped += 1
+            return False
+        if self.ffmpeg is None:
+            raise RuntimeError("ffmpeg is not installed")
+        # Written under a temporary name so a failed run never leaves a truncated output
+        root, ext = os.path.splitext(dest_path)
+        tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.part{ext}"
+        command = [
+            self.ffmpeg,
+            "-nostdin",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-y",
+            "-i",
+            src_path,
+            *PRESETS[preset],
+            tmp_path,
+        ]
+        started = time.perf_counter()
+        try:
+            result = subprocess.run(command, capture_output=True, timeout=self.timeout)
+            if result.returncode != 0:
+                raise RuntimeError(
+                    result.stderr.decode("utf-8", "replace").strip()[-500:]
+                    or f"ffmpeg exited with {result.returncode}"
+                )
+            os.replace(tmp_path, dest_path)
+        except Exception:
+            with self._lock:
+                self.failures[preset] += 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        POSTPROCESS_SECONDS.observe(time.perf_counter() - started, preset=preset)
+        with self._lock:
+            self.runs[preset] += 1
+        return True
+
+    def metrics(self) -> Dict[str, Any]:
+        """Post-processing counters for the /metrics endpoint"""
+        with self._lock:
+            return {
+                "available": int(self.available),
+                "runs_total": sum(self.runs.values()),
+                "failures_total": sum(self.failures.values()),
+                "skipped_total": self.skipped,
+            }
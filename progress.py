@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Job states after which a channel receives no more events
+FINAL_STATES = ("finished", "failed")
+
+
+class _Channel:
+    """Latest event of one download plus the subscribers waiting for the next"""
+
+    __slots__ = ("version", "event", "notified_at", "closed_at", "condition", "futures")
+
+    def __init__(self, lock: threading.Lock):
+        self.version = 0
+        self.event: Dict[str, Any] = {}
+        self.notified_at = 0.0
+        self.closed_at: Optional[float] = None
+        self.condition = threading.Condition(lock)
+        self.futures: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+
+class ProgressBroker:
+    """Per-download event channels for progress subscribers.
+
+    A channel only keeps its latest event and a version number, so an idle
+    subscriber costs one waiter: a Condition wait for WSGI responses, or a
+    future for async ones, which hold no thread at all. Progress events
+    arriving faster than min_interval update the channel without waking
+    subscribers; state changes always wake them.
+
+    A WSGI subscriber still holds a server thread for as long as its
+    stream is open, so at most max_streams of them are admitted at once
+    (0 for no limit); async subscribers are not counted.
+    """
+
+    def __init__(
+        self, min_interval: float = 0.25, retention: float = 3600, max_streams: int = 0
+    ):
+        self.min_interval = min_interval
+        self.retention = retention
+        self.max_streams = max_streams
+        self.published = 0
+        self.coalesced = 0
+        self.streams = 0
+        self.streams_rejected = 0
+        self._channels: Dict[str, _Channel] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel_id: str, event: Dict[str, Any]):
+        """Record a channel's latest event and wake its subscribers"""
+        now = time.monotonic()
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                self._prune(now)
+                channel = self._channels[channel_id] = _Channel(self._lock)
+            state_changed = channel.version == 0 or channel.event.get(
+                "status"
+            ) != event.get("status")
+            channel.version += 1
+            channel.event = event
+            self.published += 1
+            if event.get("status") in FINAL_STATES:
+                channel.closed_at = now
+            if not state_changed and now - channel.notified_at < self.min_interval:
+                self.coalesced += 1
+                return
+            channel.notified_at = now
+            channel.condition.notify_all()
+            futures, channel.futures = channel.futures, []
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def latest(self, channel_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Current (version, event) of a channel, or None if it has none"""
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None or channel.version == 0:
+                return None
+            return channel.version, channel.event
+
+    def wait(
+        self, channel_id: str, version: int, timeout: float
+    ) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Block until the channel moves past version; None on timeout or unknown channel"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return None
+            while channel.version <= version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not channel.condition.wait(remaining):
+                    break
+            if channel.version <= version:
+                return None
+            return channel.version, channel.event
+
+    async def wait_async(
+        self, channel_id: str, version: int, timeout: float
+    ) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Async variant of wait() that holds no thread while idle"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return None
+            if channel.version > version:
+                return channel.version, channel.event
+            future = loop.create_future()
+            channel.futures.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                channel.futures = [
+                    (l, f) for l, f in channel.futures if f is not future
+                ]
+        return self.latest(channel_id) if channel.version > version else None
+
+    def open_stream(self) -> bool:
+        """Claim a thread-held subscription; False when max_streams are already open"""
+        with self._lock:
+            if self.max_streams and self.streams >= self.max_streams:
+                self.streams_rejected += 1
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        """Release a subscription claimed with open_stream"""
+        with self._lock:
+            self.streams -= 1
+
+    def _prune(self, now: float):
+        """Forget channels that closed longer than retention ago"""
+        expired = [
+            channel_id
+            for channel_id, channel in self._channels.items()
+            if channel.closed_at is not None
+            and now - channel.closed_at > self.retention
+        ]
+        for channel_id in expired:
+            del self._channels[channel_id]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Broker counters for the /metrics endpoint"""
+        with self._lock:
+            return {
+                "published_total": self.published,
+                "coalesced_total": self.coalesced,
+                "channels": len(self._channels),
+                "async_subscribers": sum(
+                    len(channel.futures) for channel in self._channels.values()
+                ),
+                "streams": self.streams,
+                "streams_rejected_total": self.streams_rejected,
+            }
+
+
+def _resolve(future: "asyncio.Future"):
+    if not future.done():
+        future.set_result(None)
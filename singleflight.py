@@ -0,0 +1,205 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from deadlines import DeadlineExceeded
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None  # type: ignore[assignment]
+
+
+class _Call:
+    """An in-flight call that concurrent callers wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single execution.
+
+    Threads in one process share the leader's result directly. When a
+    shared directory is given, the leader also holds an exclusive file
+    lock there and publishes its result, so workers in other processes
+    that share the directory wait for it instead of repeating the work.
+    Callers that pass a timeout stop waiting for another caller's run
+    after that many seconds with DeadlineExceeded.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(
+        self,
+        key: str,
+        func: Callable[[], Any],
+        shared_dir: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """Run func once for all concurrent callers using the same key"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise DeadlineExceeded(
+                    f"Gave up waiting for a concurrent call after {timeout:g} seconds"
+                )
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if shared_dir and fcntl is not None:
+                call.result = self._do_shared(key, func, shared_dir, timeout)
+            else:
+                call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_shared(
+        self,
+        key: str,
+        func: Callable[[], Any],
+        shared_dir: str,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """Serialize func across processes with a lock file and share its result.
+
+        Every caller leaves a marker file while it waits. The last one out
+        deletes the lock and result files, so nothing is left behind once a
+        call is over.
+        """
+        os.makedirs(shared_dir, exist_ok=True)
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        lock_path = os.path.join(shared_dir, f"{name}.lock")
+        result_path = os.path.join(shared_dir, f"{name}.json")
+        marker_path = os.path.join(
+            shared_dir, f"{name}.{os.getpid()}-{threading.get_ident()}.wait"
+        )
+        started = time.time()
+
+        open(marker_path, "w").close()
+        try:
+            lock_file = self._lock_file(lock_path, timeout)
+        except BaseException:
+            os.remove(marker_path)
+            raise
+        try:
+            # Another worker finished the same call while we waited on the lock
+            shared = self._read_result(result_path, started)
+            if shared is not None:
+                with self._lock:
+                    self.coalesced += 1
+                return shared["result"]
+
+            result = func()
+            self._write_result(result_path, result)
+            return result
+        finally:
+            os.remove(marker_path)
+            if not glob.glob(os.path.join(glob.escape(shared_dir), f"{name}.*.wait")):
+                # Nobody is waiting for this call any more
+                for path in (result_path, lock_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    @staticmethod
+    def _lock_file(lock_path: str, timeout: Optional[float] = None):
+        """Open and exclusively lock lock_path, retrying if it is deleted while we wait"""
+        expires = None if timeout is None else time.monotonic() + timeout
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                SingleFlight._flock(lock_file, expires)
+            except BaseException:
+                lock_file.close()
+                raise
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            # The holder before us cleaned up; lock the current file instead
+            lock_file.close()
+
+    @staticmethod
+    def _flock(lock_file, expires: Optional[float]):
+        """Take an exclusive lock, polling so the wait can end at expires"""
+        if expires is None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(
+                        "Gave up waiting for a call in another worker"
+                    )
+                time.sleep(min(0.05, remaining))
+
+    @staticmethod
+    def _read_result(result_path: str, newer_than: float) -> Optional[Dict[str, Any]]:
+        try:
+            if os.path.getmtime(result_path) < newer_than:
+                return None
+            with open(result_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_result(result_path: str, result: Any):
+        try:
+            payload = json.dumps({"result": result})
+        except (TypeError, ValueError):
+            # Results that cannot be shared are recomputed by other workers
+            return
+        tmp_path = f"{result_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(payload)
+            os.replace(tmp_path, result_path)
+        except OSError as e:
+            logging.warning(f"Could not publish single-flight result: {e}")
+
+    def metrics(self) -> Dict[str, Any]:
+        """Coalescing counters for the /metrics endpoint"""
+        with self._lock:
+            return {
+                "leaders_total": self.leaders,
+                "coalesced_total": self.coalesced,
+                "in_flight": len(self._calls),
+            }
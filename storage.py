@@ -0,0 +1,173 @@
+import logging
+import os
+import shutil
+import threading
+from typing import Any, Callable, Dict, Optional, Union
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+except ImportError:  # Optional: pip install boto3
+    boto3 = None
+    TransferConfig = None
+
+
+class LocalStorage:
+    """Downloads kept only in the local upload folder, served by the instance that has them"""
+
+    remote = False
+
+    def __init__(self, get_root: Callable[[], str]):
+        self.get_root = get_root
+
+    def upload(self, key: str, path: str):
+        """Files already live under the upload folder"""
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(os.path.join(self.get_root(), key))
+
+    def url(self, key: str, filename: Optional[str] = None) -> Optional[str]:
+        """Local files are sent by /file itself"""
+        return None
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Delete a download directory; returns 1 if it existed"""
+        path = os.path.join(self.get_root(), prefix)
+        if not os.path.isdir(path):
+            return 0
+        shutil.rmtree(path, ignore_errors=True)
+        return 1
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"remote": 0}
+
+
+class S3Storage:
+    """Downloads copied to an S3-compatible bucket so any instance can serve them.
+
+    Works with AWS S3, MinIO and Google Cloud Storage through its S3
+    interoperability endpoint (https://storage.googleapis.com with HMAC
+    keys). Files are uploaded in parallel multipart chunks straight from
+    disk, and served by redirecting clients to short-lived presigned URLs,
+    so no instance proxies the bytes.
+    """
+
+    remote = True
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        url_ttl: int = 3600,
+        part_size: int = 8 * 1024 * 1024,
+        client=None,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.url_ttl = url_ttl
+        self.part_size = part_size
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("S3 storage needs boto3 (pip install boto3)")
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.failures = 0
+        self.redirects = 0
+        self._lock = threading.Lock()
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def upload(self, key: str, path: str):
+        """Upload a file, in multipart chunks once it is larger than part_size"""
+        transfer = None
+        if TransferConfig is not None:
+            transfer = TransferConfig(
+                multipart_threshold=self.part_size, multipart_chunksize=self.part_size
+            )
+        try:
+            self.client.upload_file(
+                path, self.bucket, self._object_key(key), Config=transfer
+            )
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        with self._lock:
+            self.uploads += 1
+            self.uploaded_bytes += os.path.getsize(path)
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except Exception as e:
+            # botocore reports a missing object as a ClientError with a 404 code
+            status = (
+                getattr(e, "response", {})
+                .get("ResponseMetadata", {})
+                .get("HTTPStatusCode")
+            )
+            if status == 404:
+                return False
+            raise
+
+    def url(self, key: str, filename: Optional[str] = None) -> Optional[str]:
+        """Presigned GET URL that downloads the object as filename"""
+        params = {"Bucket": self.bucket, "Key": self._object_key(key)}
+        if filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+        with self._lock:
+            self.redirects += 1
+        return self.client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=self.url_ttl
+        )
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Delete every object under a key prefix and return how many there were"""
+        deleted = 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=self._object_key(prefix)
+        ):
+            objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            if objects:
+                # delete_objects takes at most 1000 keys, the size of a listing page
+                self.client.delete_objects(
+                    Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True}
+                )
+                deleted += len(objects)
+        return deleted
+
+    def metrics(self) -> Dict[str, Any]:
+        """Upload and redirect counters for the /metrics endpoint"""
+        with self._lock:
+            return {
+                "remote": 1,
+                "uploads_total": self.uploads,
+                "uploaded_bytes_total": self.uploaded_bytes,
+                "upload_failures_total": self.failures,
+                "redirects_total": self.redirects,
+            }
+
+
+def create_storage(config) -> Union[LocalStorage, S3Storage]:
+    """Storage backend selected by STORAGE_BACKEND"""
+    if config["STORAGE_BACKEND"] == "s3":
+        return S3Storage(
+            bucket=config["STORAGE_BUCKET"],
+            prefix=config["STORAGE_PREFIX"],
+            endpoint_url=config["STORAGE_ENDPOINT_URL"],
+            region=config["STORAGE_REGION"],
+            url_ttl=config["STORAGE_URL_TTL"],
+            part_size=config["STORAGE_PART_SIZE"],
+        )
+    if config["STORAGE_BACKEND"] != "local":
+        logging.warning(
+            f"Unknown STORAGE_BACKEND {config['STORAGE_BACKEND']!r}, using local storage"
+        )
+    return LocalStorage(lambda: config["UPLOAD_FOLDER"])
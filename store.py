@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from cache import TTLCache
+
+# Content hashes keyed by file identity; hardlinked copies share an entry
+_etag_cache = TTLCache(maxsize=4096, ttl=24 * 3600)
+
+
+def _file_identity(path: str) -> tuple:
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Compute the SHA-256 of a file without loading it into memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_etag(path: str) -> str:
+    """Strong ETag for a file derived from its content hash"""
+    identity = _file_identity(path)
+    etag = _etag_cache.get(identity)
+    if etag is None:
+        etag = hash_file(path)
+        _etag_cache.set(identity, etag)
+    return etag
+
+
+class VideoStore:
+    """Content-addressed store of downloaded videos keyed by video ID and format.
+
+    The index lives in a SQLite database next to the blobs, in WAL mode
+    so every worker reads while one writes a single row; each thread
+    keeps its own connection.
+    """
+
+    _instances: Dict[str, "VideoStore"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(root, "index.db")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(root, exist_ok=True)
+        self._connect()
+        self._import_json(os.path.join(root, "index.json"))
+
+    @classmethod
+    def for_folder(cls, upload_folder: str) -> "VideoStore":
+        """Get the shared store that lives inside an upload folder"""
+        root = os.path.abspath(os.path.join(upload_folder, ".store"))
+        with cls._instances_lock:
+            store = cls._instances.get(root)
+            if store is None:
+                store = cls._instances[root] = cls(root)
+            return store
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not os.path.exists(self.index_path):
+            # The database was deleted underneath us (e.g. by /cleanup)
+            conn.close()
+            conn = None
+        if conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "entry TEXT NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_path ON entries (path)"
+                )
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(video_id: str, format_key: str) -> str:
+        return f"{video_id}:{format_key}"
+
+    @staticmethod
+    def _row(key: str, entry: Dict[str, Any]) -> tuple:
+        return (key, entry["path"], entry["size"], json.dumps(entry))
+
+    def lookup(self, video_id: str, format_key: str) -> Optional[Dict[str, Any]]:
+        """Return the stored entry for a video and format, if its blob still exists"""
+        key = self._key(video_id, format_key)
+        conn = self._connect()
+        row = conn.execute("SELECT entry FROM entries WHERE key = ?", (key,)).fetchone()
+        entry = json.loads(row[0]) if row else None
+        if entry is not None and not os.path.exists(self.blob_path(entry)):
+            # Blob was removed underneath us (e.g. by /cleanup)
+            with conn:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry
+
+    def add(
+        self,
+        video_id: str,
+        format_id: str,
+        src_path: str,
+        title: str,
+        aliases: Iterable[str] = (),
+    ) -> Dict[str, Any]:
+        """Move a downloaded file into the store and index it under its format and aliases"""
+        ext = os.path.splitext(src_path)[1].lstrip(".") or "mp4"
+        safe_format = re.sub(r"[^\w.-]", "_", str(format_id))
+        entry = {
+            "video_id": str(video_id),
+            "format_id": str(format_id),
+            "path": os.path.join(
+                re.sub(r"[^\w.-]", "_", str(video_id)), f"{safe_format}.{ext}"
+            ),
+            "ext": ext,
+            "title": title,
+            "size": os.path.getsize(src_path),
+            "created_at": time.time(),
+        }
+        blob_path = self.blob_path(entry)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        shutil.move(src_path, blob_path)
+        # Hash once at ingest so serving never has to read the file for an ETag
+        entry["sha256"] = hash_file(blob_path)
+        _etag_cache.set(_file_identity(blob_path), entry["sha256"])
+
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, path, size, entry) VALUES (?, ?, ?, ?)",
+                [
+                    self._row(self._key(video_id, format_key), entry)
+                    for format_key in {str(format_id), *aliases}
+                ],
+            )
+        return dict(entry)
+
+    def alias(self, entry: Dict[str, Any], video_id: str, format_key: str):
+        """Index an existing blob under another key as well"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, path, size, entry) VALUES (?, ?, ?, ?)",
+                self._row(self._key(video_id, format_key), entry),
+            )
+
+    def blob_path(self, entry: Dict[str, Any]) -> str:
+        """Absolute path of an entry's stored file"""
+        return os.path.join(self.root, entry["path"])
+
+    def link(self, entry: Dict[str, Any], dest_path: str):
+        """Expose a stored blob at dest_path, hardlinking when the filesystem allows"""
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        try:
+            os.link(self.blob_path(entry), dest_path)
+        except OSError:
+            shutil.copyfile(self.blob_path(entry), dest_path)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Unique stored blobs, one entry per file"""
+        rows = self._connect().execute("SELECT path, entry FROM entries")
+        blobs = {path: entry for path, entry in rows}
+        return [json.loads(entry) for entry in blobs.values()]
+
+    def discard(self, entry: Dict[str, Any]):
+        """Delete a blob and every index key that points at it"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM entries WHERE path = ?", (entry["path"],))
+        try:
+            os.remove(self.blob_path(entry))
+        except FileNotFoundError:
+            pass
+
+    def metrics(self) -> Dict[str, Any]:
+        """Store counters for the /metrics endpoint"""
+        blobs, size = (
+            self._connect()
+            .execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "
+                "(SELECT MAX(size) AS size FROM entries GROUP BY path)"
+            )
+            .fetchone()
+        )
+        with self._lock:
+            return {
+                "hits_total": self.hits,
+                "misses_total": self.misses,
+                "blobs": blobs,
+                "bytes": size,
+            }
+
+    def _import_json(self, path: str):
+        """Move an index left by older releases, which kept it in index.json, into the database"""
+        try:
+            with open(path, "r") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read old video store index: {e}")
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO entries (key, path, size, entry) VALUES (?, ?, ?, ?)",
+                [self._row(key, entry) for key, entry in index.items()],
+            )
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
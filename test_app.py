@@ -1,15 +1,18 @@
-import unittest
 import json
-import tempfile
 import os
 import shutil
-from unittest.mock import patch, MagicMock
-from app import app
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from app import app, canonicalizer, metadata_cache, ydl_pool
 from config import TestingConfig
 
+
 class TikTokDownloaderTestCase(unittest.TestCase):
     """Test cases for TikTok Downloader application"""
-    
+
     def setUp(self):
         """Set up test fixtures"""
         self.app = app
@@ -17,222 +20,2785 @@ class TikTokDownloaderTestCase(unittest.TestCase):
         self.client = self.app.test_client()
         self.ctx = self.app.app_context()
         self.ctx.push()
-        
+
         # Create temporary test directory
         self.test_dir = tempfile.mkdtemp()
-        self.app.config['UPLOAD_FOLDER'] = self.test_dir
-    
+        self.app.config["UPLOAD_FOLDER"] = self.test_dir
+        metadata_cache.clear()
+        ydl_pool.clear()
+        canonicalizer.clear()
+        # A fresh breaker per test, without backoff sleeps on failed downloads
+        from upstream import UpstreamGuard
+
+        self.upstream_guard = patch("app.upstream_guard", UpstreamGuard(max_retries=0))
+        self.upstream_guard.start()
+
     def tearDown(self):
         """Clean up after tests"""
+        self.upstream_guard.stop()
         self.ctx.pop()
         # Clean up test directory
         if os.path.exists(self.test_dir):
             shutil.rmtree(self.test_dir)
-    
+
     def test_home_page_web_interface(self):
         """Test home page returns web interface"""
-        response = self.client.get('/')
+        response = self.client.get("/")
         self.assertEqual(response.status_code, 200)
-        self.assertIn(b'TikTok Video Downloader', response.data)
-    
+        self.assertIn(b"TikTok Video Downloader", response.data)
+
     def test_home_page_api_response(self):
         """Test home page returns API info for JSON requests"""
-        response = self.client.get('/', 
-                                 headers={'Content-Type': 'application/json'})
+        response = self.client.get("/", headers={"Content-Type": "application/json"})
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertIn('message', data)
-        self.assertIn('endpoints', data)
-    
+        self.assertIn("message", data)
+        self.assertIn("endpoints", data)
+
     def test_api_info_endpoint(self):
         """Test API info endpoint"""
-        response = self.client.get('/api')
+        response = self.client.get("/api")
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertIn('message', data)
-        self.assertIn('version', data)
-        self.assertIn('endpoints', data)
-    
+        self.assertIn("message", data)
+        self.assertIn("version", data)
+        self.assertIn("endpoints", data)
+
     def test_health_check_endpoint(self):
         """Test health check endpoint"""
-        response = self.client.get('/health')
+        response = self.client.get("/health")
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertEqual(data['status'], 'healthy')
-        self.assertIn('timestamp', data)
-    
+        self.assertEqual(data["status"], "healthy")
+        self.assertIn("timestamp", data)
+
     def test_health_check_detailed(self):
         """Test detailed health check"""
-        response = self.client.get('/health?detailed=true')
+        response = self.client.get("/health?detailed=true")
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertEqual(data['status'], 'healthy')
-        self.assertIn('system_metrics', data)
-    
+        self.assertEqual(data["status"], "healthy")
+        self.assertIn("system_metrics", data)
+        self.assertGreater(data["startup"]["seconds"], 0)
+        self.assertIn("loaded", data["yt_dlp"])
+
     def test_download_missing_url(self):
         """Test download endpoint with missing URL"""
-        response = self.client.post('/download',
-                                  data=json.dumps({}),
-                                  content_type='application/json')
+        response = self.client.post(
+            "/download", data=json.dumps({}), content_type="application/json"
+        )
         self.assertEqual(response.status_code, 400)
         data = json.loads(response.data)
-        self.assertIn('error', data)
-    
+        self.assertIn("error", data)
+
     def test_download_invalid_url(self):
         """Test download endpoint with invalid URL"""
-        response = self.client.post('/download',
-                                  data=json.dumps({'url': ''}),
-                                  content_type='application/json')
+        response = self.client.post(
+            "/download", data=json.dumps({"url": ""}), content_type="application/json"
+        )
         self.assertEqual(response.status_code, 400)
         data = json.loads(response.data)
-        self.assertIn('error', data)
-    
+        self.assertIn("error", data)
+
     def test_download_non_json_request(self):
         """Test download endpoint with non-JSON request"""
-        response = self.client.post('/download',
-                                  data='not json',
-                                  content_type='text/plain')
+        response = self.client.post(
+            "/download", data="not json", content_type="text/plain"
+        )
         self.assertEqual(response.status_code, 400)
-    
-    @patch('yt_dlp.YoutubeDL')
+
+    @patch("yt_dlp.YoutubeDL")
     def test_download_success(self, mock_yt_dlp):
         """Test successful download"""
         # Mock yt-dlp behavior
         mock_instance = MagicMock()
         mock_yt_dlp.return_value = mock_instance
         mock_instance.extract_info.return_value = {
-            'title': 'Test Video',
-            'ext': 'mp4',
-            'filesize': 1024000
+            "title": "Test Video",
+            "ext": "mp4",
+            "filesize": 1024000,
         }
-        
+
         # Create a mock downloaded file
-        test_file_path = os.path.join(self.test_dir, 'test_download', 'Test Video.mp4')
+        test_file_path = os.path.join(self.test_dir, "test_download", "Test Video.mp4")
         os.makedirs(os.path.dirname(test_file_path), exist_ok=True)
-        with open(test_file_path, 'w') as f:
-            f.write('test content')
-        
-        response = self.client.post('/download',
-                                  data=json.dumps({'url': 'https://www.tiktok.com/@test/video/123'}),
-                                  content_type='application/json')
-        
-        # Should return success response
-        self.assertEqual(response.status_code, 200)
-    
+        with open(test_file_path, "w") as f:
+            f.write("test content")
+
+        response = self.client.post(
+            "/download",
+            data=json.dumps({"url": "https://www.tiktok.com/@test/video/123"}),
+            content_type="application/json",
+        )
+
+        # Download is queued and the job ID is returned immediately
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertIn("download_id", data)
+        self.assertEqual(data["status_url"], f"/jobs/{data['download_id']}")
+        self._wait_for_job(data["download_id"])
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_download_job_completes(self, mock_yt_dlp):
+        """Test queued download reports progress and download_url when finished"""
+
+        def fake_extract(url, download=False):
+            # Write the file where yt-dlp would have saved it
+            outtmpl = mock_yt_dlp.return_value.params["outtmpl"]
+            with open(
+                os.path.join(os.path.dirname(outtmpl), "Test Video.mp4"), "w"
+            ) as f:
+                f.write("test content")
+            return {"title": "Test Video", "ext": "mp4"}
+
+        mock_yt_dlp.return_value.params = {}
+        mock_yt_dlp.return_value.extract_info.side_effect = fake_extract
+
+        response = self.client.post(
+            "/download",
+            data=json.dumps({"url": "https://www.tiktok.com/@test/video/123"}),
+            content_type="application/json",
+        )
+        download_id = json.loads(response.data)["download_id"]
+
+        job = self._wait_for_job(download_id)
+        self.assertEqual(job["status"], "finished")
+        self.assertEqual(job["file_size"], len("test content"))
+        self.assertEqual(job["download_url"], f"/file/{download_id}/{job['filename']}")
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_download_reuses_stored_video(self, mock_yt_dlp):
+        """Test repeat download of the same video links the stored file"""
+
+        def fake_extract(url, download=False):
+            outtmpl = mock_yt_dlp.return_value.params["outtmpl"]
+            with open(
+                os.path.join(os.path.dirname(outtmpl), "Test Video.mp4"), "w"
+            ) as f:
+                f.write("test content")
+            return {
+                "id": "123",
+                "title": "Test Video",
+                "ext": "mp4",
+                "format_id": "h264_540p",
+            }
+
+        mock_ydl = mock_yt_dlp.return_value
+        mock_ydl.params = {}
+        mock_ydl.extract_info.side_effect = fake_extract
+
+        jobs = []
+        for url in (
+            "https://www.tiktok.com/@test/video/123",
+            "https://www.tiktok.com/@test/video/123?lang=en",
+        ):
+            response = self.client.post(
+                "/download",
+                data=json.dumps({"url": url}),
+                content_type="application/json",
+            )
+            jobs.append(self._wait_for_job(json.loads(response.data)["download_id"]))
+
+        self.assertEqual(mock_ydl.extract_info.call_count, 1)
+        self.assertFalse(jobs[0]["cached"])
+        self.assertTrue(jobs[1]["cached"])
+        paths = [
+            os.path.join(self.test_dir, job["download_id"], job["filename"])
+            for job in jobs
+        ]
+        self.assertTrue(os.path.samefile(paths[0], paths[1]))
+
+        # Both downloads are indexed under the video ID
+        response = self.client.get("/videos/123")
+        self.assertEqual(response.status_code, 200)
+        downloads = json.loads(response.data)["downloads"]
+        self.assertEqual(
+            [d["download_id"] for d in downloads], [job["download_id"] for job in jobs]
+        )
+        self.assertEqual(downloads[0]["download_url"], jobs[0]["download_url"])
+        self.assertEqual(self.client.get("/videos/999").status_code, 404)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_download_with_format_target(self, mock_yt_dlp):
+        """Test a download target picks a format from the extracted info without extracting again"""
+        formats = [
+            {
+                "format_id": "download",
+                "url": "https://cdn/d",
+                "width": 720,
+                "height": 1280,
+                "vcodec": "h264",
+                "filesize": 900,
+                "format_note": "Download video, watermarked",
+            },
+            {
+                "format_id": "h264_540p_big",
+                "url": "https://cdn/a",
+                "width": 576,
+                "height": 1024,
+                "vcodec": "h264",
+                "filesize": 800,
+            },
+            {
+                "format_id": "h264_540p_small",
+                "url": "https://cdn/b",
+                "width": 576,
+                "height": 1024,
+                "vcodec": "h264",
+                "filesize": 500,
+            },
+            {
+                "format_id": "bytevc1_720p",
+                "url": "https://cdn/c",
+                "width": 720,
+                "height": 1280,
+                "vcodec": "h265",
+                "filesize": 700,
+            },
+        ]
+
+        def fake_process(info, download=False):
+            outtmpl = mock_yt_dlp.return_value.params["outtmpl"]
+            with open(
+                os.path.join(os.path.dirname(outtmpl), "Test Video.mp4"), "w"
+            ) as f:
+                f.write("test content")
+            return {
+                "id": "123",
+                "title": "Test Video",
+                "ext": "mp4",
+                "format_id": mock_yt_dlp.return_value.params["format"],
+            }
+
+        mock_ydl = mock_yt_dlp.return_value
+        mock_ydl.params = {}
+        mock_ydl.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+            "formats": formats,
+        }
+        mock_ydl.process_ie_result.side_effect = fake_process
+
+        response = self.client.post(
+            "/download",
+            json={"url": "https://www.tiktok.com/@test/video/123", "max_height": 540},
+        )
+        job = self._wait_for_job(json.loads(response.data)["download_id"])
+
+        self.assertEqual(job["status"], "finished")
+        self.assertEqual(job["format_id"], "h264_540p_small")
+        mock_ydl.extract_info.assert_called_once()
+        self.assertFalse(mock_ydl.extract_info.call_args.kwargs["download"])
+
+        # Nothing fits: the job fails instead of sending a bigger file
+        response = self.client.post(
+            "/download",
+            json={"url": "https://www.tiktok.com/@test/video/123", "max_bytes": 100},
+        )
+        job = self._wait_for_job(json.loads(response.data)["download_id"])
+        self.assertEqual(job["status"], "failed")
+        self.assertIn("No format matches", job["error"])
+
+        response = self.client.post(
+            "/download",
+            json={"url": "https://www.tiktok.com/@test/video/123", "codec": "vp9"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_download_postprocess_variants(self, mock_yt_dlp):
+        """Test downloads get faststart and requested preset outputs, stored once per video"""
+        from app import postprocessor
+
+        def fake_extract(url, download=False):
+            outtmpl = mock_yt_dlp.return_value.params["outtmpl"]
+            with open(
+                os.path.join(os.path.dirname(outtmpl), "Test Video.mp4"), "wb"
+            ) as f:
+                f.write(PostProcessTestCase.MP4_MOOV_LAST)
+            return {
+                "id": "123",
+                "title": "Test Video",
+                "ext": "mp4",
+                "format_id": "h264",
+            }
+
+        mock_yt_dlp.return_value.params = {}
+        mock_yt_dlp.return_value.extract_info.side_effect = fake_extract
+
+        response = self.client.post(
+            "/download",
+            json={"url": "https://www.tiktok.com/@test/video/123", "presets": ["240p"]},
+        )
+        self.assertEqual(response.status_code, 400)
+
+        with patch.object(
+            postprocessor, "ffmpeg", PostProcessTestCase.fake_ffmpeg(self.test_dir)
+        ):
+            runs = postprocessor.metrics()["runs_total"]
+            for _ in range(2):
+                response = self.client.post(
+                    "/download",
+                    json={
+                        "url": "https://www.tiktok.com/@test/video/123",
+                        "presets": ["480p"],
+                    },
+                )
+                download_id = json.loads(response.data)["download_id"]
+                job = self._wait_for_job(download_id)
+                self.assertEqual(job["status"], "finished")
+                self.assertEqual(
+                    set(job["variants"]) | set(job["pending_variants"]),
+                    {"faststart", "480p"},
+                )
+                # ffmpeg runs after the job has finished; outputs are added to its result when ready
+                job = self._wait_for_variants(download_id)
+                self.assertEqual(set(job["variants"]), {"faststart", "480p"})
+            # The second download reuses both stored outputs
+            self.assertEqual(postprocessor.metrics()["runs_total"] - runs, 2)
+
+        response = self.client.get(job["variants"]["faststart"]["download_url"])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            response.data.startswith(PostProcessTestCase.MP4_MOOV_FIRST[:16])
+        )
+        response.close()
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_download_job_failure(self, mock_yt_dlp):
+        """Test failed download is reported on the job status"""
+        mock_yt_dlp.return_value.extract_info.side_effect = Exception("HTTP Error 403")
+
+        response = self.client.post(
+            "/download",
+            data=json.dumps({"url": "https://www.tiktok.com/@test/video/123"}),
+            content_type="application/json",
+        )
+        download_id = json.loads(response.data)["download_id"]
+
+        job = self._wait_for_job(download_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertIn("403", job["error"])
+
+    def _fake_downloads(self, mock_yt_dlp):
+        """Make the mocked yt-dlp write a file named after the requested video"""
+        extracted = []
+
+        def make_ydl(opts):
+            # One mock per instance so parallel downloads keep their own outtmpl
+            ydl = MagicMock()
+            ydl.params = dict(opts)
+
+            def fake_extract(url, download=False):
+                extracted.append(url)
+                video_id = url.split("/video/")[1].split("?")[0]
+                if video_id == "404":
+                    raise Exception("HTTP Error 404")
+                with open(
+                    os.path.join(
+                        os.path.dirname(ydl.params["outtmpl"]), f"Video {video_id}.mp4"
+                    ),
+                    "w",
+                ) as f:
+                    f.write(f"content {video_id}")
+                return {"id": video_id, "title": f"Video {video_id}", "ext": "mp4"}
+
+            ydl.extract_info.side_effect = fake_extract
+            return ydl
+
+        mock_yt_dlp.side_effect = make_ydl
+        return extracted
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_batch_download_dedupes_by_video_id(self, mock_yt_dlp):
+        """Test batch returns one result per URL and downloads each video once"""
+        extracted = self._fake_downloads(mock_yt_dlp)
+        urls = [
+            "https://www.tiktok.com/@a/video/1",
+            "https://www.tiktok.com/@a/video/1?lang=en",
+            "https://www.tiktok.com/@b/video/2",
+            "https://www.tiktok.com/@c/video/404",
+        ]
+
+        response = self.client.post(
+            "/download/batch",
+            data=json.dumps({"urls": urls, "parallelism": 2}),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(len(extracted), 3)
+        self.assertEqual([result["url"] for result in data["results"]], urls)
+        self.assertEqual(
+            [result["success"] for result in data["results"]], [True, True, True, False]
+        )
+        self.assertEqual(
+            data["results"][0]["download_id"], data["results"][1]["download_id"]
+        )
+        self.assertEqual(data["succeeded"], 3)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_batch_download_zip(self, mock_yt_dlp):
+        """Test batch can stream successful downloads as a ZIP"""
+        import io
+        import zipfile
+
+        self._fake_downloads(mock_yt_dlp)
+        urls = [
+            "https://www.tiktok.com/@a/video/1",
+            "https://www.tiktok.com/@b/video/2",
+        ]
+
+        response = self.client.post(
+            "/download/batch",
+            data=json.dumps({"urls": urls, "zip": True}),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "application/zip")
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        names = archive.namelist()
+        self.assertEqual(len(names), 3)
+        self.assertIn("results.json", names)
+        contents = sorted(
+            archive.read(name) for name in names if name != "results.json"
+        )
+        self.assertEqual(contents, [b"content 1", b"content 2"])
+
+    def test_batch_download_too_many_urls(self):
+        """Test batch rejects more URLs than allowed"""
+        urls = ["https://www.tiktok.com/@a/video/1"] * (
+            self.app.config["BATCH_MAX_URLS"] + 1
+        )
+        response = self.client.post(
+            "/download/batch",
+            data=json.dumps({"urls": urls}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_download_per_client_job_limit(self):
+        """Test a client with too many active downloads gets 429 while others still get in"""
+        import threading
+
+        from app import job_queue
+
+        release = threading.Event()
+
+        def blocked_download(progress_hook, *args):
+            release.wait(5)
+            return {}
+
+        with patch("app.run_download", blocked_download), patch.object(
+            job_queue, "max_per_owner", 1
+        ):
+            first = self.client.post(
+                "/download", json={"url": "https://www.tiktok.com/@a/video/1"}
+            )
+            second = self.client.post(
+                "/download", json={"url": "https://www.tiktok.com/@a/video/2"}
+            )
+            other = self.client.post(
+                "/download",
+                json={"url": "https://www.tiktok.com/@a/video/2"},
+                headers={"X-API-Key": "other-client"},
+            )
+            release.set()
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(
+            second.headers["Retry-After"], str(self.app.config["RETRY_AFTER"])
+        )
+        self.assertEqual(other.status_code, 202)
+        self._wait_for_job(first.get_json()["download_id"])
+        self._wait_for_job(other.get_json()["download_id"])
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_metadata_rejected_when_overloaded(self, mock_yt_dlp):
+        """Test extractions get a fast 503 with Retry-After once the admission queue is full"""
+        from admission import AdmissionController
+
+        admission = AdmissionController(max_concurrent=1, max_queue=0, retry_after=7)
+        admission.acquire("another-client")
+        with patch("app.admission", admission):
+            response = self.client.post(
+                "/metadata", json={"url": "https://www.tiktok.com/@a/video/1"}
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "7")
+        mock_yt_dlp.return_value.extract_info.assert_not_called()
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_metadata_fails_fast_while_throttled(self, mock_yt_dlp):
+        """Test a burst of 403s opens the breaker, after which extractions get 503 without reaching TikTok"""
+        from upstream import UpstreamGuard
+
+        mock_yt_dlp.return_value.extract_info.side_effect = Exception(
+            "HTTP Error 403: Forbidden"
+        )
+        with patch(
+            "app.upstream_guard", UpstreamGuard(threshold=2, cooldown=60, max_retries=0)
+        ):
+            for video_id in (1, 2):
+                response = self.client.post(
+                    "/metadata",
+                    json={"url": f"https://www.tiktok.com/@a/video/{video_id}"},
+                )
+                self.assertEqual(response.status_code, 500)
+            response = self.client.post(
+                "/metadata", json={"url": "https://www.tiktok.com/@a/video/3"}
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response.headers["Retry-After"]), 48)
+        self.assertEqual(mock_yt_dlp.return_value.extract_info.call_count, 2)
+
+    def test_job_status_unknown_id(self):
+        """Test job status endpoint with unknown download ID"""
+        response = self.client.get("/jobs/does-not-exist")
+        self.assertEqual(response.status_code, 404)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_download_deadline_cancels_transfer(self, mock_yt_dlp):
+        """Test a download past its deadline is aborted from the progress hook and its directory removed"""
+        hooks = []
+        mock_ydl = mock_yt_dlp.return_value
+        mock_ydl.params = {}
+        mock_ydl._progress_hooks = hooks
+        mock_ydl.add_progress_hook.side_effect = hooks.append
+
+        def slow_download(url, download=False):
+            with open(
+                os.path.join(
+                    os.path.dirname(mock_ydl.params["outtmpl"]), "Test Video.mp4.part"
+                ),
+                "wb",
+            ) as f:
+                f.write(b"partial")
+            for downloaded in range(100):
+                time.sleep(0.02)
+                for hook in list(hooks):
+                    hook({"status": "downloading", "downloaded_bytes": downloaded})
+            return {"id": "123", "title": "Test Video", "ext": "mp4"}
+
+        mock_ydl.extract_info.side_effect = slow_download
+
+        response = self.client.post(
+            "/download",
+            json={"url": "https://www.tiktok.com/@test/video/123", "timeout": "soon"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(
+            "/download",
+            json={"url": "https://www.tiktok.com/@test/video/123", "timeout": 0.2},
+        )
+        download_id = response.get_json()["download_id"]
+        job = self._wait_for_job(download_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertIn("timed out", job["error"])
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, download_id)))
+        self.assertIn(
+            'app_upstream_timeouts_total{operation="download"}',
+            self.client.get("/metrics").get_data(as_text=True),
+        )
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_metadata_deadline(self, mock_yt_dlp):
+        """Test an extraction past the client's deadline returns 504 and still fills the cache"""
+        import threading
+
+        release = threading.Event()
+
+        def slow_extract(url, download=False):
+            release.wait(5)
+            return {"id": "123", "title": "Slow Video"}
+
+        mock_yt_dlp.return_value.extract_info.side_effect = slow_extract
+
+        started = time.time()
+        response = self.client.post(
+            "/metadata",
+            json={"url": "https://www.tiktok.com/@test/video/123", "timeout": 0.1},
+        )
+        self.assertEqual(response.status_code, 504)
+        self.assertLess(time.time() - started, 2)
+
+        release.set()
+        deadline = time.time() + 5
+        while metadata_cache.get("123") is None and time.time() < deadline:
+            time.sleep(0.01)
+        response = self.client.post(
+            "/metadata", json={"url": "https://www.tiktok.com/@test/video/123"}
+        )
+        self.assertEqual(response.get_json()["metadata"]["title"], "Slow Video")
+        mock_yt_dlp.return_value.extract_info.assert_called_once()
+
+    def test_deadline_calls_share_a_bounded_pool(self):
+        """Test calls past their deadline hold at most the pool's threads and queued ones are dropped"""
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        from deadlines import Deadline, DeadlineExceeded, call_with_deadline
+
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait(5)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        with patch("deadlines._executor", executor):
+            for _ in range(3):
+                with self.assertRaises(DeadlineExceeded):
+                    call_with_deadline(slow, Deadline(0.05), "Extraction")
+        release.set()
+        executor.shutdown(wait=True)
+        self.assertEqual(calls, [1])
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_coalesced_extractions_hold_one_pool_thread(self, mock_yt_dlp):
+        """Test requests joining an extraction wait on their own thread, leaving the pool to other videos"""
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        from app import extract_video_info
+        from deadlines import Deadline
+
+        release = threading.Event()
+
+        def extract(url, download=False):
+            if url.endswith("/1"):
+                release.wait(5)
+            return {"id": url.rsplit("/", 1)[1], "title": "Video"}
+
+        mock_yt_dlp.return_value.extract_info.side_effect = extract
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        with patch("deadlines._executor", executor):
+            viral = [
+                threading.Thread(
+                    target=extract_video_info,
+                    args=("https://www.tiktok.com/@a/video/1",),
+                    kwargs={"client": "test"},
+                )
+                for _ in range(4)
+            ]
+            for thread in viral:
+                thread.start()
+            time.sleep(0.1)
+            try:
+                info = extract_video_info(
+                    "https://www.tiktok.com/@a/video/2",
+                    client="test",
+                    deadline=Deadline(2),
+                )
+            finally:
+                release.set()
+                for thread in viral:
+                    thread.join()
+        self.assertEqual(info["id"], "2")
+
+    def _wait_for_job(self, download_id, timeout=5):
+        """Poll the job status endpoint until the job is done"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = json.loads(self.client.get(f"/jobs/{download_id}").data)
+            if job["status"] in ("finished", "failed"):
+                return job
+            time.sleep(0.01)
+        self.fail(f"Job {download_id} did not finish")
+
+    def _wait_for_variants(self, download_id, timeout=5):
+        """Poll a finished job until its post-processing outputs are all in"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = json.loads(self.client.get(f"/jobs/{download_id}").data)
+            if not job["pending_variants"]:
+                return job
+            time.sleep(0.01)
+        self.fail(f"Variants of {download_id} did not finish")
+
+    def test_progress_stream(self):
+        """Test /progress sends state changes as Server-Sent Events and ends when the job is done"""
+        import threading
+
+        from app import job_queue
+
+        release = threading.Event()
+
+        def work(progress_hook):
+            release.wait(5)
+            progress_hook(
+                {
+                    "status": "downloading",
+                    "downloaded_bytes": 50,
+                    "total_bytes": 100,
+                    "speed": 1024.0,
+                    "eta": 3,
+                }
+            )
+            return {
+                "filename": "video.mp4",
+                "file_size": 100,
+                "download_url": "/file/progress-job/video.mp4",
+                "cached": False,
+            }
+
+        job_queue.submit("progress-job", work)
+        response = self.client.get("/progress/progress-job")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        release.set()
+
+        body = response.get_data(as_text=True)
+        response.close()
+        events = [block for block in body.split("\n\n") if block.startswith("id:")]
+        self.assertIn("event: finished", events[-1])
+        finished = json.loads(events[-1].split("data: ", 1)[1])
+        self.assertEqual(finished["download_url"], "/file/progress-job/video.mp4")
+        self.assertEqual(finished["progress"]["percent"], 50.0)
+        self.assertEqual(finished["progress"]["speed"], 1024.0)
+
+        self.assertEqual(self.client.get("/progress/unknown").status_code, 404)
+
+    def test_progress_streams_are_capped(self):
+        """Test /progress turns away streams past the cap and closes them after the max duration"""
+        import threading
+
+        from app import job_queue, progress_broker
+
+        release = threading.Event()
+
+        def work(progress_hook):
+            release.wait(5)
+            return {}
+
+        job_queue.submit("capped-job", work)
+        self.app.config["PROGRESS_MAX_DURATION"] = 0
+
+        with patch.object(progress_broker, "max_streams", 1):
+            response = self.client.get("/progress/capped-job")
+            self.assertEqual(response.status_code, 200)
+            rejected = self.client.get("/progress/capped-job")
+            self.assertEqual(rejected.status_code, 503)
+            self.assertEqual(rejected.get_json()["status_url"], "/jobs/capped-job")
+
+            # An expired stream ends with a poll event and frees its slot
+            body = response.get_data(as_text=True)
+            response.close()
+            self.assertIn("event: poll", body)
+            self.assertEqual(self.client.get("/progress/capped-job").status_code, 200)
+        release.set()
+
     def test_metadata_missing_url(self):
         """Test metadata endpoint with missing URL"""
-        response = self.client.post('/metadata',
-                                  data=json.dumps({}),
-                                  content_type='application/json')
+        response = self.client.post(
+            "/metadata", data=json.dumps({}), content_type="application/json"
+        )
         self.assertEqual(response.status_code, 400)
         data = json.loads(response.data)
-        self.assertIn('error', data)
-    
-    @patch('yt_dlp.YoutubeDL')
+        self.assertIn("error", data)
+
+    @patch("yt_dlp.YoutubeDL")
     def test_metadata_success(self, mock_yt_dlp):
         """Test successful metadata extraction"""
         # Mock yt-dlp behavior
         mock_instance = MagicMock()
         mock_yt_dlp.return_value = mock_instance
         mock_instance.extract_info.return_value = {
-            'title': 'Test Video',
-            'description': 'Test Description',
-            'duration': 30,
-            'view_count': 1000
+            "title": "Test Video",
+            "description": "Test Description",
+            "duration": 30,
+            "view_count": 1000,
+        }
+
+        response = self.client.post(
+            "/metadata",
+            data=json.dumps({"url": "https://www.tiktok.com/@test/video/123"}),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertIn("metadata", data)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_metadata_cached_by_video_id(self, mock_yt_dlp):
+        """Test repeat lookups for the same video ID skip yt-dlp"""
+        mock_ydl = mock_yt_dlp.return_value
+        mock_ydl.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+            "formats": [],
+        }
+
+        for url in (
+            "https://www.tiktok.com/@test/video/123",
+            "https://www.tiktok.com/@test/video/123?is_from_webapp=1",
+        ):
+            response = self.client.post(
+                "/metadata",
+                data=json.dumps({"url": url}),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.get("/formats?url=https://m.tiktok.com/v/123.html")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(mock_ydl.extract_info.call_count, 1)
+        self.assertEqual(metadata_cache.hits, 2)
+        self.assertEqual(metadata_cache.misses, 1)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_metadata_survives_restart(self, mock_yt_dlp):
+        """Test a cold in-memory cache is warmed from the persistent store"""
+        mock_ydl = mock_yt_dlp.return_value
+        mock_ydl.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+            "formats": [],
+        }
+
+        for _ in range(2):
+            response = self.client.post(
+                "/metadata",
+                data=json.dumps({"url": "https://www.tiktok.com/@test/video/123"}),
+                content_type="application/json",
+            )
+            self.assertEqual(
+                json.loads(response.data)["metadata"]["title"], "Test Video"
+            )
+            # Simulate a recycled worker
+            metadata_cache.clear()
+
+        self.assertEqual(mock_ydl.extract_info.call_count, 1)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_stored_metadata_keeps_its_age(self, mock_yt_dlp):
+        """Test an old stored row serves /metadata but not callers that need fresh CDN URLs"""
+        from app import get_metadata_store
+
+        mock_ydl = mock_yt_dlp.return_value
+        mock_ydl.extract_info.return_value = {
+            "id": "123",
+            "formats": [
+                {"format_id": "h264_540p", "url": "https://cdn.example/540.mp4"}
+            ],
+        }
+        store = get_metadata_store()
+        store.put("123", {"id": "123", "title": "Old", "formats": []})
+        with store._connect() as conn:
+            conn.execute("UPDATE videos SET extracted_at = ?", (time.time() - 7200,))
+
+        response = self.client.post(
+            "/metadata", json={"url": "https://www.tiktok.com/@test/video/123"}
+        )
+        self.assertEqual(json.loads(response.data)["metadata"]["title"], "Old")
+        self.assertEqual(mock_ydl.extract_info.call_count, 0)
+
+        response = self.client.get(
+            "/stream?url=https://www.tiktok.com/@test/video/123&format_id=nope"
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(mock_ydl.extract_info.call_count, 1)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_formats_skip_stale_stored_urls(self, mock_yt_dlp):
+        """Test /formats re-extracts rather than list the expired URLs of an old stored row"""
+        from app import get_metadata_store
+
+        mock_ydl = mock_yt_dlp.return_value
+        mock_ydl.extract_info.return_value = {
+            "id": "123",
+            "formats": [
+                {"format_id": "h264_540p", "url": "https://cdn.example/new.mp4"}
+            ],
         }
-        
-        response = self.client.post('/metadata',
-                                  data=json.dumps({'url': 'https://www.tiktok.com/@test/video/123'}),
-                                  content_type='application/json')
-        
+        store = get_metadata_store()
+        store.put(
+            "123",
+            {
+                "id": "123",
+                "formats": [
+                    {"format_id": "h264_540p", "url": "https://cdn.example/old.mp4"}
+                ],
+            },
+        )
+        with store._connect() as conn:
+            conn.execute("UPDATE videos SET extracted_at = ?", (time.time() - 7200,))
+
+        response = self.client.get(
+            "/formats?url=https://www.tiktok.com/@test/video/123"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"https://cdn.example/new.mp4", response.data)
+        self.assertNotIn(b"https://cdn.example/old.mp4", response.data)
+        self.assertEqual(mock_ydl.extract_info.call_count, 1)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_metadata_bulk(self, mock_yt_dlp):
+        """Test bulk lookups answer stored IDs and URLs and list the rest as missing"""
+        mock_yt_dlp.return_value.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+        }
+        self.client.post(
+            "/metadata",
+            data=json.dumps({"url": "https://www.tiktok.com/@test/video/123"}),
+            content_type="application/json",
+        )
+
+        response = self.client.post(
+            "/metadata/bulk",
+            data=json.dumps(
+                {"ids": ["123", "https://www.tiktok.com/@x/video/123", "456"]}
+            ),
+            content_type="application/json",
+        )
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertIn('metadata', data)
-    
+        self.assertEqual(data["found"], 2)
+        self.assertEqual(data["missing"], ["456"])
+        self.assertEqual(data["results"]["123"]["metadata"]["title"], "Test Video")
+
+        response = self.client.post(
+            "/metadata/bulk", json={"ids": ["123"], "max_age": True}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(mock_yt_dlp.return_value.extract_info.call_count, 1)
+
+        response = self.client.post(
+            "/metadata/bulk",
+            data=json.dumps({"ids": []}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
     def test_formats_missing_url(self):
         """Test formats endpoint with missing URL"""
-        response = self.client.get('/formats')
+        response = self.client.get("/formats")
         self.assertEqual(response.status_code, 400)
         data = json.loads(response.data)
-        self.assertIn('error', data)
-    
-    @patch('yt_dlp.YoutubeDL')
+        self.assertIn("error", data)
+
+    @patch("yt_dlp.YoutubeDL")
     def test_formats_success(self, mock_yt_dlp):
         """Test successful formats extraction"""
         # Mock yt-dlp behavior
         mock_instance = MagicMock()
         mock_yt_dlp.return_value = mock_instance
         mock_instance.extract_info.return_value = {
-            'formats': [
-                {'format_id': '1', 'ext': 'mp4', 'quality': 'high'},
-                {'format_id': '2', 'ext': 'webm', 'quality': 'medium'}
+            "formats": [
+                {"format_id": "1", "ext": "mp4", "quality": "high"},
+                {"format_id": "2", "ext": "webm", "quality": "medium"},
             ]
         }
-        
-        response = self.client.get('/formats?url=https://www.tiktok.com/@test/video/123')
-        
+
+        response = self.client.get(
+            "/formats?url=https://www.tiktok.com/@test/video/123"
+        )
+
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertIn('formats', data)
-    
+        self.assertIn("formats", data)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_formats_compact_layouts(self, mock_yt_dlp):
+        """Test field selection, null omission, the columnar layout and gzip on /formats"""
+        import gzip
+
+        mock_yt_dlp.return_value.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+            "formats": [
+                {
+                    "format_id": "1",
+                    "ext": "mp4",
+                    "height": 540,
+                    "url": "https://cdn/" + "x" * 2000,
+                },
+                {
+                    "format_id": "2",
+                    "ext": "mp4",
+                    "height": 720,
+                    "filesize": 1000,
+                    "url": "https://cdn/y",
+                },
+            ],
+        }
+        url = "/formats?url=https://www.tiktok.com/@test/video/123"
+
+        # The default response keeps every field
+        data = self.client.get(url).get_json()
+        self.assertEqual(data["formats"][0]["filesize"], "N/A")
+        self.assertIn("url", data["formats"][0])
+
+        data = self.client.get(url + "&compact=true").get_json()
+        self.assertEqual(
+            data["formats"],
+            [
+                {"format_id": "1", "ext": "mp4", "height": 540},
+                {"format_id": "2", "ext": "mp4", "height": 720, "filesize": 1000},
+            ],
+        )
+        self.assertNotIn("uploader", data["metadata"])
+
+        data = self.client.get(
+            url + "&compact=true&fields=format_id,filesize"
+        ).get_json()
+        self.assertEqual(
+            data["formats"], [{"format_id": "1"}, {"format_id": "2", "filesize": 1000}]
+        )
+
+        data = self.client.get(
+            url + "&layout=columns&fields=format_id,height,filesize"
+        ).get_json()
+        self.assertEqual(
+            data["formats"],
+            {"format_id": ["1", "2"], "height": [540, 720], "filesize": [None, 1000]},
+        )
+        self.assertEqual(data["total_formats"], 2)
+
+        self.assertEqual(
+            self.client.get(url + "&fields=format_id,bogus").status_code, 400
+        )
+        self.assertEqual(self.client.get(url + "&layout=table").status_code, 400)
+
+        response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(json.loads(gzip.decompress(response.data))["total_formats"], 2)
+
+    @patch("app.upstream_session")
+    @patch("yt_dlp.YoutubeDL")
+    def test_stream_passes_range_through(self, mock_yt_dlp, mock_session):
+        """Test streaming forwards Range and upstream length headers"""
+        mock_yt_dlp.return_value.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+            "formats": [
+                {
+                    "format_id": "h264_540p",
+                    "ext": "mp4",
+                    "vcodec": "h264",
+                    "url": "https://cdn.example/540.mp4",
+                    "http_headers": {"Referer": "https://www.tiktok.com/"},
+                }
+            ],
+        }
+        upstream = MagicMock()
+        upstream.status_code = 206
+        upstream.headers = {
+            "Content-Type": "video/mp4",
+            "Content-Length": "4",
+            "Content-Range": "bytes 0-3/100",
+            "Accept-Ranges": "bytes",
+        }
+        upstream.iter_content.return_value = iter([b"te", b"st"])
+        mock_session.get.return_value = upstream
+
+        response = self.client.get(
+            "/stream?url=https://www.tiktok.com/@test/video/123",
+            headers={"Range": "bytes=0-3"},
+        )
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b"test")
+        self.assertEqual(response.headers["Content-Range"], "bytes 0-3/100")
+        self.assertEqual(response.headers["Content-Length"], "4")
+        upstream_headers = mock_session.get.call_args[1]["headers"]
+        self.assertEqual(upstream_headers["Range"], "bytes=0-3")
+        self.assertEqual(upstream_headers["Referer"], "https://www.tiktok.com/")
+        upstream.iter_content.assert_called_with(
+            chunk_size=self.app.config["STREAM_CHUNK_SIZE"]
+        )
+
+    @patch("app.upstream_session")
+    @patch("yt_dlp.YoutubeDL")
+    def test_stream_cdn_errors_bypass_breaker(self, mock_yt_dlp, mock_session):
+        """Test a 403 from the CDN, an expired signed URL, neither opens the breaker nor is retried"""
+        from upstream import CLOSED, UpstreamGuard
+
+        mock_yt_dlp.return_value.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+            "formats": [
+                {
+                    "format_id": "h264_540p",
+                    "ext": "mp4",
+                    "vcodec": "h264",
+                    "url": "https://cdn.example/540.mp4",
+                }
+            ],
+        }
+        mock_session.get.return_value.status_code = 403
+        guard = UpstreamGuard(threshold=1, cooldown=60, max_retries=2)
+        with patch("app.upstream_guard", guard):
+            for _ in range(2):
+                response = self.client.get(
+                    "/stream?url=https://www.tiktok.com/@test/video/123"
+                )
+                self.assertEqual(response.status_code, 502)
+
+        self.assertEqual(guard.state, CLOSED)
+        self.assertEqual(guard.retries, 0)
+        self.assertEqual(mock_session.get.call_count, 2)
+
+    @patch("app.upstream_session")
+    @patch("yt_dlp.YoutubeDL")
+    def test_audio_and_thumbnail_are_stored(self, mock_yt_dlp, mock_session):
+        """Test /audio fetches the smallest audio format and /thumbnail the cover, each only once"""
+        mock_yt_dlp.return_value.extract_info.return_value = {
+            "id": "123",
+            "title": "Test Video",
+            "thumbnail": "https://cdn.example/cover.jpeg",
+            "formats": [
+                {
+                    "format_id": "h264_540p",
+                    "ext": "mp4",
+                    "vcodec": "h264",
+                    "acodec": "aac",
+                    "filesize": 100,
+                    "url": "https://cdn.example/540.mp4",
+                },
+                {
+                    "format_id": "music",
+                    "ext": "m4a",
+                    "vcodec": "none",
+                    "acodec": "aac",
+                    "filesize": 500,
+                    "url": "https://cdn.example/music.m4a",
+                },
+            ],
+        }
+
+        def fake_get(url, **kwargs):
+            upstream = MagicMock()
+            upstream.headers = {
+                "Content-Type": "image/jpeg" if "cover" in url else "audio/mp4"
+            }
+            upstream.iter_content.return_value = iter([url.encode()])
+            return upstream
+
+        mock_session.get.side_effect = fake_get
+
+        for _ in range(2):
+            audio = self.client.get("/audio?url=https://www.tiktok.com/@test/video/123")
+            thumbnail = self.client.get(
+                "/thumbnail?url=https://www.tiktok.com/@test/video/123"
+            )
+
+        self.assertEqual(audio.status_code, 200)
+        self.assertEqual(audio.data, b"https://cdn.example/music.m4a")
+        self.assertTrue(audio.headers["Content-Disposition"].startswith("attachment"))
+        self.assertEqual(thumbnail.data, b"https://cdn.example/cover.jpeg")
+        self.assertEqual(thumbnail.mimetype, "image/jpeg")
+        self.assertEqual(
+            (audio.headers["X-Cache"], thumbnail.headers["X-Cache"]), ("HIT", "HIT")
+        )
+        self.assertEqual(mock_session.get.call_count, 2)
+
+        response = self.client.get(
+            "/thumbnail?url=https://www.tiktok.com/@test/video/123",
+            headers={"If-None-Match": thumbnail.headers["ETag"]},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_stream_unknown_format(self, mock_yt_dlp):
+        """Test streaming a format that does not exist"""
+        mock_yt_dlp.return_value.extract_info.return_value = {
+            "id": "123",
+            "formats": [
+                {"format_id": "h264_540p", "url": "https://cdn.example/540.mp4"}
+            ],
+        }
+        response = self.client.get(
+            "/stream?url=https://www.tiktok.com/@test/video/123&format_id=nope"
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def _create_download(self, content=b"0123456789"):
+        """Write a downloaded file and return its /file URL"""
+        os.makedirs(os.path.join(self.test_dir, "abc"))
+        with open(os.path.join(self.test_dir, "abc", "video.mp4"), "wb") as f:
+            f.write(content)
+        return "/file/abc/video.mp4"
+
+    def test_file_conditional_get(self):
+        """Test /file sends a content-hash ETag and answers revalidation with 304"""
+        import hashlib
+
+        url = self._create_download()
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.headers["ETag"], f'"{hashlib.sha256(b"0123456789").hexdigest()}"'
+        )
+        self.assertIn("Last-Modified", response.headers)
+        response.close()
+
+        response = self.client.get(
+            url, headers={"If-None-Match": response.headers["ETag"]}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+    def test_file_range_request(self):
+        """Test /file answers byte ranges with 206"""
+        url = self._create_download()
+        response = self.client.get(url, headers={"Range": "bytes=2-5"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b"2345")
+        self.assertEqual(response.headers["Content-Range"], "bytes 2-5/10")
+        response.close()
+
+    def test_file_uses_wsgi_file_wrapper(self):
+        """Test full-file responses go through the server's file wrapper for sendfile"""
+        from werkzeug.wsgi import FileWrapper
+
+        wrapped = []
+
+        class RecordingFileWrapper(FileWrapper):
+            def __init__(self, file, buffer_size=8192):
+                wrapped.append(file.name)
+                super().__init__(file, buffer_size)
+
+        url = self._create_download()
+        response = self.client.get(
+            url, environ_overrides={"wsgi.file_wrapper": RecordingFileWrapper}
+        )
+        self.assertEqual(response.data, b"0123456789")
+        self.assertEqual(len(wrapped), 1)
+        response.close()
+
+    def test_file_rejects_path_traversal(self):
+        """Test /file does not serve paths outside the downloads folder"""
+        response = self.client.get("/file/%2E%2E/app.py")
+        self.assertEqual(response.status_code, 404)
+
     def test_404_error_handler(self):
         """Test 404 error handler"""
-        response = self.client.get('/nonexistent')
+        response = self.client.get("/nonexistent")
         self.assertEqual(response.status_code, 404)
         data = json.loads(response.data)
-        self.assertIn('error', data)
-    
+        self.assertIn("error", data)
+
     def test_405_error_handler(self):
         """Test 405 error handler"""
-        response = self.client.put('/download')
+        response = self.client.put("/download")
         self.assertEqual(response.status_code, 405)
         data = json.loads(response.data)
-        self.assertIn('error', data)
-    
+        self.assertIn("error", data)
+
     def test_metrics_endpoint(self):
         """Test metrics endpoint"""
-        response = self.client.get('/metrics')
+        response = self.client.get("/metrics")
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'text/plain; charset=utf-8')
-        self.assertIn(b'app_', response.data)
+        self.assertEqual(response.content_type, "text/plain; charset=utf-8")
+        self.assertIn(b"app_", response.data)
+        self.assertIn(b"app_metadata_cache_hits_total", response.data)
+
+    def test_metrics_record_requests(self):
+        """Test requests are counted per endpoint and status with latency histograms"""
+        self.client.get("/health")
+        self.client.get("/jobs/unknown")
+        response = self.client.get("/metrics")
+        self.assertIn(
+            b"# TYPE app_http_request_duration_seconds histogram", response.data
+        )
+        self.assertIn(
+            b'app_http_requests_total{method="GET",endpoint="/health",status="200"}',
+            response.data,
+        )
+        self.assertIn(
+            b'app_http_requests_total{method="GET",endpoint="/jobs/<download_id>",status="404"}',
+            response.data,
+        )
+        self.assertIn(
+            b'app_http_request_duration_seconds_bucket{method="GET",endpoint="/health",le="+Inf"}',
+            response.data,
+        )
+        self.assertIn(b"app_http_requests_in_flight", response.data)
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    """Test cases for the Prometheus metrics registry"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test histogram rendering emits cumulative buckets, sum and count"""
+        from monitoring import MetricsRegistry
+
+        registry = MetricsRegistry()
+        histogram = registry.histogram(
+            "test_seconds", "Test timings", buckets=(0.1, 1.0)
+        )
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = registry.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("test_seconds_sum 5.55", lines)
+        self.assertIn("test_seconds_count 3", lines)
+
+    def test_workers_are_aggregated(self):
+        """Test counters from other workers are summed and dead workers' gauges dropped"""
+        from monitoring import MetricsRegistry
+
+        registry = MetricsRegistry()
+        registry.configure(self.test_dir)
+        registry.counter("test_total", "Test counter", ("status",)).inc(status="200")
+        registry.gauge("test_in_flight", "Test gauge").set(2)
+
+        # Snapshot left behind by a worker that has exited
+        other = {
+            "test_total": {
+                "kind": "counter",
+                "documentation": "Test counter",
+                "labelnames": ["status"],
+                "values": [[["200"], 4], [["500"], 1]],
+            },
+            "test_in_flight": {
+                "kind": "gauge",
+                "documentation": "Test gauge",
+                "labelnames": [],
+                "values": [[[], 7]],
+            },
+        }
+        with open(os.path.join(self.test_dir, "metrics_999999999.json"), "w") as f:
+            json.dump(other, f)
+
+        lines = registry.render()
+        self.assertIn('test_total{status="200"} 5', lines)
+        self.assertIn('test_total{status="500"} 1', lines)
+        self.assertIn("test_in_flight 2", lines)
+
+    def test_providers_are_aggregated(self):
+        """Test provider values go through METRICS_DIR like the registry's own metrics"""
+        from monitoring import MetricsRegistry
+
+        registry = MetricsRegistry()
+        registry.configure(self.test_dir)
+        registry.register_provider(
+            "test", lambda: {"calls_total": 3, "open": 1, "state": "closed"}
+        )
+        other = MetricsRegistry()
+        other.register_provider("test", lambda: {"calls_total": 4, "open": 1})
+        # Left behind by a worker that has exited: its counter stays, its gauge goes
+        with open(os.path.join(self.test_dir, "metrics_999999999.json"), "w") as f:
+            json.dump(other.snapshot(), f)
+
+        lines = registry.render()
+        self.assertIn("# TYPE app_test_calls_total counter", lines)
+        self.assertIn("app_test_calls_total 7", lines)
+        self.assertIn("app_test_open 1", lines)
+        self.assertNotIn("app_test_state", lines)
+
+    def test_shared_gauges_take_the_max(self):
+        """Test gauges describing state every worker shares are not multiplied by the worker count"""
+        from monitoring import MetricsRegistry
+
+        registry = MetricsRegistry()
+        registry.configure(self.test_dir)
+        registry.register_provider(
+            "test", lambda: {"blobs": 3, "in_use": 1}, shared=("blobs",)
+        )
+        other = MetricsRegistry()
+        other.register_provider(
+            "test", lambda: {"blobs": 3, "in_use": 2}, shared=("blobs",)
+        )
+        # A live worker: this process' parent
+        with open(
+            os.path.join(self.test_dir, f"metrics_{os.getppid()}.json"), "w"
+        ) as f:
+            json.dump(other.snapshot(), f)
+
+        lines = registry.render()
+        self.assertIn("app_test_blobs 3", lines)
+        self.assertIn("app_test_in_use 3", lines)
+
+    def test_retired_workers_are_folded(self):
+        """Test an exited worker's counters move to retired.json and its file is removed"""
+        from monitoring import MetricsRegistry
+
+        registry = MetricsRegistry()
+        registry.configure(self.test_dir)
+        counter = registry.counter("test_total", "Test counter")
+        counter.inc(2)
+        for pid in (999999998, 999999999):
+            other = MetricsRegistry()
+            other.counter("test_total", "Test counter").inc(3)
+            other.gauge("test_in_flight", "Test gauge").set(1)
+            with open(os.path.join(self.test_dir, f"metrics_{pid}.json"), "w") as f:
+                json.dump(other.snapshot(), f)
+            registry.retire(pid)
+
+        self.assertEqual(
+            sorted(os.listdir(self.test_dir)), ["metrics.lock", "retired.json"]
+        )
+        lines = registry.render()
+        self.assertIn("test_total 8", lines)
+        self.assertNotIn("test_in_flight 1", lines)
+        # A new worker reusing a retired PID starts from zero
+        with open(os.path.join(self.test_dir, "metrics_999999999.json"), "w") as f:
+            json.dump({}, f)
+        self.assertIn("test_total 8", registry.render())
+
+
+class AsgiTestCase(unittest.TestCase):
+    """Test cases for the ASGI entry point"""
+
+    def setUp(self):
+        app.config.from_object(TestingConfig)
+        self.test_dir = tempfile.mkdtemp()
+        app.config["UPLOAD_FOLDER"] = self.test_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def _request(self, method, path, query=b"", headers=(), body=b""):
+        """Drive asgi:app with one request and return (status, headers, body)"""
+        import asyncio
+
+        from asgi import app as asgi_app
+
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query,
+            "headers": [(name.encode(), value.encode()) for name, value in headers],
+            "server": ("testserver", 80),
+            "client": ("127.0.0.1", 1234),
+            "scheme": "http",
+        }
+        asyncio.run(asgi_app(scope, receive, send))
+        start = sent[0]
+        self.assertFalse(sent[-1].get("more_body"))
+        return (
+            start["status"],
+            {k.decode(): v.decode() for k, v in start["headers"]},
+            b"".join(message.get("body", b"") for message in sent[1:]),
+        )
+
+    def test_json_routes(self):
+        """Test regular Flask routes are served through the ASGI bridge"""
+        status, headers, body = self._request("GET", "/health")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["status"], "healthy")
+
+        status, _, body = self._request(
+            "POST",
+            "/download",
+            headers=[("Content-Type", "application/json")],
+            body=b"{}",
+        )
+        self.assertEqual(status, 400)
+
+    def test_file_range_request(self):
+        """Test /file byte ranges and full bodies are sent in chunks"""
+        os.makedirs(os.path.join(self.test_dir, "abc"))
+        content = os.urandom(200 * 1024)
+        with open(os.path.join(self.test_dir, "abc", "video.mp4"), "wb") as f:
+            f.write(content)
+
+        status, headers, body = self._request(
+            "GET", "/file/abc/video.mp4", headers=[("Range", "bytes=2-5")]
+        )
+        self.assertEqual(status, 206)
+        self.assertEqual(body, content[2:6])
+
+        status, headers, body = self._request("GET", "/file/abc/video.mp4")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, content)
+        self.assertEqual(headers["content-length"], str(len(content)))
+
+    def test_progress_stream(self):
+        """Test /progress is served natively and ends with the final job state"""
+        from app import job_queue
+
+        job_queue.submit(
+            "asgi-progress", lambda progress_hook: {"download_url": "/file/x/y.mp4"}
+        )
+        deadline = time.time() + 5
+        while job_queue.is_active("asgi-progress") and time.time() < deadline:
+            time.sleep(0.01)
+
+        status, headers, body = self._request("GET", "/progress/asgi-progress")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["content-type"].startswith("text/event-stream"))
+        self.assertIn(b"event: finished", body)
+        self.assertIn(b"/file/x/y.mp4", body)
+
+        status, _, _ = self._request("GET", "/progress/unknown")
+        self.assertEqual(status, 404)
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    """Test cases for the metadata cache"""
+
+    def test_lru_eviction(self):
+        """Test least recently used entry is evicted when full"""
+        from cache import TTLCache
+
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl_expiry(self):
+        """Test expired entries are treated as misses"""
+        from cache import TTLCache
+
+        cache = TTLCache(maxsize=2, ttl=0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+
+class ProgressBrokerTestCase(unittest.TestCase):
+    """Test cases for progress event channels"""
+
+    def test_progress_events_are_coalesced(self):
+        """Test fast progress updates are coalesced while state changes always wake subscribers"""
+        from progress import ProgressBroker
+
+        broker = ProgressBroker(min_interval=60)
+        broker.publish("a", {"status": "running", "progress": 1})
+        broker.publish("a", {"status": "running", "progress": 2})
+        self.assertEqual(broker.metrics()["coalesced_total"], 1)
+
+        # The coalesced event is still the latest state
+        self.assertEqual(
+            broker.wait("a", 0, timeout=0), (2, {"status": "running", "progress": 2})
+        )
+        self.assertIsNone(broker.wait("a", 2, timeout=0))
+        self.assertIsNone(broker.wait("unknown", 0, timeout=0))
+
+    def test_async_subscribers_are_woken(self):
+        """Test an async subscriber is woken by a publish from another thread"""
+        import asyncio
+        import threading
+
+        from progress import ProgressBroker
+
+        broker = ProgressBroker()
+        broker.publish("a", {"status": "running"})
+
+        async def subscribe():
+            waiting = asyncio.ensure_future(broker.wait_async("a", 1, timeout=5))
+            await asyncio.sleep(0.01)
+            self.assertEqual(broker.metrics()["async_subscribers"], 1)
+            threading.Thread(
+                target=broker.publish, args=("a", {"status": "finished"})
+            ).start()
+            return await waiting
+
+        self.assertEqual(asyncio.run(subscribe()), (2, {"status": "finished"}))
+        self.assertEqual(broker.metrics()["async_subscribers"], 0)
+
+
+class FormatSelectionTestCase(unittest.TestCase):
+    """Test cases for server-side format selection"""
+
+    FORMATS = [
+        {
+            "format_id": "audio",
+            "url": "https://cdn/audio",
+            "vcodec": "none",
+            "acodec": "aac",
+            "filesize": 10,
+        },
+        {
+            "format_id": "download",
+            "url": "https://cdn/d",
+            "width": 576,
+            "height": 1024,
+            "vcodec": "h264",
+            "filesize": 400,
+            "format_note": "Download video, watermarked",
+        },
+        {
+            "format_id": "h264_540p",
+            "url": "https://cdn/a",
+            "width": 576,
+            "height": 1024,
+            "vcodec": "h264",
+            "filesize": 600,
+        },
+        {
+            "format_id": "bytevc1_540p",
+            "url": "https://cdn/b",
+            "width": 576,
+            "height": 1024,
+            "vcodec": "h265",
+            "filesize": 450,
+        },
+        {
+            "format_id": "h264_720p",
+            "url": "https://cdn/c",
+            "width": 720,
+            "height": 1280,
+            "vcodec": "h264",
+            "tbr": 1600,
+        },
+    ]
+
+    def _select(self, duration=None, **target):
+        from formats import FormatTarget, select_format
+
+        fmt = select_format(self.FORMATS, FormatTarget(**target), duration)
+        return fmt and fmt["format_id"]
+
+    def test_targets(self):
+        """Test height, codec, watermark and size targets pick the cheapest fitting format"""
+        self.assertEqual(self._select(), "h264_720p")
+        self.assertEqual(self._select(max_height=540), "bytevc1_540p")
+        self.assertEqual(self._select(max_height=540, codec="h264"), "h264_540p")
+        self.assertEqual(
+            self._select(max_height=540, codec="h264", no_watermark=True), "h264_540p"
+        )
+        # 720p at 1600 kbit/s for 10 seconds is estimated at 2 MB
+        self.assertEqual(self._select(duration=10, max_bytes=3000000), "h264_720p")
+        self.assertEqual(self._select(duration=10, max_bytes=500), "bytevc1_540p")
+        self.assertIsNone(self._select(max_height=360))
+
+    def test_audio_format(self):
+        """Test audio selection prefers audio-only formats and skips segmented ones"""
+        from formats import select_audio_format
+
+        formats = [
+            {
+                "format_id": "hls",
+                "url": "https://cdn/a.m3u8",
+                "vcodec": "none",
+                "acodec": "aac",
+                "protocol": "m3u8_native",
+            },
+            *self.FORMATS,
+        ]
+        self.assertEqual(select_audio_format(formats)["format_id"], "audio")
+        self.assertEqual(select_audio_format(self.FORMATS[1:])["format_id"], "download")
+        self.assertIsNone(select_audio_format([]))
+
+    def test_target_from_request(self):
+        """Test request parsing validates fields and ignores requests without a target"""
+        from formats import FormatTarget
+
+        self.assertIsNone(FormatTarget.from_request({"url": "x"}))
+        self.assertIsNone(
+            FormatTarget.from_request({"url": "x", "no_watermark": False})
+        )
+        self.assertEqual(
+            vars(FormatTarget.from_request({"max_height": 540, "codec": "h265"})),
+            {
+                "max_height": 540,
+                "max_bytes": None,
+                "codec": "h265",
+                "no_watermark": False,
+            },
+        )
+        for data in (
+            {"max_height": "540"},
+            {"max_bytes": 0},
+            {"max_height": True},
+            {"codec": "vp9"},
+            {"no_watermark": "yes"},
+        ):
+            with self.assertRaises(ValueError):
+                FormatTarget.from_request(data)
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+    """Test cases for upstream admission control"""
+
+    def test_slots_go_to_clients_in_turn(self):
+        """Test a freed slot goes to the next client rather than the one with the most waiting"""
+        import threading
+
+        from admission import AdmissionController
+
+        admission = AdmissionController(max_concurrent=1, per_client=4)
+        admission.acquire("busy")
+        order = []
+
+        def wait_for_slot(client):
+            admission.acquire(client, timeout=5)
+            order.append(client)
+            admission.release(client)
+
+        threads = []
+        for client in ("busy", "busy", "quiet"):
+            threads.append(threading.Thread(target=wait_for_slot, args=(client,)))
+            threads[-1].start()
+            while admission.metrics()["queued"] < len(threads):
+                time.sleep(0.001)
+        admission.release("busy")
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, ["busy", "quiet", "busy"])
+        self.assertEqual(admission.metrics()["active"], 0)
+
+    def test_per_client_limit(self):
+        """Test a client is capped while other clients still get slots"""
+        from admission import AdmissionController, AdmissionRejected
+
+        admission = AdmissionController(
+            max_concurrent=4, per_client=1, per_client_queue=0
+        )
+        admission.acquire("a")
+        with self.assertRaises(AdmissionRejected) as rejected:
+            admission.acquire("a", timeout=0)
+        self.assertEqual(rejected.exception.status, 429)
+        admission.acquire("b", timeout=0)
+        self.assertEqual(admission.metrics()["rejected_client_limit_total"], 1)
+
+    def test_queue_timeout(self):
+        """Test a request that waits too long is rejected with 503 and leaves the queue"""
+        from admission import AdmissionController, AdmissionRejected
+
+        admission = AdmissionController(max_concurrent=1)
+        with admission.slot("a"):
+            with self.assertRaises(AdmissionRejected) as rejected:
+                admission.acquire("b", timeout=0.01)
+        self.assertEqual(rejected.exception.status, 503)
+        metrics = admission.metrics()
+        self.assertEqual(
+            (metrics["queued"], metrics["active"], metrics["rejected_timeout_total"]),
+            (0, 0, 1),
+        )
+
+
+class UpstreamGuardTestCase(unittest.TestCase):
+    """Test cases for the upstream circuit breaker and retry budget"""
+
+    @staticmethod
+    def _throttled():
+        raise RuntimeError(
+            "ERROR: [TikTok] 1: Unable to download webpage: HTTP Error 429: Too Many Requests"
+        )
+
+    def test_breaker_opens_and_probes(self):
+        """Test the circuit opens on a burst of throttling, then a single probe closes or reopens it"""
+        from upstream import UpstreamGuard, UpstreamUnavailable
+
+        guard = UpstreamGuard(threshold=2, cooldown=10, max_retries=0)
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                guard.call("extraction", self._throttled)
+        with self.assertRaises(UpstreamUnavailable) as rejected:
+            guard.call("extraction", lambda: "info")
+        self.assertEqual(rejected.exception.status, 503)
+        self.assertEqual(guard.metrics()["open"], 1)
+
+        # Past the cooldown one probe goes through; a throttled probe reopens the circuit
+        guard._open_until = 0
+        with self.assertRaises(RuntimeError):
+            guard.call("extraction", self._throttled)
+        self.assertEqual(guard.metrics()["opened_total"], 2)
+
+        guard._open_until = 0
+        seen = []
+
+        def probe():
+            # Other calls are turned away while the probe is in flight
+            with self.assertRaises(UpstreamUnavailable):
+                guard.call("extraction", lambda: "info")
+            seen.append(True)
+            return "info"
+
+        self.assertEqual(guard.call("extraction", probe), "info")
+        self.assertEqual(seen, [True])
+        self.assertEqual(guard.call("extraction", lambda: "info"), "info")
+        self.assertEqual(guard.metrics()["open"], 0)
+
+    def test_other_errors_do_not_open_breaker(self):
+        """Test errors that are not throttling are raised at once and never trip the circuit"""
+        from upstream import UpstreamGuard
+
+        guard = UpstreamGuard(threshold=1)
+        calls = []
+
+        def not_found():
+            calls.append(True)
+            raise RuntimeError("Video unavailable")
+
+        with self.assertRaises(RuntimeError):
+            guard.call("extraction", not_found)
+        self.assertEqual((len(calls), guard.metrics()["open"]), (1, 0))
+
+    @patch("upstream.time.sleep")
+    def test_retry_budget(self, mock_sleep):
+        """Test throttled calls are retried with jittered backoff until the shared budget runs out"""
+        from upstream import UpstreamGuard, UpstreamUnavailable
+
+        guard = UpstreamGuard(
+            threshold=100, max_retries=2, retry_ratio=0, retry_burst=3, max_delay=5
+        )
+        attempts = []
+
+        def flaky():
+            attempts.append(True)
+            if len(attempts) < 3:
+                self._throttled()
+            return "info"
+
+        self.assertEqual(guard.call("download", flaky), "info")
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertTrue(
+            all(0 <= call.args[0] <= 5 for call in mock_sleep.call_args_list)
+        )
+
+        # One token left: the next failing call gets a single retry, the yt-dlp hook none
+        with self.assertRaises(RuntimeError):
+            guard.call("download", self._throttled)
+        self.assertEqual(guard.metrics()["retries_total"], 3)
+        with self.assertRaises(UpstreamUnavailable):
+            guard.retry_sleep(0)
+        self.assertEqual(guard.metrics()["retry_budget_exhausted_total"], 2)
+
+
+class MetadataStoreTestCase(unittest.TestCase):
+    """Test cases for the persistent metadata store"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_freshness_window(self):
+        """Test entries older than the freshness window are misses"""
+        from metadata_store import MetadataStore
+
+        store = MetadataStore(os.path.join(self.test_dir, "metadata.db"), freshness=60)
+        store.put("123", {"id": "123", "title": "Test Video"})
+        self.assertEqual(store.get("123")["title"], "Test Video")
+        self.assertIsNone(store.get("123", freshness=-1))
+        self.assertIsNone(store.get("456"))
+        self.assertEqual(store.metrics()["hits_total"], 1)
+
+    def test_shared_between_connections(self):
+        """Test a second store on the same file sees writes and bulk lookups work"""
+        from metadata_store import MetadataStore
+
+        path = os.path.join(self.test_dir, "metadata.db")
+        MetadataStore(path).put("1", {"id": "1"})
+        MetadataStore(path).put("2", {"id": "2"})
+        found = MetadataStore(path).get_many(["1", "2", "3"])
+        self.assertEqual(sorted(found), ["1", "2"])
+        self.assertEqual(found["2"]["info"], {"id": "2"})
+
+
+class CanonicalTestCase(unittest.TestCase):
+    """Test cases for URL canonicalization and the video index"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_url_variants_share_a_key(self):
+        """Test mobile, tracking-parameter and scheme-less variants normalize to one URL"""
+        from canonical import normalize_url, video_key
+
+        canonical = "https://www.tiktok.com/@user/video/7123"
+        for url in (
+            "https://www.tiktok.com/@user/video/7123?is_from_webapp=1&sender_device=pc",
+            "www.tiktok.com/@user/video/7123/#comments",
+            "https://m.tiktok.com/@user/video/7123",
+        ):
+            self.assertEqual(normalize_url(url), canonical)
+            self.assertEqual(video_key(url), "7123")
+        self.assertEqual(video_key("https://m.tiktok.com/v/7123.html"), "7123")
+        self.assertEqual(
+            video_key("https://vm.tiktok.com/ZMabc/?k=1"), "https://vm.tiktok.com/ZMabc"
+        )
+        self.assertEqual(
+            normalize_url(" https://example.com/a.mp4?x=1 "),
+            "https://example.com/a.mp4?x=1",
+        )
+
+    def test_short_links_are_resolved_once(self):
+        """Test short links are resolved by redirect, cached and persisted as aliases"""
+        from canonical import Canonicalizer
+        from video_index import VideoIndex
+
+        session = MagicMock()
+        session.head.return_value.url = "https://www.tiktok.com/@user/video/7123?_r=1"
+        index = VideoIndex(self.test_dir)
+        canonicalizer = Canonicalizer(session, get_index=lambda: index)
+
+        expected = ("7123", "https://www.tiktok.com/@user/video/7123")
+        self.assertEqual(
+            canonicalizer.resolve("https://vm.tiktok.com/ZMabc/"), expected
+        )
+        self.assertEqual(canonicalizer.resolve("vm.tiktok.com/ZMabc"), expected)
+        self.assertEqual(session.head.call_count, 1)
+
+        # A fresh worker reads the alias from the index instead of the network
+        restarted = Canonicalizer(session, get_index=lambda: VideoIndex(self.test_dir))
+        self.assertEqual(restarted.resolve("https://vm.tiktok.com/ZMabc/")[0], "7123")
+        self.assertEqual(session.head.call_count, 1)
+
+    def test_failed_resolution_falls_back_to_url(self):
+        """Test an unresolvable short link is passed on for yt-dlp to follow"""
+        from canonical import Canonicalizer
+
+        session = MagicMock()
+        session.head.side_effect = Exception("timeout")
+        canonicalizer = Canonicalizer(session)
+        self.assertEqual(
+            canonicalizer.resolve("https://vm.tiktok.com/ZMabc/"),
+            ("https://vm.tiktok.com/ZMabc", "https://vm.tiktok.com/ZMabc"),
+        )
+        self.assertEqual(canonicalizer.metrics()["resolve_failures_total"], 1)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """Test cases for request coalescing"""
+
+    def _run_concurrently(self, callables):
+        """Start callables together and collect their results"""
+        import threading
+
+        results = [None] * len(callables)
+
+        def run(i):
+            try:
+                results[i] = callables[i]()
+            except Exception as e:
+                results[i] = e
+
+        threads = [
+            threading.Thread(target=run, args=(i,)) for i in range(len(callables))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_result(self):
+        """Test only one caller runs the function for a key"""
+        from singleflight import SingleFlight
+
+        flight = SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"id": "123"}
+
+        results = self._run_concurrently([lambda: flight.do("info:123", slow)] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"id": "123"}] * 5)
+        self.assertEqual(flight.coalesced, 4)
+
+    def test_errors_propagate_to_waiters(self):
+        """Test waiters see the leader's exception"""
+        from singleflight import SingleFlight
+
+        flight = SingleFlight()
+
+        def failing():
+            time.sleep(0.1)
+            raise ValueError("HTTP Error 429")
+
+        results = self._run_concurrently([lambda: flight.do("info:123", failing)] * 3)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+    def test_shared_dir_coalesces_across_instances(self):
+        """Test separate workers sharing a directory reuse one result"""
+        from singleflight import SingleFlight
+
+        shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_dir)
+        # Separate instances stand in for separate gunicorn workers
+        workers = [SingleFlight(), SingleFlight()]
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"title": "Test Video"}
+
+        def second_worker():
+            time.sleep(0.05)
+            return workers[1].do("info:123", slow, shared_dir=shared_dir)
+
+        results = self._run_concurrently(
+            [
+                lambda: workers[0].do("info:123", slow, shared_dir=shared_dir),
+                second_worker,
+            ]
+        )
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"title": "Test Video"}] * 2)
+        # The last caller out removes the lock and the published result
+        self.assertEqual(os.listdir(shared_dir), [])
+
+    def test_shared_dir_left_empty(self):
+        """Test a call leaves no lock or result files behind, whether it succeeds or fails"""
+        from singleflight import SingleFlight
+
+        shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_dir)
+        flight = SingleFlight()
+        self.assertEqual(
+            flight.do("info:123", lambda: {"id": "123"}, shared_dir=shared_dir),
+            {"id": "123"},
+        )
+        self.assertEqual(os.listdir(shared_dir), [])
+        with self.assertRaises(ValueError):
+            flight.do("info:123", lambda: int("x"), shared_dir=shared_dir)
+        self.assertEqual(os.listdir(shared_dir), [])
+
+    def test_waiters_give_up_at_their_timeout(self):
+        """Test callers joining a slow call stop waiting at their own timeout, in and across processes"""
+        from deadlines import DeadlineExceeded
+        from singleflight import SingleFlight
+
+        shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_dir)
+        workers = [SingleFlight(), SingleFlight()]
+
+        def slow():
+            time.sleep(0.5)
+            return {"id": "123"}
+
+        def joining(flight):
+            def call():
+                time.sleep(0.05)
+                started = time.monotonic()
+                try:
+                    return flight.do(
+                        "info:123", slow, shared_dir=shared_dir, timeout=0.1
+                    )
+                finally:
+                    self.assertLess(time.monotonic() - started, 0.4)
+
+            return call
+
+        results = self._run_concurrently(
+            [
+                lambda: workers[0].do("info:123", slow, shared_dir=shared_dir),
+                joining(workers[0]),
+                joining(workers[1]),
+            ]
+        )
+        self.assertEqual(results[0], {"id": "123"})
+        self.assertIsInstance(results[1], DeadlineExceeded)
+        self.assertIsInstance(results[2], DeadlineExceeded)
+        self.assertEqual(os.listdir(shared_dir), [])
+
+
+class SharedStateTestCase(unittest.TestCase):
+    """Test cases for state shared between gunicorn workers"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_jobs_are_visible_to_other_workers(self):
+        """Test a job run by one queue can be read through another sharing the state directory"""
+        import threading
+
+        from jobs import JobQueue
+
+        state_dir = os.path.join(self.test_dir, "jobs")
+        running, release = threading.Event(), threading.Event()
+
+        def work(progress_hook):
+            running.set()
+            release.wait(5)
+            return {"filename": "video.mp4"}
+
+        worker, other = JobQueue(state_dir=state_dir), JobQueue(state_dir=state_dir)
+        worker.submit("job-1", work)
+        running.wait(5)
+        self.assertEqual(other.get("job-1")["status"], "running")
+        self.assertTrue(other.is_active("job-1"))
+        self.assertFalse(other.is_local("job-1"))
+        release.set()
+
+        deadline = time.time() + 5
+        while other.get("job-1")["status"] != "finished" and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(other.get("job-1")["result"], {"filename": "video.mp4"})
+        self.assertIsNone(other.get("../job-1"))
+
+        # A job whose worker exited mid-download is reported as failed
+        with open(os.path.join(state_dir, "job-2.json"), "w") as f:
+            json.dump(
+                {
+                    **worker.get("job-1"),
+                    "download_id": "job-2",
+                    "status": "running",
+                    "pid": 999999999,
+                },
+                f,
+            )
+        self.assertEqual(other.get("job-2")["status"], "failed")
+        self.assertFalse(other.is_active("job-2"))
+
+    def test_store_updates_from_workers_are_not_lost(self):
+        """Test concurrent index updates through separate store instances all survive"""
+        import threading
+
+        from store import VideoStore
+
+        root = os.path.join(self.test_dir, ".store")
+        stores = [VideoStore(root), VideoStore(root)]
+
+        def add_videos(worker):
+            for i in range(20):
+                path = os.path.join(self.test_dir, f"{worker}-{i}.mp4")
+                with open(path, "wb") as f:
+                    f.write(b"video")
+                stores[worker].add(f"{worker}-{i}", "best", path, "Video")
+
+        threads = [
+            threading.Thread(target=add_videos, args=(worker,)) for worker in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(VideoStore(root).entries()), 40)
+
+    def test_index_updates_from_workers_are_not_lost(self):
+        """Test concurrent video index updates through separate instances all survive"""
+        import threading
+
+        from video_index import VideoIndex
+
+        indexes = [VideoIndex(self.test_dir), VideoIndex(self.test_dir)]
+
+        def add_videos(worker):
+            for i in range(20):
+                indexes[worker].record_download(
+                    f"{worker}-{i}", f"download-{worker}-{i}"
+                )
+                indexes[worker].add_alias(
+                    f"https://vm.tiktok.com/{worker}-{i}", f"{worker}-{i}"
+                )
+
+        threads = [
+            threading.Thread(target=add_videos, args=(worker,)) for worker in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            VideoIndex(self.test_dir).metrics(), {"videos": 40, "aliases": 40}
+        )
+
+    def test_json_store_index_is_imported(self):
+        """Test a store index written as JSON by older releases moves into the database"""
+        from store import VideoStore
+
+        root = os.path.join(self.test_dir, ".store")
+        os.makedirs(os.path.join(root, "123"))
+        with open(os.path.join(root, "123", "best.mp4"), "wb") as f:
+            f.write(b"video")
+        entry = {"video_id": "123", "path": "123/best.mp4", "size": 5}
+        with open(os.path.join(root, "index.json"), "w") as f:
+            json.dump({"123:best": entry}, f)
+
+        self.assertEqual(VideoStore(root).lookup("123", "best"), entry)
+        self.assertFalse(os.path.exists(os.path.join(root, "index.json")))
+
+    def test_json_video_index_is_imported(self):
+        """Test a video index written as JSON by older releases moves into the database"""
+        from video_index import VideoIndex
+
+        root = os.path.join(self.test_dir, ".store")
+        os.makedirs(root)
+        with open(os.path.join(root, "videos.json"), "w") as f:
+            json.dump(
+                {
+                    "videos": {"123": {"metadata": {"title": "Video"}}},
+                    "aliases": {"https://vm.tiktok.com/x": {"video_id": "123"}},
+                },
+                f,
+            )
+
+        index = VideoIndex(self.test_dir)
+        self.assertEqual(index.get("123")["metadata"], {"title": "Video"})
+        self.assertEqual(index.alias("https://vm.tiktok.com/x"), "123")
+        self.assertFalse(os.path.exists(os.path.join(root, "videos.json")))
+
+    def test_index_keeps_the_most_recent_videos(self):
+        """Test the video index trims least recently updated videos and caps downloads per video"""
+        from video_index import MAX_DOWNLOADS_PER_VIDEO, VideoIndex
+
+        index = VideoIndex(self.test_dir, maxsize=2)
+        for i in range(MAX_DOWNLOADS_PER_VIDEO + 5):
+            os.makedirs(os.path.join(self.test_dir, f"download-{i}"))
+            index.record_download("1", f"download-{i}")
+        index.record_metadata("2", {"title": "Two"})
+        index.record_metadata("3", {"title": "Three"})
+        index.trim()
+
+        self.assertIsNone(index.get("1"))
+        self.assertEqual(index.get("3")["metadata"], {"title": "Three"})
+        index.record_download("3", "download-0")
+        index.record_download("3", "download-1")
+        index.record_download("3", "download-0")
+        self.assertEqual(index.get("3")["download_ids"], ["download-1", "download-0"])
+
+    def test_result_updates_after_finish(self):
+        """Test result fields added while a job runs or after it finished both end up in its result"""
+        import threading
+
+        from jobs import JobQueue
+
+        queue = JobQueue()
+        release = threading.Event()
+
+        def work(progress_hook):
+            queue.update_result("job", variants={"480p": {}})
+            release.wait(5)
+            return {"filename": "video.mp4", "variants": {}}
+
+        queue.submit("job", work)
+        release.set()
+        while queue.get("job")["status"] != "finished":
+            time.sleep(0.01)
+        self.assertEqual(queue.get("job")["result"]["variants"], {"480p": {}})
+        queue.update_result("job", pending_variants=[])
+        self.assertEqual(
+            queue.get("job")["result"],
+            {"filename": "video.mp4", "variants": {"480p": {}}, "pending_variants": []},
+        )
+
+
+class JanitorTestCase(unittest.TestCase):
+    """Test cases for downloads eviction"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _make_download(self, download_id, size, age):
+        """Create a download directory last served age seconds ago"""
+        download_dir = os.path.join(self.test_dir, download_id)
+        os.makedirs(download_dir)
+        with open(os.path.join(download_dir, "video.mp4"), "wb") as f:
+            f.write(b"x" * size)
+        served = time.time() - age
+        os.utime(download_dir, (served, served))
+
+    def _janitor(self, **limits):
+        from janitor import Janitor
+
+        return Janitor(get_folder=lambda: self.test_dir, **limits)
+
+    def test_evicts_by_age(self):
+        """Test downloads not served within max_age are removed"""
+        self._make_download("old", 10, age=7200)
+        self._make_download("new", 10, age=10)
+        janitor = self._janitor(max_age=3600)
+        self.assertEqual(janitor.run_once(), {"age": 1})
+        self.assertEqual(sorted(os.listdir(self.test_dir)), [".store", "new"])
+
+    def test_evicts_least_recently_served_over_quota(self):
+        """Test byte quota evicts least recently served downloads first"""
+        self._make_download("a", 100, age=30)
+        self._make_download("b", 100, age=20)
+        self._make_download("c", 100, age=10)
+        janitor = self._janitor(max_bytes=250)
+        janitor.touch(os.path.join(self.test_dir, "a"))
+        self.assertEqual(janitor.run_once(), {"bytes": 1})
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, "b")))
+        self.assertEqual(janitor.metrics()["evicted_bytes_total"], 100)
+
+    def test_never_evicts_download_in_use(self):
+        """Test downloads being served or written are skipped"""
+        self._make_download("serving", 10, age=7200)
+        self._make_download("writing", 10, age=7200)
+        janitor = self._janitor(
+            max_age=3600,
+            max_files=1,
+            is_busy=lambda download_id: download_id == "writing",
+        )
+        janitor.acquire("serving")
+        self.assertEqual(janitor.run_once(), {})
+        janitor.release("serving")
+        self.assertEqual(janitor.run_once(), {"age": 1})
+
+    def test_keeps_stored_blob_while_linked(self):
+        """Test store blobs are evicted only once no download links to them"""
+        from store import VideoStore
+
+        store = VideoStore.for_folder(self.test_dir)
+        src = os.path.join(self.test_dir, "staging.mp4")
+        with open(src, "wb") as f:
+            f.write(b"x" * 100)
+        entry = store.add("123", "h264_540p", src, "Test Video")
+        store.link(entry, os.path.join(self.test_dir, "dl", "video.mp4"))
+
+        janitor = self._janitor(max_bytes=50)
+        with patch("janitor.ORPHAN_GRACE_SECONDS", -1):
+            self.assertEqual(janitor.run_once(), {"bytes": 2})
+        self.assertIsNone(store.lookup("123", "h264_540p"))
+
+
+class PostProcessTestCase(unittest.TestCase):
+    """Test cases for ffmpeg post-processing"""
+
+    MP4_MOOV_LAST = (
+        b"\x00\x00\x00\x10ftypisom\x00\x00\x02\x00"
+        + b"\x00\x00\x00\x0cmdatdata"
+        + b"\x00\x00\x00\x08moov"
+    )
+    MP4_MOOV_FIRST = (
+        b"\x00\x00\x00\x10ftypisom\x00\x00\x02\x00"
+        + b"\x00\x00\x00\x08moov"
+        + b"\x00\x00\x00\x0cmdatdata"
+    )
+
+    @classmethod
+    def fake_ffmpeg(cls, directory, exit_code=0):
+        """Stand-in ffmpeg that writes a faststart file to its output path"""
+        import sys
+
+        path = os.path.join(directory, f"ffmpeg-{exit_code}")
+        with open(path, "w") as f:
+            f.write(
+                f"#!{sys.executable}\n"
+                "import sys\n"
+                f'open(sys.argv[-1], "wb").write({cls.MP4_MOOV_FIRST!r})\n'
+                f"sys.exit({exit_code})\n"
+            )
+        os.chmod(path, 0o755)
+        return path
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.test_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_needs_faststart(self):
+        """Test the moov box position is read from the top-level boxes"""
+        from postprocess import needs_faststart
+
+        self.assertTrue(needs_faststart(self._write("last.mp4", self.MP4_MOOV_LAST)))
+        self.assertFalse(needs_faststart(self._write("first.mp4", self.MP4_MOOV_FIRST)))
+        self.assertFalse(needs_faststart(self._write("text.mp4", b"not a video")))
+
+    def test_process_runs_ffmpeg(self):
+        """Test outputs are written atomically, and already faststart files are skipped"""
+        from postprocess import PostProcessor
+
+        processor = PostProcessor(ffmpeg=self.fake_ffmpeg(self.test_dir))
+        src = self._write("last.mp4", self.MP4_MOOV_LAST)
+        dest = os.path.join(self.test_dir, "out.mp4")
+
+        self.assertTrue(processor.process(src, dest, "faststart"))
+        self.assertFalse(
+            processor.process(
+                dest, os.path.join(self.test_dir, "again.mp4"), "faststart"
+            )
+        )
+        self.assertTrue(
+            processor.process(src, os.path.join(self.test_dir, "small.mp4"), "480p")
+        )
+        self.assertEqual(processor.metrics()["runs_total"], 2)
+        self.assertEqual(processor.metrics()["skipped_total"], 1)
+
+        failing = PostProcessor(ffmpeg=self.fake_ffmpeg(self.test_dir, exit_code=1))
+        with self.assertRaises(RuntimeError):
+            failing.process(src, os.path.join(self.test_dir, "failed.mp4"), "480p")
+        self.assertEqual(failing.metrics()["failures_total"], 1)
+        self.assertFalse(
+            [name for name in os.listdir(self.test_dir) if "failed" in name]
+        )
+
+    def test_unavailable_without_ffmpeg(self):
+        """Test the stage reports itself unavailable when ffmpeg is missing"""
+        from postprocess import PostProcessor
+
+        with patch("shutil.which", return_value=None):
+            self.assertFalse(PostProcessor().available)
+
+
+class FakeS3Client:
+    """In-memory stand-in for the boto3 S3 client calls used by S3Storage"""
+
+    class NotFound(Exception):
+        response = {"ResponseMetadata": {"HTTPStatusCode": 404}}
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key, Config=None):
+        with open(path, "rb") as f:
+            self.objects[key] = f.read()
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.NotFound()
+        return {"ContentLength": len(self.objects[Key])}
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        return (
+            f"https://{Params['Bucket']}.s3.example/{Params['Key']}?expires={ExpiresIn}"
+        )
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(key for key in client.objects if key.startswith(Prefix))
+                for start in range(0, len(keys), 2):
+                    yield {
+                        "Contents": [{"Key": key} for key in keys[start : start + 2]]
+                    }
+
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.objects.pop(item["Key"], None)
+
+
+class StorageTestCase(unittest.TestCase):
+    """Test cases for the download storage backends"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        app.config["UPLOAD_FOLDER"] = self.test_dir
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _storage(self):
+        from storage import S3Storage
+
+        return S3Storage("videos", prefix="downloads/", client=FakeS3Client())
+
+    def _write(self, name, data=b"0123456789"):
+        path = os.path.join(self.test_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_s3_storage(self):
+        """Test uploads land under the key prefix, and prefixes are deleted page by page"""
+        storage = self._storage()
+        for name in ("a.mp4", "b.mp4", "c.mp4"):
+            storage.upload(f"abc/{name}", self._write(f"abc/{name}"))
+        storage.upload("abd/a.mp4", self._write("abd/a.mp4"))
+
+        self.assertIn("downloads/abc/a.mp4", storage.client.objects)
+        self.assertTrue(storage.exists("abc/a.mp4"))
+        self.assertFalse(storage.exists("abc/missing.mp4"))
+        self.assertEqual(
+            storage.url("abc/a.mp4", "a.mp4"),
+            "https://videos.s3.example/downloads/abc/a.mp4?expires=3600",
+        )
+
+        self.assertEqual(storage.delete_prefix("abc/"), 3)
+        self.assertEqual(list(storage.client.objects), ["downloads/abd/a.mp4"])
+        self.assertEqual(storage.metrics()["uploaded_bytes_total"], 40)
+
+    def test_local_storage_by_default(self):
+        """Test the local backend is used unless a bucket is configured"""
+        from storage import LocalStorage, create_storage
+
+        storage = create_storage(app.config)
+        self.assertIsInstance(storage, LocalStorage)
+        self.assertFalse(storage.exists("abc/video.mp4"))
+        self._write("abc/video.mp4")
+        self.assertTrue(storage.exists("abc/video.mp4"))
+
+    def test_file_redirects_to_shared_copy(self):
+        """Test /file redirects to the bucket for downloads made on another instance"""
+        storage = self._storage()
+        storage.upload("abc/video.mp4", self._write("other/video.mp4"))
+        with patch("app.storage", storage):
+            response = self.client.get("/file/abc/video.mp4")
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(
+                response.headers["Location"].startswith(
+                    "https://videos.s3.example/downloads/abc/"
+                )
+            )
+            self.assertEqual(self.client.get("/file/abc/missing.mp4").status_code, 404)
+
+            # Cleanup removes the shared copy even though this instance never had the file
+            response = self.client.post("/cleanup", json={"download_id": "abc"})
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(storage.exists("abc/video.mp4"))
+
+    @patch("yt_dlp.YoutubeDL")
+    def test_download_uploads_to_storage(self, mock_yt_dlp):
+        """Test finished downloads are copied to the shared bucket"""
+
+        def fake_extract(url, download=False):
+            outtmpl = mock_yt_dlp.return_value.params["outtmpl"]
+            with open(
+                os.path.join(os.path.dirname(outtmpl), "Test Video.mp4"), "w"
+            ) as f:
+                f.write("test content")
+            return {"id": "123", "title": "Test Video", "ext": "mp4"}
+
+        mock_yt_dlp.return_value.params = {}
+        mock_yt_dlp.return_value.extract_info.side_effect = fake_extract
+        storage = self._storage()
+        with patch("app.storage", storage):
+            response = self.client.post(
+                "/download", json={"url": "https://www.tiktok.com/@test/video/123"}
+            )
+            download_id = json.loads(response.data)["download_id"]
+            for _ in range(100):
+                job = json.loads(self.client.get(f"/jobs/{download_id}").data)
+                if job["status"] in ("finished", "failed"):
+                    break
+                time.sleep(0.05)
+        self.assertEqual(job["status"], "finished")
+        self.assertEqual(
+            storage.client.objects[f"downloads/{download_id}/{job['filename']}"],
+            b"test content",
+        )
+
+
+class YoutubeDLPoolTestCase(unittest.TestCase):
+    """Test cases for pooled yt-dlp instances"""
+
+    def _pool(self, size=2):
+        from config import Config
+        from ydl_pool import YoutubeDLPool
+
+        return YoutubeDLPool(
+            lambda profile: Config.get_yt_dlp_options("/tmp", profile), size=size
+        )
+
+    def test_instances_are_reused_per_profile(self):
+        """Test sequential checkouts share one instance and profiles stay separate"""
+        pool = self._pool()
+        with pool.checkout("metadata") as first:
+            pass
+        with pool.checkout("metadata") as second:
+            pass
+        with pool.checkout("download") as download:
+            pass
+        self.assertIs(first, second)
+        self.assertIsNot(first, download)
+        self.assertTrue(first.params["quiet"])
+        self.assertEqual(pool.metrics()["created_total"], 2)
+        pool.clear()
+
+    def test_concurrent_checkouts_are_exclusive(self):
+        """Test an instance is never handed to two callers at once"""
+        pool = self._pool()
+        with pool.checkout("metadata") as first:
+            with pool.checkout("metadata") as second:
+                self.assertIsNot(first, second)
+        pool.clear()
+
+    def test_checkout_params_are_restored(self):
+        """Test per-request outtmpl, format and hooks do not leak into later checkouts"""
+        pool = self._pool()
+        hook = lambda status: None
+        with pool.checkout(
+            "download",
+            params={"outtmpl": "/tmp/abc/%(title)s.%(ext)s", "format": "worst"},
+            progress_hooks=[hook],
+        ) as ydl:
+            self.assertEqual(
+                ydl.params["outtmpl"]["default"], "/tmp/abc/%(title)s.%(ext)s"
+            )
+            self.assertEqual(ydl.params["format"], "worst")
+            self.assertIn(hook, ydl._progress_hooks)
+
+        with pool.checkout("download") as ydl:
+            self.assertEqual(ydl.params["outtmpl"]["default"], "/tmp/%(title)s.%(ext)s")
+            self.assertEqual(ydl.params["format"], "best/mp4/any")
+            self.assertNotIn(hook, ydl._progress_hooks)
+        pool.clear()
+
+    def test_warm_up_builds_instances(self):
+        """Test warm-up builds one instance per profile with only the configured extractors"""
+        pool = self._pool()
+        pool.warm_up(("metadata", "download"))
+        metrics = pool.metrics()
+        self.assertEqual((metrics["created_total"], metrics["idle"]), (2, 2))
+        self.assertEqual(metrics["yt_dlp_loaded"], 1)
+        with pool.checkout("metadata") as ydl:
+            self.assertIn("TikTok", ydl._ies)
+            self.assertNotIn("Youtube", ydl._ies)
+        pool.clear()
+
+    def test_app_import_does_not_load_yt_dlp(self):
+        """Test importing the app leaves yt_dlp unloaded until it is needed"""
+        import subprocess
+        import sys
+
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys, app; print('yt_dlp' in sys.modules)"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        self.assertEqual(result.stdout.strip(), "False", result.stderr)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """Test cases for the benchmark harness"""
+
+    def test_fake_origin_serves_pages_and_ranges(self):
+        """Test the fake origin serves video pages and byte ranges of its payload"""
+        import requests
+
+        from benchmarks.fake_origin import FakeOrigin
+
+        origin = FakeOrigin(latency=0, size=1000).start()
+        try:
+            page = requests.get(origin.video_url(7), timeout=5)
+            self.assertIn("/media/7.mp4", page.text)
+            media = requests.get(
+                f"{origin.base_url}/media/7.mp4",
+                headers={"Range": "bytes=10-19"},
+                timeout=5,
+            )
+            self.assertEqual(media.status_code, 206)
+            self.assertEqual(media.content, bytes(range(10, 20)))
+            self.assertEqual(media.headers["Content-Range"], "bytes 10-19/1000")
+        finally:
+            origin.stop()
+
+    def test_baseline_comparison(self):
+        """Test regressions beyond the tolerance are reported"""
+        from benchmarks.run import compare, percentile
+
+        self.assertEqual(percentile([1, 2, 3, 4], 0.5), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 0.99), 4)
+        baseline = {
+            "scenarios": {
+                "file": [{"concurrency": 4, "p95_ms": 10, "rps": 100, "errors": 0}]
+            }
+        }
+        same = {
+            "scenarios": {
+                "file": [{"concurrency": 4, "p95_ms": 11, "rps": 95, "errors": 0}]
+            }
+        }
+        slower = {
+            "scenarios": {
+                "file": [{"concurrency": 4, "p95_ms": 20, "rps": 50, "errors": 0}]
+            }
+        }
+        self.assertEqual(compare(same, baseline, 0.2), [])
+        self.assertEqual(len(compare(slower, baseline, 0.2)), 2)
+
 
 class ConfigTestCase(unittest.TestCase):
     """Test cases for configuration"""
-    
+
     def test_development_config(self):
         """Test development configuration"""
         from config import DevelopmentConfig
+
         config = DevelopmentConfig()
         self.assertTrue(config.DEBUG)
-        self.assertEqual(config.LOG_LEVEL, 'DEBUG')
-    
+        self.assertEqual(config.LOG_LEVEL, "DEBUG")
+
     def test_production_config(self):
         """Test production configuration"""
         from config import ProductionConfig
+
         config = ProductionConfig()
         self.assertFalse(config.DEBUG)
-        self.assertEqual(config.LOG_LEVEL, 'WARNING')
-    
+        self.assertEqual(config.LOG_LEVEL, "WARNING")
+
     def test_testing_config(self):
         """Test testing configuration"""
         from config import TestingConfig
+
         config = TestingConfig()
         self.assertTrue(config.TESTING)
         self.assertTrue(config.DEBUG)
-    
+
     def test_get_config(self):
         """Test get_config function"""
-        from config import get_config, ProductionConfig
-        config = get_config('production')
+        from config import ProductionConfig, get_config
+
+        config = get_config("production")
         self.assertEqual(config, ProductionConfig)
-    
+
     def test_yt_dlp_options(self):
         """Test yt-dlp options generation"""
         from config import Config
-        options = Config.get_yt_dlp_options('/test/dir')
-        self.assertIn('outtmpl', options)
-        self.assertIn('http_headers', options)
-        self.assertIn('User-Agent', options['http_headers'])
 
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+        options = Config.get_yt_dlp_options("/test/dir")
+        self.assertIn("outtmpl", options)
+        self.assertIn("http_headers", options)
+        self.assertIn("User-Agent", options["http_headers"])
+
+        metadata_options = Config.get_yt_dlp_options("/test/dir", profile="metadata")
+        self.assertNotIn("outtmpl", metadata_options)
+        self.assertEqual(metadata_options["http_headers"], options["http_headers"])
+        self.assertNotIn("retry_sleep_functions", metadata_options)
+
+        retry_sleep = lambda n: 0.1
+        options = Config.get_yt_dlp_options("/test/dir", retry_sleep=retry_sleep)
+        self.assertIs(options["retry_sleep_functions"]["http"], retry_sleep)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from admission import AdmissionRejected
+from deadlines import DeadlineExceeded
+from monitoring import REGISTRY
+
+UPSTREAM_THROTTLED = REGISTRY.counter(
+    "app_upstream_throttled_total",
+    "yt-dlp operations answered with 403 or 429 by TikTok",
+    ("operation",),
+)
+
+# How yt-dlp reports TikTok turning a request away
+_THROTTLED = re.compile(r"HTTP Error (?:403|429)\b|Too Many Requests")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class UpstreamUnavailable(AdmissionRejected):
+    """Raised instead of calling TikTok while it is throttling us"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message, 503, retry_after)
+
+
+def is_throttled(error: BaseException) -> bool:
+    """Whether an upstream error is TikTok rate limiting or blocking us"""
+    return bool(_THROTTLED.search(str(error)))
+
+
+class UpstreamGuard:
+    """Circuit breaker and retry budget shared by every upstream call of a process.
+
+    A burst of `threshold` throttled responses (403/429) within `window`
+    seconds opens the circuit: calls fail at once with UpstreamUnavailable
+    for a jittered `cooldown`, after which up to `probes` calls go through.
+    A probe that is not throttled closes the circuit again, a throttled one
+    reopens it.
+
+    Throttled calls are retried after a jittered backoff while the retry
+    budget has tokens. Every call adds `retry_ratio` of a token and every
+    retry spends one, so retries stay a bounded fraction of the traffic
+    however many requests fail at once. threshold 0 disables the breaker.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 5,
+        window: float = 30,
+        cooldown: float = 30,
+        probes: int = 1,
+        max_retries: int = 2,
+        retry_ratio: float = 0.2,
+        retry_burst: float = 10,
+        base_delay: float = 0.5,
+        max_delay: float = 5,
+    ):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.probes = probes
+        self.max_retries = max_retries
+        self.retry_ratio = retry_ratio
+        self.retry_burst = retry_burst
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self.retries = 0
+        self.budget_exhausted = 0
+        self._tokens = float(retry_burst)
+        self._failures: deque = deque()
+        self._open_until = 0.0
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def call(self, operation: str, func: Callable[[], Any], deadline=None) -> Any:
+        """Run func unless the circuit is open, retrying throttled attempts within the budget"""
+        with self._lock:
+            self._tokens = min(self._tokens + self.retry_ratio, self.retry_burst)
+        attempt = 0
+        while True:
+            probe = self._enter()
+            try:
+                result = func()
+            except (AdmissionRejected, DeadlineExceeded):
+                # Turned away or cut short on our side; says nothing about TikTok
+                self._record(probe, None)
+                raise
+            except Exception as e:
+                throttled = is_throttled(e)
+                if throttled:
+                    UPSTREAM_THROTTLED.inc(operation=operation)
+                self._record(probe, throttled)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._record(probe, False)
+            return result
+
+    def retry_sleep(self, n: int) -> float:
+        """yt-dlp retry_sleep_functions hook: a jittered backoff drawn from the retry budget.
+
+        yt-dlp's own retry count still caps the attempts.
+        """
+        delay = self._retry_delay(n)
+        if delay is None:
+            # Raised inside yt-dlp's retry loop, this ends the transfer
+            raise UpstreamUnavailable(
+                "Upstream retry budget exhausted, please retry later",
+                math.ceil(self.cooldown),
+            )
+        return delay
+
+    def _enter(self) -> bool:
+        """Admit a call, or raise while the circuit is open; returns whether it is a probe"""
+        if self.threshold <= 0:
+            return False
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._open_until - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise UpstreamUnavailable(
+                        "TikTok is throttling requests, please retry later",
+                        math.ceil(remaining),
+                    )
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self._probing >= self.probes:
+                    self.rejected += 1
+                    raise UpstreamUnavailable(
+                        "TikTok is throttling requests, please retry later", 1
+                    )
+                self._probing += 1
+                return True
+            return False
+
+    def _record(self, probe: bool, throttled: Optional[bool]):
+        """Feed the outcome of a call to the breaker; None when there is nothing to learn from it"""
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                self._probing -= 1
+                if throttled is None:
+                    return
+                if throttled:
+                    self._open(now)
+                else:
+                    self.state = CLOSED
+                    self._failures.clear()
+                return
+            if not throttled or self.state != CLOSED:
+                return
+            self._failures.append(now)
+            while self._failures and self._failures[0] < now - self.window:
+                self._failures.popleft()
+            if len(self._failures) >= self.threshold:
+                self._open(now)
+
+    def _open(self, now: float):
+        """Open the circuit; called with the lock held"""
+        self.state = OPEN
+        self.opened += 1
+        self._failures.clear()
+        # Jittered so instances that opened together do not all probe at once
+        self._open_until = now + self.cooldown * random.uniform(0.8, 1.2)
+
+    def _retry_delay(self, attempt: int, deadline=None) -> Optional[float]:
+        """Backoff before another attempt, or None when no retry is allowed"""
+        with self._lock:
+            if self.state != CLOSED:
+                return None
+            # Full jitter spreads the retries of requests that failed together
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+            if deadline is not None and deadline.remaining() <= delay:
+                return None
+            if self._tokens < 1:
+                self.budget_exhausted += 1
+                return None
+            self._tokens -= 1
+            self.retries += 1
+            return delay
+
+    def metrics(self) -> Dict[str, Any]:
+        """Breaker and retry budget counters for the /metrics endpoint"""
+        with self._lock:
+            return {
+                "open": int(self.state == OPEN),
+                "half_open": int(self.state == HALF_OPEN),
+                "opened_total": self.opened,
+                "rejected_total": self.rejected,
+                "retries_total": self.retries,
+                "retry_budget_exhausted_total": self.budget_exhausted,
+                "retry_budget": round(self._tokens, 2),
+            }
@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# Summary fields kept per video; full info dicts stay in the metadata cache
+METADATA_FIELDS = (
+    "title",
+    "uploader",
+    "uploader_id",
+    "duration",
+    "upload_date",
+    "webpage_url",
+    "thumbnail",
+)
+
+# Download IDs remembered per video
+MAX_DOWNLOADS_PER_VIDEO = 20
+
+# Writes between trims of the least recently updated videos and aliases
+_TRIM_EVERY = 100
+
+
+class VideoIndex:
+    """Persistent index from TikTok video ID to known downloads, metadata and URL aliases.
+
+    Shared by all workers through a SQLite database in the upload folder,
+    next to the metadata store. It runs in WAL mode, so every update is a
+    single-row write that never blocks readers; each thread keeps its own
+    connection. Aliases map normalized short links to the video ID they
+    redirect to.
+    """
+
+    _instances: Dict[str, "VideoIndex"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, upload_folder: str, maxsize: int = 5000):
+        self.upload_folder = upload_folder
+        self.path = os.path.join(upload_folder, ".store", "videos.db")
+        self.maxsize = maxsize
+        self.writes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connect()
+        self._import_json(os.path.join(upload_folder, ".store", "videos.json"))
+
+    @classmethod
+    def for_folder(cls, upload_folder: str, maxsize: int = 5000) -> "VideoIndex":
+        """Get the shared index that lives inside an upload folder"""
+        key = os.path.abspath(upload_folder)
+        with cls._instances_lock:
+            index = cls._instances.get(key)
+            if index is None:
+                index = cls._instances[key] = cls(key, maxsize)
+            return index
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not os.path.exists(self.path):
+            # The database was deleted underneath us (e.g. by /cleanup)
+            conn.close()
+            conn = None
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS videos ("
+                    "video_id TEXT PRIMARY KEY, metadata TEXT, updated_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS videos_updated_at ON videos (updated_at)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS downloads ("
+                    "video_id TEXT NOT NULL, download_id TEXT NOT NULL, "
+                    "PRIMARY KEY (video_id, download_id))"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS aliases ("
+                    "url TEXT PRIMARY KEY, video_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS aliases_updated_at ON aliases (updated_at)"
+                )
+            self._local.conn = conn
+        return conn
+
+    def get(self, video_id: str) -> Optional[Dict[str, Any]]:
+        """Return a video's record with only the downloads still on disk"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT metadata, updated_at FROM videos WHERE video_id = ?",
+            (str(video_id),),
+        ).fetchone()
+        if row is None:
+            return None
+        record: Dict[str, Any] = {"video_id": str(video_id), "updated_at": row[1]}
+        if row[0] is not None:
+            record["metadata"] = json.loads(row[0])
+        # Oldest first; re-recording a download moves it to the end
+        rows = conn.execute(
+            "SELECT download_id FROM downloads WHERE video_id = ? ORDER BY rowid",
+            (str(video_id),),
+        )
+        record["download_ids"] = [
+            download_id
+            for (download_id,) in rows
+            if os.path.isdir(os.path.join(self.upload_folder, download_id))
+        ]
+        return record
+
+    def record_download(self, video_id: str, download_id: str):
+        """Remember that a download holds a video"""
+        video_id = str(video_id)
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO videos (video_id, updated_at) VALUES (?, ?) "
+                "ON CONFLICT (video_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (video_id, time.time()),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO downloads (video_id, download_id) VALUES (?, ?)",
+                (video_id, download_id),
+            )
+            conn.execute(
+                "DELETE FROM downloads WHERE video_id = ? AND rowid NOT IN ("
+                "SELECT rowid FROM downloads WHERE video_id = ? ORDER BY rowid DESC LIMIT ?)",
+                (video_id, video_id, MAX_DOWNLOADS_PER_VIDEO),
+            )
+        self._wrote()
+
+    def record_metadata(self, video_id: str, info: Dict[str, Any]):
+        """Remember summary metadata from an extracted info dict"""
+        metadata = json.dumps(
+            {
+                field: info.get(field)
+                for field in METADATA_FIELDS
+                if info.get(field) is not None
+            },
+            sort_keys=True,
+            default=str,
+        )
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO videos (video_id, metadata, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (video_id) DO UPDATE SET "
+                "metadata = excluded.metadata, updated_at = excluded.updated_at "
+                "WHERE videos.metadata IS NOT excluded.metadata",
+                (str(video_id), metadata, time.time()),
+            )
+        if cursor.rowcount:
+            self._wrote()
+
+    def alias(self, url: str) -> Optional[str]:
+        """Video ID a normalized URL is known to point at"""
+        row = (
+            self._connect()
+            .execute("SELECT video_id FROM aliases WHERE url = ?", (url,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def add_alias(self, url: str, video_id: str):
+        """Remember the video ID a normalized URL resolved to"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO aliases (url, video_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET "
+                "video_id = excluded.video_id, updated_at = excluded.updated_at "
+                "WHERE aliases.video_id != excluded.video_id",
+                (url, str(video_id), time.time()),
+            )
+        if cursor.rowcount:
+            self._wrote()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Index sizes for the /metrics endpoint"""
+        conn = self._connect()
+        return {
+            "videos": conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0],
+            "aliases": conn.execute("SELECT COUNT(*) FROM aliases").fetchone()[0],
+        }
+
+    def trim(self):
+        """Drop the least recently updated videos and aliases beyond maxsize"""
+        if not self.maxsize:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "DELETE FROM videos WHERE video_id NOT IN ("
+                "SELECT video_id FROM videos ORDER BY updated_at DESC LIMIT ?)",
+                (self.maxsize,),
+            )
+            conn.execute(
+                "DELETE FROM downloads WHERE video_id NOT IN (SELECT video_id FROM videos)"
+            )
+            conn.execute(
+                "DELETE FROM aliases WHERE url NOT IN ("
+                "SELECT url FROM aliases ORDER BY updated_at DESC LIMIT ?)",
+                (self.maxsize,),
+            )
+
+    def _wrote(self):
+        with self._lock:
+            self.writes += 1
+            trim = self.writes % _TRIM_EVERY == 0
+        if trim:
+            self.trim()
+
+    def _import_json(self, path: str):
+        """Move an index left by older releases, which kept it in videos.json, into the database"""
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read old video index: {e}")
+            return
+        conn = self._connect()
+        with conn:
+            for video_id, record in data.get("videos", {}).items():
+                metadata = record.get("metadata")
+                conn.execute(
+                    "INSERT OR IGNORE INTO videos (video_id, metadata, updated_at) VALUES (?, ?, ?)",
+                    (
+                        video_id,
+                        (
+                            json.dumps(metadata, sort_keys=True, default=str)
+                            if metadata is not None
+                            else None
+                        ),
+                        record.get("updated_at", 0),
+                    ),
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO downloads (video_id, download_id) VALUES (?, ?)",
+                    [(video_id, d) for d in record.get("download_ids", [])],
+                )
+            conn.executemany(
+                "INSERT OR IGNORE INTO aliases (url, video_id, updated_at) VALUES (?, ?, ?)",
+                [
+                    (url, alias["video_id"], alias.get("updated_at", 0))
+                    for url, alias in data.get("aliases", {}).items()
+                ],
+            )
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
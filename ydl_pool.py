@@ -0,0 +1,213 @@
+import importlib
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, Optional
+
+import psutil
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+# Marks a parameter that was not set before a checkout override
+_MISSING = object()
+
+# yt_dlp is imported on first use so the app starts (and answers /health) without it
+_yt_dlp = None
+_import_lock = threading.Lock()
+# Cost of that import in this process, for the /metrics endpoint
+IMPORT_STATS = {"loaded": 0, "import_seconds": 0.0, "import_rss_bytes": 0}
+
+
+def load_yt_dlp():
+    """Import yt_dlp once per process and return the module"""
+    global _yt_dlp
+    if _yt_dlp is None:
+        with _import_lock:
+            if _yt_dlp is None:
+                process = psutil.Process()
+                rss = process.memory_info().rss
+                started = time.perf_counter()
+                module = importlib.import_module("yt_dlp")
+                IMPORT_STATS.update(
+                    loaded=1,
+                    import_seconds=round(time.perf_counter() - started, 3),
+                    import_rss_bytes=max(process.memory_info().rss - rss, 0),
+                )
+                _yt_dlp = module
+    return _yt_dlp
+
+
+class YoutubeDLPool:
+    """Reusable YoutubeDL instances, one pool per option profile.
+
+    Building a YoutubeDL loads its extractors and sets up a request
+    director whose HTTP sessions keep connections (and TLS sessions) to
+    TikTok alive. Reusing instances keeps that state across requests.
+    An instance is not thread-safe, so each checkout gets exclusive use
+    of one; per-request settings are applied on checkout and undone on
+    return.
+    """
+
+    def __init__(self, build_options: Callable[[str], Dict[str, Any]], size: int = 8):
+        self.build_options = build_options
+        self.size = size
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.warmup_seconds = 0.0
+        self._idle: Dict[str, "queue.LifoQueue"] = {}
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._warmup_pid: Optional[int] = None
+
+    @contextmanager
+    def checkout(
+        self,
+        profile: str,
+        params: Optional[Dict[str, Any]] = None,
+        progress_hooks: Iterable[Callable] = (),
+    ) -> Iterator["yt_dlp.YoutubeDL"]:
+        """Borrow an instance with per-request params and progress hooks applied"""
+        ydl = self._acquire(profile)
+        saved = {}
+        hooks = list(progress_hooks)
+        try:
+            for key, value in (params or {}).items():
+                saved[key] = ydl.params.get(key, _MISSING)
+                self._set_param(ydl, key, value)
+            for hook in hooks:
+                ydl.add_progress_hook(hook)
+            yield ydl
+        finally:
+            try:
+                for hook in hooks:
+                    ydl._progress_hooks.remove(hook)
+                for key, value in saved.items():
+                    if value is _MISSING:
+                        ydl.params.pop(key, None)
+                    else:
+                        self._set_param(ydl, key, value)
+                ydl._download_retcode = 0
+            except Exception as e:
+                # Never hand out an instance we could not reset
+                logging.warning(f"Discarding YoutubeDL instance for '{profile}': {e}")
+                self._discard(profile, ydl)
+            else:
+                self._idle[profile].put(ydl)
+
+    @staticmethod
+    def _set_param(ydl: "yt_dlp.YoutubeDL", key: str, value: Any):
+        if (
+            key == "outtmpl"
+            and isinstance(value, str)
+            and isinstance(ydl.params.get("outtmpl"), dict)
+        ):
+            # YoutubeDL normalizes outtmpl into a dict of templates at init
+            value = {**ydl.params["outtmpl"], "default": value}
+        ydl.params[key] = value
+        if key == "format":
+            # The format selector is compiled once at init
+            ydl.format_selector = ydl.build_format_selector(value) if value else None
+
+    def _acquire(self, profile: str) -> "yt_dlp.YoutubeDL":
+        with self._lock:
+            self.checkouts += 1
+        waited = False
+        while True:
+            with self._lock:
+                idle = self._idle.setdefault(profile, queue.LifoQueue())
+                try:
+                    return idle.get_nowait()
+                except queue.Empty:
+                    pass
+                create = self._counts.get(profile, 0) < self.size
+                if create:
+                    self._counts[profile] = self._counts.get(profile, 0) + 1
+                    self.created += 1
+                elif not waited:
+                    self.waits += 1
+                    waited = True
+
+            if create:
+                try:
+                    return load_yt_dlp().YoutubeDL(self.build_options(profile))
+                except Exception:
+                    with self._lock:
+                        self._counts[profile] -= 1
+                    raise
+
+            # Every instance for this profile is busy; wait for one to come
+            # back, re-checking in case a discarded one frees up a slot
+            try:
+                return idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def _discard(self, profile: str, ydl: "yt_dlp.YoutubeDL"):
+        with self._lock:
+            self._counts[profile] -= 1
+        try:
+            ydl.close()
+        except Exception:
+            pass
+
+    def warm_up(self, profiles: Iterable[str]):
+        """Import yt_dlp and build one instance per profile ahead of the first request"""
+        started = time.perf_counter()
+        for profile in profiles:
+            with self.checkout(profile):
+                pass
+        self.warmup_seconds = round(time.perf_counter() - started, 3)
+
+    def start_warm_up(self, profiles: Iterable[str]):
+        """Run warm_up() on a background thread once per process"""
+        if self._warmup_pid == os.getpid():
+            return
+        with self._lock:
+            if self._warmup_pid == os.getpid():
+                return
+            self._warmup_pid = os.getpid()
+        threading.Thread(
+            target=self._warm_up_safely,
+            args=(list(profiles),),
+            name="ydl-warmup",
+            daemon=True,
+        ).start()
+
+    def _warm_up_safely(self, profiles):
+        try:
+            self.warm_up(profiles)
+        except Exception as e:
+            # Requests still build instances on demand
+            logging.warning(f"yt-dlp warm-up failed: {e}")
+
+    def clear(self):
+        """Close and drop all idle instances"""
+        with self._lock:
+            pools = list(self._idle.items())
+        for profile, idle in pools:
+            while True:
+                try:
+                    ydl = idle.get_nowait()
+                except queue.Empty:
+                    break
+                self._discard(profile, ydl)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Pool counters for the /metrics endpoint"""
+        with self._lock:
+            return {
+                "created_total": self.created,
+                "checkouts_total": self.checkouts,
+                "waits_total": self.waits,
+                "instances": sum(self._counts.values()),
+                "idle": sum(idle.qsize() for idle in self._idle.values()),
+                "warmup_seconds": self.warmup_seconds,
+                "yt_dlp_loaded": IMPORT_STATS["loaded"],
+                "yt_dlp_import_seconds": IMPORT_STATS["import_seconds"],
+                "yt_dlp_import_rss_bytes": IMPORT_STATS["import_rss_bytes"],
+            }
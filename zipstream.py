@@ -0,0 +1,59 @@
+import zipfile
+from typing import IO, Iterable, Iterator, Tuple, cast
+
+
+class _ZipBuffer:
+    """Write-only, unseekable target that collects bytes for the next yield.
+
+    zipfile detects the missing seek() and writes data descriptors after
+    each member, so an archive can be produced front to back.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(
+    members: Iterable[Tuple[str, str]],
+    extra: Iterable[Tuple[str, bytes]] = (),
+    chunk_size: int = 64 * 1024,
+) -> Iterator[bytes]:
+    """Yield a ZIP archive of (path, arcname) files chunk by chunk.
+
+    Members are stored without compression since videos are already
+    compressed; at most one chunk of each file is held in memory.
+    """
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(
+        cast(IO[bytes], buffer), "w", compression=zipfile.ZIP_STORED
+    ) as archive:
+        for path, arcname in members:
+            with open(path, "rb") as src, archive.open(
+                arcname, "w", force_zip64=True
+            ) as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            yield buffer.drain()
+        for arcname, content in extra:
+            archive.writestr(arcname, content)
+    yield buffer.drain()